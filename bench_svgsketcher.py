@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Benchmarks of the hot paths of the sketcher. Each benchmark is run for
+several sizes (number of elements), and measured in wall time (best of
+several runs), peak of memory allocated during the run (tracemalloc) and
+size of the output (bytes).
+
+The results are compared to a baseline (JSON file), and the benchmark
+fails (exit status 1) if a measure exceeds the baseline by more than a
+threshold. The baseline is created by the first run, and can be updated
+on demand. The parameters are read from the environment:
+
+- BENCH_SIZES: comma separated list of sizes (default 1000,10000,100000)
+- BENCH_REPEAT: number of runs for the time measure (default 3)
+- BENCH_BASELINE: path of the baseline file (default bench_baseline.json)
+- BENCH_THRESHOLD: tolerated relative regression (default 0.25)
+- BENCH_UPDATE: set to 1 to replace the baseline by the results
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import subprocess
+import tracemalloc
+
+import environ
+import svgsketcher
+import telecran
+
+# =======================================================================
+# The benchmarks. Each benchmark is a function that prepares the data
+# for the size n (not measured), and returns the function to measure,
+# which returns the size of the output (bytes, 0 if no output).
+
+def spiral(n):
+    return [(0.001*i*math.cos(0.01*i), 0.001*i*math.sin(0.01*i)) for i in range(n)]
+
+def newSketcher():
+    return svgsketcher.SvgSketcher.newCenteredCoordinates(xrange=200)
+
+def bench_lineTo(n):
+    points = spiral(n)
+    def run():
+        sketcher = newSketcher()
+        for x, y in points: sketcher.lineTo(x, y)
+        return 0
+    return run
+
+def bench_polygon(n):
+    points = spiral(n)
+    def run():
+        newSketcher().polygon(points, closed=True)
+        return 0
+    return run
+
+def bench_point(n):
+    points = spiral(n)
+    def run():
+        sketcher = newSketcher()
+        for x, y in points: sketcher.point(x, y)
+        return 0
+    return run
+
+def bench_labels(n):
+    # labelled points with collision-free label placement
+    points = spiral(n)
+    def run():
+        sketcher = newSketcher()
+        sketcher.labelPlacement = "leader"
+        for i, (x, y) in enumerate(points): sketcher.point(x, y, label="P%d"%i)
+        return 0
+    return run
+
+def bench_text(n):
+    points = spiral(n)
+    def run():
+        sketcher = newSketcher()
+        for x, y in points: sketcher.text(x, y, "label")
+        return 0
+    return run
+
+def bench_circle(n):
+    points = spiral(n)
+    def run():
+        sketcher = newSketcher()
+        for x, y in points: sketcher.circle(x, y, radius=0.5)
+        return 0
+    return run
+
+def bench_toSVG(n):
+    sketcher = newSketcher()
+    sketcher.polygon(spiral(n))
+    def run():
+        return len(sketcher.toSVG())
+    return run
+
+def bench_toSVG_grouped(n):
+    sketcher = newSketcher()
+    for i, (x, y) in enumerate(spiral(n)):
+        sketcher.pencil.lineColor = ("red", "green", "blue")[(i // 100) % 3]
+        sketcher.lineTo(x, y)
+    def run():
+        return len(sketcher.toSVG(grouped=True))
+    return run
+
+def bench_toJSON(n):
+    sketcher = newSketcher()
+    sketcher.polygon(spiral(n))
+    def run():
+        return len(sketcher.toJSON())
+    return run
+
+def bench_save(n):
+    sketcher = newSketcher()
+    sketcher.polygon(spiral(n))
+    svgpath = svgsketcher.svgTempPath()
+    def run():
+        sketcher.save(svgpath)
+        return os.path.getsize(svgpath)
+    return run
+
+def bench_boundingBox(n):
+    points = spiral(n)
+    def run():
+        svgsketcher.boundingBox(points)
+        return 0
+    return run
+
+def bench_transform(n):
+    points = spiral(n)
+    csys = svgsketcher.CoordinatesSystem.Centered(600, 400, xyunit=3)
+    def run():
+        cnvCoordinates = csys.cnvCoordinates
+        for x, y in points: cnvCoordinates(x, y)
+        return 0
+    return run
+
+def bench_telecran(n):
+    # Replay of knob moves: runs of 10 steps in a turning direction
+    steps = [((1, 0), (0, 1), (-1, 0), (0, -1))[(i // 10) % 4] for i in range(n)]
+    def run():
+        t = telecran.Telecran()
+        for dx, dy in steps:
+            if dx: t.hlineLong(dx)
+            else: t.vlineLong(dy)
+        return 0
+    return run
+
+def bench_telecranNew(n):
+    def run():
+        for i in range(n): telecran.Telecran()
+        return 0
+    return run
+
+def bench_import(n):
+    # Startup of a python process that imports the telecran (run once,
+    # see sizeless, n is None). The modules are compiled once before, so
+    # that only the import is measured, and not the compilation.
+    command = [sys.executable, "-c", "import telecran"]
+    subprocess.run(command, check=True)
+    def run():
+        subprocess.run(command, check=True)
+        return 0
+    return run
+
+benchmarks = [
+    bench_lineTo, bench_polygon, bench_point, bench_labels, bench_text, bench_circle,
+    bench_toSVG, bench_toSVG_grouped, bench_toJSON, bench_save, bench_boundingBox,
+    bench_transform, bench_telecran, bench_telecranNew, bench_import,
+]
+# The benchmarks that do not depend on the size, run once (n is None)
+sizeless = [bench_import]
+
+# =======================================================================
+# Measures and comparison with the baseline
+
+def measure(benchmark, n, repeat):
+    """Return the measures (time, peak, bytes) of the benchmark for the
+    size n. The peak of memory is measured in a separate run, because
+    tracemalloc slows down the execution."""
+    run = benchmark(n)
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        nbytes = run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"time": min(times), "peak": peak, "bytes": nbytes}
+
+# Differences below these absolute values are considered as noise
+noise = {"time": 0.001, "peak": 1024, "bytes": 0}
+
+def compare(results, baseline, threshold):
+    """Return the list of regressions, i.e. the measures of the results
+    greater than the baseline by more than the threshold (relative)"""
+    regressions = []
+    for key, result in sorted(results.items()):
+        reference = baseline.get(key)
+        if reference is None: continue
+        for name in ("time", "peak", "bytes"):
+            if result[name] > reference[name] * (1. + threshold) + noise[name]:
+                regressions.append("%s %s: %.4g > %.4g"%(key, name, result[name], reference[name]))
+    return regressions
+
+def runbench():
+    sizes = [int(float(size)) for size in os.environ.get("BENCH_SIZES", "1000,10000,100000").split(",")]
+    repeat = int(os.environ.get("BENCH_REPEAT", 3))
+    baselinepath = os.environ.get("BENCH_BASELINE", "bench_baseline.json")
+    threshold = float(os.environ.get("BENCH_THRESHOLD", 0.25))
+    update = environ.boolenv("BENCH_UPDATE", False)
+
+    results = {}
+    print("%-28s %10s %12s %12s"%("benchmark", "time (s)", "peak (kB)", "output (kB)"))
+    for benchmark in benchmarks:
+        name = benchmark.__name__[len("bench_"):]
+        for n in ([None] if benchmark in sizeless else sizes):
+            key = name if n is None else "%s:%d"%(name, n)
+            result = measure(benchmark, n, repeat)
+            results[key] = result
+            print("%-28s %10.4f %12.1f %12.1f"%(
+                key, result["time"], result["peak"]/1024., result["bytes"]/1024.))
+            sys.stdout.flush()
+
+    baseline = {}
+    if os.path.exists(baselinepath):
+        with open(baselinepath) as baselinefile: baseline = json.load(baselinefile)
+    regressions = compare(results, baseline, threshold)
+    if update or not baseline:
+        baseline.update(results)
+        with open(baselinepath, 'w') as baselinefile:
+            json.dump(baseline, baselinefile, indent=1, sort_keys=True)
+        print("Baseline saved in file: %s"%baselinepath)
+        return True
+    for regression in regressions:
+        print("REGRESSION: %s"%regression, file=sys.stderr)
+    return not regressions
+
+if __name__ == "__main__":
+    sys.exit(0 if runbench() else 1)
@@ -1,9 +1,9 @@
 # coding: utf-8
 import os
 
-import subprocess
 def getScreenSize():
     """This function retrieve the screen sizes using the linux command xrandr"""
+    import subprocess
     cmd1 = ['xrandr']    # to print the screen resolutions
     cmd2 = ['grep', '*'] # to filter the selected resolution
     # The output of cmd1 is piped into the input of cmd2
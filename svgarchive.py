@@ -0,0 +1,194 @@
+# coding: utf-8
+
+"""
+Archives of sketches: many sketches (sketchers or compositions) written
+in a single zip or tar archive instead of one file by sketch, optionally
+with a PNG rendition of each sketch, and with a manifest (JSON index of
+the sketches). The SVG text of a sketch is written piece by piece, and
+any member can be read back alone:
+
+    with SvgArchive("sketches.zip", "w") as archive:
+        for i, sketcher in enumerate(sketchers):
+            archive.add("sketch%d"%i, sketcher)
+
+    archive = SvgArchive("sketches.zip")
+    svgtext = archive.read("sketch42")
+
+The format is given by the extension of the archive: .zip, or .tar,
+.tar.gz (.tgz), .tar.bz2, .tar.xz. The zip archives are written member
+by member without any copy (a tar member needs its size in its header,
+so its text is first written in a spooled temporary file), and are the
+most efficient for random reads (the tar archives are scanned once to
+know the position of the members, and the compressed tar archives must
+be decompressed up to the member).
+"""
+
+__author__ = "gboulant, nov. 2022"
+
+import io
+import json
+import time
+import shutil
+import tarfile
+import zipfile
+import tempfile
+
+from svgsketcher import SvgException, loadSVG
+
+def importWand():
+    try:
+        from wand.image import Image
+    except ImportError:
+        raise SvgException("PNG renditions require imagemagick and python3-wand")
+    return Image
+
+tarModes = ((".tar.gz", "gz"), (".tgz", "gz"), (".tar.bz2", "bz2"), (".tar.xz", "xz"), (".tar", ""))
+
+def archiveFormat(filepath):
+    """Return the format ("zip" or "tar") and the tar compression of the
+    archive, given by the extension of its path"""
+    if filepath.endswith(".zip"): return "zip", None
+    for extension, compression in tarModes:
+        if filepath.endswith(extension): return "tar", compression
+    raise SvgException("Unknown archive format for %s (zip or tar expected)"%filepath)
+
+def iterBuffered(fragments, size):
+    """Generate the UTF-8 encoded text fragments, gathered in chunks of
+    about size bytes"""
+    chunk, length = [], 0
+    for fragment in fragments:
+        chunk.append(fragment)
+        length += len(fragment)
+        if length >= size:
+            yield "".join(chunk).encode("utf-8")
+            chunk, length = [], 0
+    if chunk: yield "".join(chunk).encode("utf-8")
+
+class SvgArchive:
+    chunkSize = 65536      # bytes written at once in a member
+    spoolSize = 1 << 20    # bytes of a member kept in memory before writing to disk
+    manifestName = "manifest.json"
+
+    def __init__(self, filepath, mode="r", png=False):
+        """Open the archive for reading (mode "r") or writing (mode "w").
+        If png is True, a PNG rendition of each sketch is added (see
+        add)."""
+        self.filepath = filepath
+        self.mode = mode
+        self.png = png
+        self.format, compression = archiveFormat(filepath)
+        self.manifest = [] # entries of the sketches (see add)
+        self._names = set()
+        self._Image = importWand() if png and mode == "w" else None
+        if mode == "w":
+            if self.format == "zip":
+                self._archive = zipfile.ZipFile(filepath, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+            else:
+                self._archive = tarfile.open(filepath, "w:" + compression)
+        elif mode == "r":
+            if self.format == "zip":
+                self._archive = zipfile.ZipFile(filepath)
+                self._members = None
+            else:
+                self._archive = tarfile.open(filepath, "r:" + compression)
+                self._members = dict((info.name, info) for info in self._archive)
+            self._readManifest()
+        else:
+            raise SvgException("Unknown archive mode %s"%mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def close(self):
+        """Close the archive (after the writing of the manifest if the
+        archive is written)"""
+        if self._archive is None: return
+        if self.mode == "w":
+            data = json.dumps({"sketches": self.manifest}, indent=1).encode("utf-8")
+            self._writeMember(SvgArchive.manifestName, io.BytesIO(data), len(data))
+        self._archive.close()
+        self._archive = None
+
+    # ---------------------------------------------------------
+    # Writing
+    def add(self, name, sketch, grouped=None):
+        """Write the SVG text of the sketch as the member name.svg of
+        the archive (and its PNG rendition as name.png if the archive is
+        opened with png), and return the entry of the manifest of the
+        sketch: name, members, canvas size and size of the SVG text."""
+        if name in self._names:
+            raise SvgException("A sketch named %s is already in the archive"%name)
+        entry = {"name": name, "svg": name + ".svg",
+                 "width": sketch.cnvwidth, "height": sketch.cnvheight}
+        chunks = iterBuffered(sketch._iterSVG(grouped), SvgArchive.chunkSize)
+        if self.format == "zip" and not self.png:
+            # streamed in the archive
+            with self._archive.open(entry["svg"], "w", force_zip64=True) as member:
+                for chunk in chunks: member.write(chunk)
+            entry["bytes"] = self._archive.getinfo(entry["svg"]).file_size
+        else:
+            with tempfile.SpooledTemporaryFile(SvgArchive.spoolSize) as spool:
+                for chunk in chunks: spool.write(chunk)
+                entry["bytes"] = spool.tell()
+                spool.seek(0)
+                self._writeMember(entry["svg"], spool, entry["bytes"])
+                if self.png:
+                    spool.seek(0)
+                    with self._Image(file=spool, format="svg") as image:
+                        data = image.make_blob("png")
+                    entry["png"] = name + ".png"
+                    self._writeMember(entry["png"], io.BytesIO(data), len(data))
+        self.manifest.append(entry)
+        self._names.add(name)
+        return entry
+
+    def _writeMember(self, membername, fileobj, size):
+        if self.format == "zip":
+            with self._archive.open(membername, "w", force_zip64=True) as member:
+                shutil.copyfileobj(fileobj, member, SvgArchive.chunkSize)
+        else:
+            info = tarfile.TarInfo(membername)
+            info.size = size
+            info.mtime = time.time()
+            self._archive.addfile(info, fileobj)
+
+    # ---------------------------------------------------------
+    # Reading
+    def _readManifest(self):
+        try:
+            with self.open(SvgArchive.manifestName) as member:
+                self.manifest = json.load(member)["sketches"]
+        except KeyError:
+            # no manifest: the sketches are the svg members
+            self.manifest = [{"name": membername[:-len(".svg")], "svg": membername}
+                             for membername in self._memberNames() if membername.endswith(".svg")]
+
+    def _memberNames(self):
+        if self.format == "zip": return self._archive.namelist()
+        return list(self._members)
+
+    def names(self):
+        """Return the names of the sketches of the archive"""
+        return [entry["name"] for entry in self.manifest]
+
+    def open(self, membername):
+        """Return a binary file object to read the member of the archive
+        (KeyError if there is no such member)"""
+        if self.format == "zip": return self._archive.open(membername)
+        return self._archive.extractfile(self._members[membername])
+
+    def read(self, name, png=False):
+        """Return the SVG text of the sketch name (or its PNG rendition
+        if png is True, as bytes)"""
+        with self.open(name + (".png" if png else ".svg")) as member:
+            data = member.read()
+        return data if png else data.decode("utf-8")
+
+    def load(self, name):
+        """Return a sketcher with the elements of the sketch name (see
+        svgsketcher.loadSVG)"""
+        with self.open(name + ".svg") as member:
+            return loadSVG(member)
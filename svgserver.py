@@ -0,0 +1,298 @@
+# coding: utf-8
+
+"""
+A local HTTP server (asyncio, standard library only) that shows live
+sketches in a web browser. The sketchers (or telecrans) are registered
+with a name, and the drawings can continue in other threads while the
+server runs (see SvgServer.start):
+
+    server = SvgServer(port=8000).start()
+    t = Telecran()
+    server.register("telecran", t)
+    ... # draw with t, and look at http://127.0.0.1:8000/
+
+The server answers to the requests:
+
+- /: a dashboard page that shows all the registered sketches
+- /sketches: the names of the registered sketches (JSON list)
+- /svg/<name>: the current SVG text of a sketch
+- /events/<name>: the updates of a sketch as server-sent events (SSE)
+
+The updates of a sketch are computed for each client from the elements
+of the visible layers of the sketcher (see SketchCursor), at most every
+interval seconds. The drawing is never blocked by the clients: a slow
+client is not sent anything until it has read the previous updates
+(backpressure), and all the elements drawn in the meantime are sent at
+once (coalescing).
+"""
+
+__author__ = "gboulant, nov. 2022"
+
+import json
+import html
+import asyncio
+import threading
+import itertools
+from urllib.parse import unquote
+
+from svgsketcher import headPattern, backgroundPattern, footPattern
+from svgsketcher import formatElement, DENSITY, ConcurrentElements
+
+def appendedLists(sketcher):
+    """Return the lists of elements of the visible layers of the sketcher,
+    split so that the elements are only appended at the end of each list
+    (or the last one replaced), and the signature of the lists that are
+    not (whose change requires a reset). The elements of a concurrent
+    sketcher (see ConcurrentElements) are given by thread if merged in
+    thread order, and else as a whole, with the length and the last
+    element of the lists of the threads as signature."""
+    lists, signature = [], []
+    for elements in sketcher.visibleElementLists():
+        if not isinstance(elements, ConcurrentElements):
+            lists.append(elements)
+        elif elements.order == "thread":
+            lists.extend(elements.threadLists())
+        else:
+            lists.append(elements)
+            signature.append(tuple((len(buffer), buffer[-1] if buffer else None)
+                                   for buffer in elements.threadLists()))
+    return lists, signature
+
+class SketchCursor:
+    """The part of the sketch known by a client, i.e. for each list of
+    elements of the visible layers (see appendedLists), the number of
+    elements sent and the last one, that is used to compute the update
+    of the client (see update). The elements are only read, so that the
+    sketcher can be used in another thread."""
+    __slots__ = ("sketcher", "lists", "counts", "lasts", "header", "signature")
+
+    def __init__(self, sketcher):
+        self.sketcher = sketcher
+        self.lists = None # nothing sent yet
+
+    def update(self):
+        """Return the event (name, data) that brings the client up to
+        date, or None if the sketch did not change since the previous
+        update. The events are:
+
+        - reset: the whole SVG text of the sketch
+        - append: the SVG text of the new elements
+        - replace: the SVG text of the new elements, the first one
+          replacing the last element sent (see coalesceLines)
+
+        Only the elements of the last list (the top visible layer, or
+        the last thread of a concurrent sketcher) can be appended (or
+        replaced): any other change is sent as a reset.
+        """
+        sketcher = self.sketcher
+        lists, signature = appendedLists(sketcher)
+        header = (sketcher.cnvwidth, sketcher.cnvheight, sketcher.backgroundColor)
+        counts = [len(elements) for elements in lists]
+        if (self.lists is None or header != self.header or signature != self.signature
+            or len(lists) != len(self.lists)
+            or any(elements is not sent for elements, sent in zip(lists, self.lists))):
+            return self._reset(lists, counts, header, signature)
+        for elements, count, sentCount, last in zip(lists[:-1], counts, self.counts, self.lasts):
+            if count != sentCount or (count > 0 and elements[count-1] != last):
+                return self._reset(lists, counts, header, signature)
+        if not lists: return None
+        elements, count = lists[-1], counts[-1]
+        start = self.counts[-1]
+        if count < start: return self._reset(lists, counts, header, signature)
+        if start > 0:
+            last = elements[start-1]
+            if last != self.lasts[-1]:
+                if last[0] == DENSITY or self.lasts[-1][0] == DENSITY:
+                    return self._reset(lists, counts, header, signature)
+                start -= 1
+        if start == count: return None
+        event = "append" if start == self.counts[-1] else "replace"
+        fragments = [formatElement(element) for element in itertools.islice(elements, start, count)]
+        self.counts[-1] = count
+        self.lasts[-1] = elements[count-1]
+        return event, "\n".join(fragments)
+
+    def _reset(self, lists, counts, header, signature):
+        cnvwidth, cnvheight, backgroundColor = header
+        fragments = [headPattern % (cnvwidth, cnvheight)]
+        if backgroundColor is not None:
+            fragments.append(backgroundPattern % backgroundColor)
+        for elements, count in zip(lists, counts):
+            fragments.extend(formatElement(element) for element in itertools.islice(elements, count))
+        fragments.append(footPattern)
+        self.lists = lists
+        self.counts = counts
+        self.lasts = [elements[count-1] if count > 0 else None for elements, count in zip(lists, counts)]
+        self.header = header
+        self.signature = signature
+        return "reset", "\n".join(fragments)
+
+def sseEvent(event, data):
+    """Return the text of a server-sent event (one data line per line)"""
+    lines = ["event: %s"%event]
+    lines.extend("data: %s"%line for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+async def readUntilEOF(reader):
+    """Read (and ignore) the input of a client until its end, i.e. until
+    the client is disconnected"""
+    try:
+        while await reader.read(4096): pass
+    except ConnectionError:
+        pass
+
+dashboardPattern = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Sketches</title>
+<style>
+body { font-family: sans-serif; display: flex; flex-wrap: wrap; }
+figure { border: 1px solid lightgray; margin: 4px; }
+</style>
+</head>
+<body>
+%s
+<script>
+function follow(figure) {
+  var sketch = figure.querySelector("div");
+  var source = new EventSource("/events/" + encodeURIComponent(figure.dataset.name));
+  function add(data, replace) {
+    var svg = sketch.querySelector("svg");
+    if (replace && svg.lastElementChild) svg.lastElementChild.remove();
+    svg.insertAdjacentHTML("beforeend", data);
+  }
+  source.addEventListener("reset", function(e) { sketch.innerHTML = e.data; });
+  source.addEventListener("append", function(e) { add(e.data, false); });
+  source.addEventListener("replace", function(e) { add(e.data, true); });
+  source.addEventListener("close", function(e) { source.close(); });
+}
+document.querySelectorAll("figure").forEach(follow);
+</script>
+</body>
+</html>
+"""
+figurePattern = "<figure data-name='%s'><figcaption>%s</figcaption><div></div></figure>"
+
+class SvgServer:
+    interval = 0.1         # min time (seconds) between two updates of a client
+    writeBufferSize = 65536 # bytes written to a client before waiting for it
+
+    def __init__(self, host="127.0.0.1", port=8000):
+        self.host = host
+        self.port = port # the actual port once started if 0
+        self.sketchers = {}
+        self.clients = 0 # number of clients following a sketch (events)
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._stopped = None
+
+    def register(self, name, sketcher):
+        """Register the sketcher (or any object with a sketcher
+        attribute, e.g. a Telecran) under the name"""
+        self.sketchers[name] = getattr(sketcher, "sketcher", sketcher)
+        return self
+
+    def unregister(self, name):
+        """Remove the sketch (its clients are sent a close event)"""
+        del self.sketchers[name]
+
+    @property
+    def url(self):
+        return "http://%s:%d/"%(self.host, self.port)
+
+    # ---------------------------------------------------------
+    # Execution of the server
+    async def serve(self):
+        """Run the server until stop is called"""
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        async with self._server:
+            await self._stopped.wait()
+
+    def start(self):
+        """Run the server in a background thread, and return when the
+        server is ready (e.g. to know the port if 0 was given)"""
+        ready = threading.Event()
+        async def serve():
+            task = asyncio.ensure_future(self.serve())
+            while self._server is None and not task.done(): await asyncio.sleep(0.01)
+            ready.set()
+            await task
+        self._thread = threading.Thread(target=asyncio.run, args=(serve(),), daemon=True)
+        self._thread.start()
+        ready.wait()
+        if self._server is None:
+            self._thread.join()
+            raise OSError("The server can't listen on %s:%s"%(self.host, self.port))
+        return self
+
+    def stop(self):
+        """Stop the server (and wait for the thread if started)"""
+        if self._loop is None: return
+        self._loop.call_soon_threadsafe(self._stopped.set)
+        if self._thread is not None: self._thread.join()
+        self._loop = self._server = self._thread = None
+
+    # ---------------------------------------------------------
+    # Processing of the requests
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip(): pass # headers ignored
+            parts = request.decode("latin-1").split()
+            path = unquote(parts[1]) if len(parts) > 1 else ""
+            if path == "/":
+                figures = [figurePattern%(html.escape(name, True), html.escape(name))
+                           for name in self.sketchers]
+                self._respond(writer, "text/html", dashboardPattern%"\n".join(figures))
+            elif path == "/sketches":
+                self._respond(writer, "application/json", json.dumps(list(self.sketchers)))
+            elif path.startswith("/svg/") and path[5:] in self.sketchers:
+                self._respond(writer, "image/svg+xml", self.sketchers[path[5:]].toSVG(False))
+            elif path.startswith("/events/") and path[8:] in self.sketchers:
+                await self._stream(reader, writer, path[8:])
+            else:
+                self._respond(writer, "text/plain", "Not found", "404 Not Found")
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _respond(self, writer, contentType, text, status="200 OK"):
+        data = text.encode("utf-8")
+        writer.write(("HTTP/1.1 %s\r\nContent-Type: %s; charset=utf-8\r\n"
+                      "Content-Length: %d\r\nConnection: close\r\n\r\n"%(
+                          status, contentType, len(data))).encode("latin-1"))
+        writer.write(data)
+
+    async def _stream(self, reader, writer, name):
+        writer.transport.set_write_buffer_limits(high=SvgServer.writeBufferSize)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                     b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n")
+        sketcher = self.sketchers[name]
+        cursor = SketchCursor(sketcher)
+        # the client sends nothing more: the end of its input means that
+        # it is gone (noticed even if the sketch does not change)
+        disconnected = asyncio.ensure_future(readUntilEOF(reader))
+        stopped = asyncio.ensure_future(self._stopped.wait())
+        self.clients += 1
+        try:
+            while not stopped.done() and not disconnected.done() and not writer.is_closing():
+                if self.sketchers.get(name) is not sketcher:
+                    writer.write(sseEvent("close", name).encode("utf-8"))
+                    break
+                update = cursor.update()
+                if update is not None:
+                    writer.write(sseEvent(*update).encode("utf-8"))
+                    # wait for the client to read (backpressure)
+                    await writer.drain()
+                await asyncio.wait((disconnected, stopped), timeout=SvgServer.interval)
+        finally:
+            self.clients -= 1
+            disconnected.cancel()
+            stopped.cancel()
@@ -3,19 +3,58 @@
 __author__ = "gboulant, nov. 2022"
 
 import os
-import copy
 import math
-import tempfile
+import time
+import zlib
+import weakref
+import heapq
+import array
+import bisect
+import threading
+import itertools
 
 import environ
 
+# Note that re, pickle, tempfile, base64 and struct, only used for some
+# features, are imported when needed to speed up the import of this module
+
 headPattern = "<svg xmlns='http://www.w3.org/2000/svg' width='%d' height='%d'>"
+scaledHeadPattern = "<svg xmlns='http://www.w3.org/2000/svg' width='%d' height='%d' viewBox='0 0 %.2f %.2f'>"
+backgroundPattern = "<rect width='100%%' height='100%%' fill='%s'/>"
 linePattern = "<line x1='%.2f' y1='%.2f' x2='%.2f' y2='%.2f' style='%s'/>"
 textPattern = "<text x='%.2f' y='%.2f' style='%s'>%s</text>"
 rectPattern = "<rect x='%.2f' y='%.2f' width='%.2f' height='%.2f' style='%s'/>"
 circPattern = "<circle cx='%.2f' cy='%.2f' r='%.2f' style='%s'/>"
+ellipsePattern = "<ellipse cx='%.2f' cy='%.2f' rx='%.2f' ry='%.2f' style='%s'/>"
+pathPattern = "<path d='%s' style='%s'/>"
 footPattern = "</svg>"
 
+# Patterns of the elements when the style is given by the enclosing group
+groupPattern = "<g style='%s'>"
+groupEndPattern = "</g>"
+lineBarePattern = "<line x1='%.2f' y1='%.2f' x2='%.2f' y2='%.2f'/>"
+textBarePattern = "<text x='%.2f' y='%.2f'>%s</text>"
+rectBarePattern = "<rect x='%.2f' y='%.2f' width='%.2f' height='%.2f'/>"
+circBarePattern = "<circle cx='%.2f' cy='%.2f' r='%.2f'/>"
+ellipseBarePattern = "<ellipse cx='%.2f' cy='%.2f' rx='%.2f' ry='%.2f'/>"
+pathBarePattern = "<path d='%s'/>"
+
+# Patterns of the path data commands (see SvgSketcher.arcTo)
+pathCommandPatterns = {
+    "M": "M%.2f %.2f",
+    "L": "L%.2f %.2f",
+    "Q": "Q%.2f %.2f %.2f %.2f",
+    "C": "C%.2f %.2f %.2f %.2f %.2f %.2f",
+    "A": "A%.2f %.2f %g %d %d %.2f %.2f",
+    "Z": "Z",
+}
+
+# A density layer is a rectangle filled with the style color, through a
+# mask given by a grayscale image (see SvgSketcher.densityCloud)
+densityMaskPattern = "<mask id='%s'><image x='%.2f' y='%.2f' width='%.2f' height='%.2f' preserveAspectRatio='none' image-rendering='optimizeSpeed' href='%s'/></mask>"
+densityPattern = "<rect x='%.2f' y='%.2f' width='%.2f' height='%.2f' mask='url(#%s)' style='%s'/>"
+densityBarePattern = "<rect x='%.2f' y='%.2f' width='%.2f' height='%.2f' mask='url(#%s)'/>"
+
 class SvgException(Exception): pass
 def assertIsInstance(value, expectedType):
     if not isinstance(value, expectedType):
@@ -28,6 +67,122 @@ def cssvalue(data):
     if data is None: return "none"
     return data
 
+class SvgPencilState:
+    """A pencil state is an immutable snapshot of the pencil parameters
+    (see SvgPencil). The states are interned, i.e. two pencils with the
+    same parameters share the very same state object, so that the
+    identity of a state can be used to compare (or group) the styles of
+    the sketched elements.
+
+    A state can be derived into a variant (e.g. the same state with no
+    border, or with another fill color). The variants are cached by the
+    state itself, so that once created, getting a variant costs a
+    dictionary lookup and no allocation.
+
+    The interned states and the variants are weakly referenced: a state
+    is released as soon as no element or pencil uses it.
+    """
+    __slots__ = ("lineColor", "lineWidth", "fillColor",
+                 "fontFamily", "fontSize", "fontWeight", "fontColor",
+                 "forcedStyle", "fillOpacity",
+                 "_key", "_drawStyle", "_textStyle", "_variants", "__weakref__")
+
+    fields = ("lineColor", "lineWidth", "fillColor",
+              "fontFamily", "fontSize", "fontWeight", "fontColor",
+              "forcedStyle", "fillOpacity")
+
+    _interned = weakref.WeakValueDictionary()
+    _internLock = threading.Lock() # creation of the states (see intern)
+
+    @staticmethod
+    def intern(lineColor, lineWidth, fillColor,
+               fontFamily, fontSize, fontWeight, fontColor,
+               forcedStyle=None, fillOpacity=None):
+        """Return the unique state for the specified parameters values
+        (thread safe: the states are created under a lock, so that two
+        threads never get two different states for the same values)"""
+        key = (lineColor, lineWidth, fillColor,
+               fontFamily, fontSize, fontWeight, fontColor,
+               forcedStyle, fillOpacity)
+        state = SvgPencilState._interned.get(key)
+        if state is not None: return state
+        with SvgPencilState._internLock:
+            state = SvgPencilState._interned.get(key)
+            if state is not None: return state
+            state = object.__new__(SvgPencilState)
+            init = object.__setattr__
+            for name, value in zip(SvgPencilState.fields, key):
+                init(state, name, value)
+            init(state, "_key", key)
+            init(state, "_variants", weakref.WeakValueDictionary())
+            if forcedStyle is not None:
+                init(state, "_drawStyle", forcedStyle)
+                init(state, "_textStyle", forcedStyle)
+            else:
+                drawStyle = SvgPencil.drawStylePattern%(
+                    cssvalue(lineColor),
+                    cssvalue(lineWidth),
+                    cssvalue(fillColor))
+                if fillOpacity is not None:
+                    drawStyle += SvgPencil.opacityStylePattern%fillOpacity
+                init(state, "_drawStyle", drawStyle)
+                init(state, "_textStyle", SvgPencil.textStylePattern%(
+                    cssvalue(fontFamily),
+                    cssvalue(fontSize),
+                    cssvalue(fontWeight),
+                    cssvalue(fontColor)))
+            SvgPencilState._interned[key] = state
+        return state
+
+    def __setattr__(self, name, value):
+        raise SvgException("A pencil state is immutable")
+
+    def __reduce__(self):
+        # Unpickled states are interned again (identity is preserved
+        # in the process where they are loaded)
+        return (SvgPencilState.intern, self._key)
+
+    def drawStyle(self):
+        return self._drawStyle
+
+    def textStyle(self):
+        return self._textStyle
+
+    def variant(self, name, value):
+        """Return the state equal to this one, except for the parameter
+        name whose value is replaced by value."""
+        override = (name, value)
+        state = self._variants.get(override)
+        if state is None:
+            index = SvgPencilState.fields.index(name)
+            key = self._key[:index] + (value,) + self._key[index+1:]
+            state = SvgPencilState.intern(*key)
+            # a concurrent thread can only store the same (interned) state
+            self._variants[override] = state
+        return state
+
+    def withFill(self, color):
+        return self.variant("fillColor", color)
+
+    def withoutFill(self):
+        return self.variant("fillColor", None)
+
+    def withoutBorder(self):
+        return self.variant("lineColor", None)
+
+    def withFontColor(self, color):
+        return self.variant("fontColor", color)
+
+    def withFontSize(self, size):
+        return self.variant("fontSize", size)
+
+    def withFillOpacity(self, opacity):
+        return self.variant("fillOpacity", opacity)
+
+    def __repr__(self):
+        return "SvgPencilState(%s)"%self._drawStyle
+
+
 class SvgPencil:
     """The pencil is the tool used by the sketcher for the graphical
     rendering of the sketching. The sketcher defines only the geometry
@@ -38,7 +193,15 @@ class SvgPencil:
     composing a SVG sketch you can prepare a set of pencils and choose
     (associate to the skecther) the pencil of your choice depending on
     the expected rendering for the current drawing.
+
+    The parameters of the pencil can be modified at any time. The
+    sketcher uses the current state of the pencil (see SvgPencilState),
+    that is computed once and kept until a parameter is modified.
     """
+    __slots__ = ("lineColor", "lineWidth", "fillColor", "fillOpacity",
+                 "fontFamily", "fontSize", "fontWeight", "fontColor",
+                 "_style", "_state")
+
     defaultLineWidth = 2
     defaultLineColor = "black"
     defaultFontFamily = "Cursive"
@@ -47,48 +210,77 @@ class SvgPencil:
     
     drawStylePattern = "stroke: %s; stroke-width: %d; fill: %s"
     textStylePattern = "font-family:%s; font-size:%s; font-weight:%s; fill: %s"
+    opacityStylePattern = "; fill-opacity: %.3g" # only when fillOpacity is set
 
     def __init__(self):
         self.lineColor   = SvgPencil.defaultLineColor
         self.lineWidth   = SvgPencil.defaultLineWidth
         self.fillColor   = self.lineColor
+        self.fillOpacity = None # opaque
         self.fontFamily  = SvgPencil.defaultFontFamily
         self.fontSize    = SvgPencil.defaultFontSize
         self.fontWeight  = SvgPencil.defaultFontWeight
         self.fontColor   = self.lineColor
         self._style =  None
 
+    def __setattr__(self, name, value):
+        # Any modification of a parameter invalidates the current state
+        object.__setattr__(self, name, value)
+        object.__setattr__(self, "_state", None)
+
+    _model = None # (defaults, pencil) model of the new pencils (see new)
+
+    @staticmethod
+    def new():
+        """Return a new pencil with the default parameters. The pencil is
+        a copy of a model pencil, created once and whose state is already
+        computed, which is faster than a creation from scratch."""
+        defaults = (SvgPencil.defaultLineColor, SvgPencil.defaultLineWidth,
+                    SvgPencil.defaultFontFamily, SvgPencil.defaultFontSize,
+                    SvgPencil.defaultFontWeight)
+        model = SvgPencil._model
+        if model is None or model[0] != defaults:
+            pencil = SvgPencil()
+            pencil.state()
+            model = SvgPencil._model = (defaults, pencil)
+        return model[1].clone()
+
     def forceStyle(self, style):
         self._style =  style
 
     def resetStyle(self):
         self._style = None
 
+    def state(self):
+        """Return the current state of the pencil (see SvgPencilState)"""
+        state = self._state
+        if state is None:
+            state = SvgPencilState.intern(
+                self.lineColor, self.lineWidth, self.fillColor,
+                self.fontFamily, self.fontSize, self.fontWeight, self.fontColor,
+                self._style, self.fillOpacity)
+            object.__setattr__(self, "_state", state)
+        return state
+
     def drawStyle(self):
         """Return the style value (css string) for drawing. The style string is
         created from the values of the pencil drawing parameters. If forceStyle
         is used, then the given value for style is considered instead (whatever
         the value of the pencil parameters are)"""
-        if self._style is not None: return self._style
-        return SvgPencil.drawStylePattern%(
-            cssvalue(self.lineColor),
-            cssvalue(self.lineWidth),
-            cssvalue(self.fillColor))
+        return self.state().drawStyle()
 
     def textStyle(self):
         """Return the style value (css string) for writing texts. The style
         string is created from the values of the pencil font parameters. If
         forceStyle is used, then the given value for style is considered instead
         (whatever the value of the pencil parameters are)"""
-        if self._style is not None: return self._style
-        return SvgPencil.textStylePattern%(
-            cssvalue(self.fontFamily),
-            cssvalue(self.fontSize),
-            cssvalue(self.fontWeight),
-            cssvalue(self.fontColor))
+        return self.state().textStyle()
 
     def clone(self):
-        return copy.copy(self)
+        pencil = SvgPencil.__new__(SvgPencil)
+        for name in SvgPencil.__slots__:
+            object.__setattr__(pencil, name, getattr(self, name))
+        return pencil
 
     def __repr__(self):
         s = "lineColor : %s\n"%cssvalue(self.lineColor)
@@ -134,6 +326,8 @@ class CoordinatesSystem:
     user coordinates x, y in pixel native coordinates hcoord, vcoord for
     the placement of the element on the SVG canvas.
     """
+    __slots__ = ("Ohcoord", "Ovcoord", "xyunit", "xinverse", "yinverse",
+                 "underlying_cnvwidth", "underlying_cnvheight")
 
     def __init__(self, Ohcoord=0, Ovcoord=0, xyunit=1, xinverse=False, yinverse=False):
         self.Ohcoord = Ohcoord    # horizontal distance from left (pixels)
@@ -256,6 +450,658 @@ class CoordinatesSystem:
         csys = CoordinatesSystem(Ohcoord, Ovcoord, xyunit=xyunit)
         return csys
 
+# =======================================================================
+# The sketched elements (see docstring)
+#
+# The sketcher records the drawing as a list of elements, each element
+# being a tuple (kind, state, *geometry) where state is the pencil state
+# (see SvgPencilState) and the geometry is given in the canvas native
+# coordinates system (pixels):
+#
+#   (LINE,   state, x1, y1, x2, y2)
+#   (CIRCLE, state, cx, cy, r)
+#   (RECT,   state, x, y, width, height)
+#   (TEXT,   state, x, y, value)
+#   (DENSITY, state, x, y, width, height, maskid, href)
+#   (ELLIPSE, state, cx, cy, rx, ry)
+#   (PATH,   state, commands)
+#
+# The commands of a path are tuples (op, *coordinates) where op is one
+# of the SVG path commands M, L, Q, C, A or Z, with absolute canvas
+# coordinates (see pathCommandPatterns).
+#
+# The SVG text is created from this list only when requested (see
+# SvgSketcher.toSVG).
+
+LINE   = "line"
+CIRCLE = "circle"
+RECT   = "rect"
+TEXT   = "text"
+DENSITY = "density"
+ELLIPSE = "ellipse"
+PATH   = "path"
+
+densityMaskIds = itertools.count()
+
+def elementStyle(element):
+    """Return the style value (css string) of the element"""
+    if element[0] == TEXT: return element[1].textStyle()
+    return element[1].drawStyle()
+
+def escapeText(value):
+    """Return the text value (any object) with the XML special characters
+    escaped, as written in the content of a text element"""
+    return str(value).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def formatElement(element, style=None):
+    """Return the SVG text of the element. If style is False, the style
+    attribute is omitted (the style is then given by an enclosing
+    group). If style is None, the style of the element is used."""
+    kind = element[0]
+    if style is False:
+        if kind == LINE: return lineBarePattern % element[2:]
+        if kind == CIRCLE: return circBarePattern % element[2:]
+        if kind == RECT: return rectBarePattern % element[2:]
+        if kind == TEXT: return textBarePattern % (element[2], element[3], escapeText(element[4]))
+        if kind == DENSITY: return formatDensity(element, None)
+        if kind == ELLIPSE: return ellipseBarePattern % element[2:]
+        if kind == PATH: return pathBarePattern % pathData(element[2])
+    else:
+        if style is None: style = elementStyle(element)
+        if kind == LINE: return linePattern % (element[2:] + (style,))
+        if kind == CIRCLE: return circPattern % (element[2:] + (style,))
+        if kind == RECT: return rectPattern % (element[2:] + (style,))
+        if kind == TEXT: return textPattern % (element[2], element[3], style, escapeText(element[4]))
+        if kind == DENSITY: return formatDensity(element, style)
+        if kind == ELLIPSE: return ellipsePattern % (element[2:] + (style,))
+        if kind == PATH: return pathPattern % (pathData(element[2]), style)
+    raise SvgException("Unknown element kind %s"%kind)
+
+def iterElements(elements, grouped):
+    """Generate the SVG text of the elements, piece by piece. If grouped
+    is True, the elements of same style are gathered in groups (see
+    groupElements)."""
+    if not grouped:
+        for element in elements:
+            yield formatElement(element) + "\n"
+        return
+    for style, group in groupElements(elements, SvgSketcher.groupSearchWindow):
+        if len(group) == 1:
+            yield formatElement(group[0], style) + "\n"
+            continue
+        yield groupPattern % style + "\n"
+        for element in group:
+            yield formatElement(element, False) + "\n"
+        yield groupEndPattern + "\n"
+
+def pathData(commands):
+    """Return the SVG path data (attribute d) of the path commands"""
+    return " ".join([pathCommandPatterns[command[0]] % command[1:] for command in commands])
+
+def formatDensity(element, style):
+    _, _, x, y, w, h, maskid, href = element
+    s = densityMaskPattern % (maskid, x, y, w, h, href)
+    if style is None: return s + densityBarePattern % (x, y, w, h, maskid)
+    return s + densityPattern % (x, y, w, h, maskid, style)
+
+def elementBox(element):
+    """Return the bounding box (hmin, vmin, hmax, vmax) of the element
+    in canvas coordinates, including the width of the border. The box
+    is unbounded when the extent of the element can't be known without
+    a rendering (texts, forced styles)."""
+    kind, state = element[0], element[1]
+    if kind == TEXT or state.forcedStyle is not None:
+        return (-math.inf, -math.inf, math.inf, math.inf)
+    m = 0.
+    if state.lineColor is not None and state.lineWidth is not None:
+        m = 0.5 * state.lineWidth
+    if kind == LINE:
+        _, _, x1, y1, x2, y2 = element
+        if x1 > x2: x1, x2 = x2, x1
+        if y1 > y2: y1, y2 = y2, y1
+        return (x1-m, y1-m, x2+m, y2+m)
+    if kind == CIRCLE:
+        _, _, cx, cy, r = element
+        return (cx-r-m, cy-r-m, cx+r+m, cy+r+m)
+    if kind == RECT or kind == DENSITY:
+        x, y, w, h = element[2:6]
+        return (x-m, y-m, x+w+m, y+h+m)
+    if kind == ELLIPSE:
+        _, _, cx, cy, rx, ry = element
+        return (cx-rx-m, cy-ry-m, cx+rx+m, cy+ry+m)
+    if kind == PATH:
+        points = [p for polyline in flattenPath(element[2]) for p in polyline]
+        if not points: return (math.inf, math.inf, -math.inf, -math.inf)
+        hcoords = [p[0] for p in points]
+        vcoords = [p[1] for p in points]
+        return (min(hcoords)-m, min(vcoords)-m, max(hcoords)+m, max(vcoords)+m)
+    raise SvgException("Unknown element kind %s"%kind)
+
+# -----------------------------------------------------------------------
+# Flattening of the paths, i.e. approximation of the curves by polylines,
+# for the backends that can only draw straight lines. The number of
+# points is adapted so that the distance between the curve and the
+# polyline is less than a tolerance (in pixels).
+
+def flattenPath(commands, tolerance=0.5):
+    """Return the list of polylines (lists of (h,v) canvas points) that
+    approximate the path commands (see PATH) within the tolerance"""
+    polylines = []
+    points = None
+    for command in commands:
+        op = command[0]
+        if op == "M":
+            points = [command[1:3]]
+            polylines.append(points)
+            continue
+        if points is None: raise SvgException("A path must start with M")
+        p0 = points[-1]
+        if op == "L":
+            points.append(command[1:3])
+        elif op == "Q":
+            # elevation of the quadratic curve to a cubic curve
+            q1, p3 = command[1:3], command[3:5]
+            p1 = (p0[0] + 2./3*(q1[0]-p0[0]), p0[1] + 2./3*(q1[1]-p0[1]))
+            p2 = (p3[0] + 2./3*(q1[0]-p3[0]), p3[1] + 2./3*(q1[1]-p3[1]))
+            flattenCubic(p0, p1, p2, p3, tolerance, points)
+        elif op == "C":
+            flattenCubic(p0, command[1:3], command[3:5], command[5:7], tolerance, points)
+        elif op == "A":
+            flattenArc(p0, command[1], command[2], command[3], command[4], command[5], command[6:8],
+                       tolerance, points)
+        elif op == "Z":
+            points.append(points[0])
+        else:
+            raise SvgException("Unknown path command %s"%op)
+    return polylines
+
+def _distanceToChord(p, a, b):
+    dx, dy = b[0]-a[0], b[1]-a[1]
+    length = math.hypot(dx, dy)
+    if length == 0: return math.hypot(p[0]-a[0], p[1]-a[1])
+    return abs((p[0]-a[0])*dy - (p[1]-a[1])*dx) / length
+
+def flattenCubic(p0, p1, p2, p3, tolerance, points, depth=0):
+    """Append to points the polyline approximating the cubic Bézier
+    curve (p0, p1, p2, p3), p0 excluded (recursive subdivision until the
+    control points are close enough to the chord)"""
+    if depth >= 16 or (_distanceToChord(p1, p0, p3) <= tolerance and
+                       _distanceToChord(p2, p0, p3) <= tolerance):
+        points.append(p3)
+        return
+    # de Casteljau subdivision at t=0.5
+    mid = lambda a, b: (0.5*(a[0]+b[0]), 0.5*(a[1]+b[1]))
+    p01, p12, p23 = mid(p0, p1), mid(p1, p2), mid(p2, p3)
+    p012, p123 = mid(p01, p12), mid(p12, p23)
+    p0123 = mid(p012, p123)
+    flattenCubic(p0, p01, p012, p0123, tolerance, points, depth+1)
+    flattenCubic(p0123, p123, p23, p3, tolerance, points, depth+1)
+
+def flattenArc(p0, rx, ry, rotation, large, sweep, p1, tolerance, points):
+    """Append to points the polyline approximating the SVG elliptical
+    arc (axis rotated by rotation degrees) from p0 to p1, p0 excluded.
+    The center parameterization is computed as specified by the SVG
+    standard (implementation notes, section F.6.5)."""
+    rx, ry = abs(rx), abs(ry)
+    dx, dy = 0.5*(p0[0]-p1[0]), 0.5*(p0[1]-p1[1])
+    if rx == 0 or ry == 0 or (dx == 0 and dy == 0):
+        points.append(p1)
+        return
+    cosphi = math.cos(math.radians(rotation))
+    sinphi = math.sin(math.radians(rotation))
+    hx, hy = cosphi*dx + sinphi*dy, -sinphi*dx + cosphi*dy
+    scale = (hx/rx)**2 + (hy/ry)**2
+    if scale > 1:
+        rx *= math.sqrt(scale)
+        ry *= math.sqrt(scale)
+    num = (rx*ry)**2 - (rx*hy)**2 - (ry*hx)**2
+    den = (rx*hy)**2 + (ry*hx)**2
+    coef = math.sqrt(max(0., num/den))
+    if bool(large) == bool(sweep): coef = -coef
+    chx, chy = coef*rx*hy/ry, -coef*ry*hx/rx
+    cx = cosphi*chx - sinphi*chy + 0.5*(p0[0]+p1[0])
+    cy = sinphi*chx + cosphi*chy + 0.5*(p0[1]+p1[1])
+    theta = math.atan2((hy-chy)/ry, (hx-chx)/rx)
+    dtheta = math.atan2((-hy-chy)/ry, (-hx-chx)/rx) - theta
+    if sweep and dtheta < 0: dtheta += 2*math.pi
+    if not sweep and dtheta > 0: dtheta -= 2*math.pi
+
+    # Max angle step for a chord whose sagitta is less than the tolerance
+    r = max(rx, ry)
+    step = 2*math.acos(max(-1., 1.-float(tolerance)/r)) if tolerance < r else math.pi
+    n = max(1, int(math.ceil(abs(dtheta)/step)))
+    for i in range(1, n):
+        angle = theta + dtheta*i/n
+        ex, ey = rx*math.cos(angle), ry*math.sin(angle)
+        points.append((cx + cosphi*ex - sinphi*ey, cy + sinphi*ex + cosphi*ey))
+    points.append(p1)
+
+def niceStep(vmin, vmax, count=10):
+    """Return the step of the form 1, 2 or 5 times a power of ten that
+    splits the range [vmin, vmax] in about count intervals"""
+    span = float(vmax - vmin)
+    if span <= 0: return 1.
+    raw = span / count
+    magnitude = 10 ** math.floor(math.log10(raw))
+    for factor in (1, 2, 5):
+        if factor * magnitude >= raw: return factor * magnitude
+    return 10 * magnitude
+
+def niceTicks(vmin, vmax, step):
+    """Return the multiples of step in the range [vmin, vmax]"""
+    first = int(math.ceil(vmin / step))
+    last = int(math.floor(vmax / step))
+    return [i * step for i in range(first, last + 1)]
+
+def formatTick(value, step):
+    """Return the label of a tick value, with the number of decimals
+    needed by the step"""
+    decimals = max(0, -int(math.floor(math.log10(step))))
+    return "%.*f" % (decimals, value)
+
+def _distanceToSegment(p, a, b):
+    dx, dy = b[0]-a[0], b[1]-a[1]
+    length2 = dx*dx + dy*dy
+    t = 0. if length2 == 0 else ((p[0]-a[0])*dx + (p[1]-a[1])*dy) / length2
+    t = min(max(t, 0.), 1.)
+    return math.hypot(p[0]-a[0]-t*dx, p[1]-a[1]-t*dy)
+
+def simplifyPolyline(points, tolerance):
+    """Return the points of the polyline needed to approximate it within
+    the tolerance (Ramer-Douglas-Peucker algorithm)"""
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points)-1)]
+    while stack:
+        first, last = stack.pop()
+        farthest, distance = None, tolerance
+        for i in range(first+1, last):
+            d = _distanceToChord(points[i], points[first], points[last])
+            if d > distance: farthest, distance = i, d
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [p for p, k in zip(points, keep) if k]
+
+def boxesOverlap(box1, box2):
+    return not (box1[2] < box2[0] or box2[2] < box1[0] or
+                box1[3] < box2[1] or box2[3] < box1[1])
+
+def groupElements(elements, window=32):
+    """Gather the elements in groups of identical style, and return the
+    list of groups as (style, elements) tuples. The consecutive elements
+    of same style are gathered in a same group. An element can also be
+    moved back into a previous group of same style, but only if it does
+    not overlap any of the groups in between (checked using the bounding
+    boxes), so that the z-order of the rendering is unchanged. The
+    search for a previous group is limited to the window last groups."""
+    groups = [] # list of [style, elements, box]
+    for element in elements:
+        style = elementStyle(element)
+        box = None
+        target = None
+        for i in range(len(groups)-1, max(-1, len(groups)-1-window), -1):
+            group = groups[i]
+            if group[0] == style:
+                target = group
+                break
+            if box is None: box = elementBox(element)
+            if boxesOverlap(group[2], box): break
+        if target is None:
+            if box is None: box = elementBox(element)
+            groups.append([style, [element], box])
+            continue
+        target[1].append(element)
+        gbox = target[2]
+        if box is None: box = elementBox(element)
+        target[2] = (min(gbox[0], box[0]), min(gbox[1], box[1]),
+                     max(gbox[2], box[2]), max(gbox[3], box[3]))
+    return [(group[0], group[1]) for group in groups]
+
+def elementKey(element, quantum=0.01):
+    """Return a hashable key of the element, equal for two elements
+    with the same style and the same geometry, up to the quantum (canvas
+    coordinates rounded to the quantum, and lines in both directions)."""
+    kind, state = element[0], element[1]
+    q = lambda value: round(value / quantum)
+    if kind == LINE:
+        p1, p2 = (q(element[2]), q(element[3])), (q(element[4]), q(element[5]))
+        return (kind, state, min(p1, p2), max(p1, p2))
+    if kind == TEXT:
+        return (kind, state, q(element[2]), q(element[3]), element[4])
+    if kind == PATH:
+        return (kind, state, tuple((c[0],) + tuple(map(q, c[1:])) for c in element[2]))
+    if kind == DENSITY:
+        return (kind, state) + tuple(map(q, element[2:6])) + (element[7],)
+    return (kind, state) + tuple(map(q, element[2:]))
+
+class PaintOrder:
+    """The indices and bounding boxes of a sequence of elements, by
+    style (in compact arrays), to know if an element can be drawn
+    earlier without changing the rendering (see paintedBetween). The
+    elements are added in the order of their indices."""
+    __slots__ = ("styles",)
+
+    def __init__(self):
+        self.styles = {} # (indices, boxes) by style
+
+    def add(self, index, element):
+        style = elementStyle(element)
+        arrays = self.styles.get(style)
+        if arrays is None:
+            arrays = self.styles[style] = (array.array("q"), array.array("d"))
+        arrays[0].append(index)
+        arrays[1].extend(elementBox(element))
+
+    def paintedBetween(self, first, last, element):
+        """Return True if an element of another style than the element,
+        and overlapping it (checked using the bounding boxes), is drawn
+        between the indices first and last (excluded), i.e. if the
+        element drawn at last can't be drawn at first without changing
+        the rendering. Only the elements of the other styles are
+        checked, and none if the elements are of one style."""
+        style = elementStyle(element)
+        box = None
+        for other, (indices, boxes) in self.styles.items():
+            if other == style: continue
+            start = bisect.bisect_right(indices, first)
+            end = bisect.bisect_left(indices, last)
+            if start >= end: continue
+            if box is None: box = elementBox(element)
+            hmin, vmin, hmax, vmax = box
+            for i in range(4*start, 4*end, 4):
+                if not (boxes[i+2] < hmin or hmax < boxes[i] or
+                        boxes[i+3] < vmin or vmax < boxes[i+1]): return True
+        return False
+
+def mergeCollinearLines(elements, quantum=0.01, paintOrder=None):
+    """Find the lines of same style lying on a same straight line (up to
+    the quantum) that overlap or touch each other, and return a dictionary
+    that gives, for the index of each line to be modified, the line to
+    draw instead: the union of the lines for the first one, and None for
+    the others (to be removed). The lines are not merged if one of them
+    is drawn after an overlapping element of another style (see
+    PaintOrder.paintedBetween), so that the z-order of the rendering is
+    unchanged. The elements are read once, and added to paintOrder if
+    given."""
+    if paintOrder is None: paintOrder = PaintOrder()
+    # The straight line of a line is given by its normalized direction
+    # (angle in [0, pi[) and its distance to the origin
+    groups = {} # list of (tmin, tmax, index) by (state, angle, distance)
+    for index, element in enumerate(elements):
+        paintOrder.add(index, element)
+        if element[0] != LINE: continue
+        _, state, x1, y1, x2, y2 = element
+        length = math.hypot(x2-x1, y2-y1)
+        if length < quantum: continue
+        ux, uy = (x2-x1)/length, (y2-y1)/length
+        if ux < 0 or (ux == 0 and uy < 0): ux, uy = -ux, -uy
+        angle = math.atan2(uy, ux)
+        distance = x1*uy - y1*ux
+        key = (state, round(angle / 1e-6), round(distance / quantum))
+        t1, t2 = x1*ux + y1*uy, x2*ux + y2*uy
+        groups.setdefault(key, []).append((min(t1, t2), max(t1, t2), index, ux, uy, distance))
+
+    merged = {}
+    for (state, _, _), intervals in groups.items():
+        if len(intervals) < 2: continue
+        intervals.sort()
+        runs = [[intervals[0]]]
+        end = intervals[0][1]
+        for interval in intervals[1:]:
+            if interval[0] <= end + quantum:
+                runs[-1].append(interval)
+                end = max(end, interval[1])
+            else:
+                runs.append([interval])
+                end = interval[1]
+        for run in runs:
+            if len(run) < 2: continue
+            first = min(interval[2] for interval in run)
+            _, _, _, ux, uy, distance = run[0]
+            # line from the abscissa t1 to t2 on the straight line
+            line = lambda t1, t2: (LINE, state, t1*ux + distance*uy, t1*uy - distance*ux,
+                                   t2*ux + distance*uy, t2*uy - distance*ux)
+            if any(paintOrder.paintedBetween(first, interval[2], line(*interval[:2]))
+                   for interval in run): continue
+            merged[first] = line(run[0][0], max(interval[1] for interval in run))
+            for interval in run:
+                if interval[2] != first: merged[interval[2]] = None
+    return merged
+
+class LabelPlacer:
+    """The placement of the labels of the points without collision (see
+    SvgSketcher.labelPlacement). The canvas is divided in cells of
+    cellSize pixels, and the cells covered by the points and labels
+    already drawn are marked as occupied. A label is put at the first
+    candidate position around its point whose cells are all free, so
+    that the cost of a placement does not depend on the number of
+    labels (a test is a search in a few rows of cells). The size of a
+    label is estimated from its length and the font size.
+
+    If no position is free, the label is either dropped, or, if leader
+    is True, searched further from the point (see leaderDistances) and
+    linked to the point by a leader line.
+    """
+    __slots__ = ("ncols", "nrows", "cells", "leader")
+
+    cellSize = 4          # size of the cells (pixels)
+    charWidth = 0.6       # estimated width of a character (font size)
+    ascent = 0.8          # estimated height above the baseline (font size)
+    leaderDistances = (3, 6) # distances of the labels with leader (offset)
+    # directions of the candidate positions (in canvas, i.e. v downward)
+    directions = ((1, -1), (-1, -1), (1, 1), (-1, 1), (1, 0), (-1, 0), (0, -1), (0, 1))
+
+    def __init__(self, cnvwidth, cnvheight, leader=False):
+        self.ncols = int(math.ceil(cnvwidth / LabelPlacer.cellSize))
+        self.nrows = int(math.ceil(cnvheight / LabelPlacer.cellSize))
+        self.cells = bytearray(self.ncols * self.nrows)
+        self.leader = leader
+
+    def occupy(self, box):
+        """Mark the cells covered by the box (clipped to the canvas)"""
+        size = LabelPlacer.cellSize
+        i0, i1 = max(0, int(box[0] // size)), min(self.ncols - 1, int(box[2] // size))
+        j0, j1 = max(0, int(box[1] // size)), min(self.nrows - 1, int(box[3] // size))
+        if i0 > i1: return
+        occupied = b"\x01" * (i1 - i0 + 1)
+        for j in range(j0, j1 + 1):
+            start = j * self.ncols + i0
+            self.cells[start:start + len(occupied)] = occupied
+
+    def isFree(self, box):
+        """Return True if the box is inside the canvas, and its cells are
+        not occupied"""
+        hmin, vmin, hmax, vmax = box
+        if hmin < 0 or vmin < 0: return False
+        size = LabelPlacer.cellSize
+        i1, j1 = int(hmax // size), int(vmax // size)
+        ncols = self.ncols
+        if i1 >= ncols or j1 >= self.nrows: return False
+        i0 = int(hmin // size)
+        cells, count = self.cells, i1 - i0 + 1
+        for start in range(int(vmin // size) * ncols + i0, j1 * ncols + i0 + 1, ncols):
+            if cells.find(1, start, start + count) != -1: return False
+        return True
+
+    def place(self, h, v, offset, width, height):
+        """Return the box (hmin, vmin, hmax, vmax) of the label of size
+        (width, height) of the point (h, v), and the end of its leader
+        line (None if no leader), or None if the label can't be placed.
+        The cells of the box are then occupied."""
+        distances = (1,) + (LabelPlacer.leaderDistances if self.leader else ())
+        for scale in distances:
+            d = offset * scale
+            for dh, dv in LabelPlacer.directions:
+                hmin = h + d if dh > 0 else h - d - width if dh < 0 else h - 0.5*width
+                vmin = v + d if dv > 0 else v - d - height if dv < 0 else v - 0.5*height
+                box = (hmin, vmin, hmin + width, vmin + height)
+                if not self.isFree(box): continue
+                self.occupy(box)
+                if scale == 1: return box, None
+                # leader to the nearest point of the box
+                return box, (min(max(h, box[0]), box[2]), min(max(v, box[1]), box[3]))
+        return None
+
+class SketchLayer:
+    """A named layer of a sketch (see SvgSketcher.layer), i.e. a list of
+    elements with a visibility and a z-order (the layers of greater
+    zorder are drawn over the others). The SVG text of the elements is
+    kept (see fragment), and only the new elements are formatted when
+    the layer is serialized again."""
+    __slots__ = ("name", "elements", "visible", "zorder", "_cache")
+
+    def __init__(self, name, elements, zorder):
+        self.name = name
+        self.elements = elements # None for the current layer of the sketcher
+        self.visible = True
+        self.zorder = zorder
+        self._cache = None # (elements, count, last element, grouped, text)
+
+    def fragment(self, elements, grouped):
+        """Return the SVG text of the elements of the layer"""
+        count = len(elements)
+        cache = self._cache
+        text = None
+        if cache is not None:
+            cached, cachedCount, last, cachedGrouped, cachedText = cache
+            if (cached is elements and cachedGrouped == grouped and cachedCount <= count
+                and (cachedCount == 0 or elements[cachedCount-1] == last)):
+                if cachedCount == count: return cachedText
+                # only new elements: formatted after the cached text (if
+                # grouped, they could belong to the previous groups)
+                if not grouped:
+                    text = cachedText + "".join([formatElement(element) + "\n"
+                                                 for element in itertools.islice(elements, cachedCount, None)])
+        if text is None: text = "".join(iterElements(elements, grouped))
+        self._cache = (elements, count, elements[count-1] if count > 0 else None, grouped, text)
+        return text
+
+def encodedLength(text):
+    """Return the number of bytes of the text encoded in UTF-8"""
+    return len(text) if text.isascii() else len(text.encode("utf-8"))
+
+class SketcherStats:
+    """The measures of an instrumented sketcher (see
+    SvgSketcher.enableStats), i.e. the number of calls and the cumulative
+    time of the stages:
+
+    - transform: conversion of the user coordinates to canvas coordinates
+    - format: creation of the SVG text of the elements (including the
+      fragments included in other documents, see SvgSketcher.fragment)
+    - serialize: creation of the whole SVG text, or of the text appended
+      by an incremental save (including format)
+    - write: output of the SVG text (save and display, serialize excluded)
+
+    and the number of bytes (UTF-8) of SVG text produced. The probes are
+    functions called for each measure with the stage, the elapsed time
+    and a detail (number of bytes, or file path), e.g. for profiling.
+    """
+    stages = ("transform", "format", "serialize", "write")
+
+    def __init__(self):
+        self.calls = dict.fromkeys(SketcherStats.stages, 0)
+        self.times = dict.fromkeys(SketcherStats.stages, 0.)
+        self.bytes = 0
+        self.probes = []
+
+    def record(self, stage, elapsed, detail=None):
+        self.calls[stage] += 1
+        self.times[stage] += elapsed
+        for probe in self.probes: probe(stage, elapsed, detail)
+
+    def timed(self, stage, fragments):
+        """Generate the fragments of text of the generator, measuring the
+        time spent in the generator and the size of the fragments"""
+        clock = time.perf_counter
+        elapsed = 0.
+        size = 0
+        while True:
+            start = clock()
+            fragment = next(fragments, None)
+            elapsed += clock() - start
+            if fragment is None: break
+            size += encodedLength(fragment)
+            yield fragment
+        if stage == "serialize": self.bytes += size
+        self.record(stage, elapsed, size)
+
+class SpillingElements:
+    """A list of elements that keeps in memory at most a budget of bytes
+    (estimated with elementSize bytes by element). When the budget is
+    exceeded, the elements in memory are written (pickled) as a new chunk
+    at the end of a temporary file, optionally compressed, and read back
+    chunk by chunk when iterating the list. The last element is always
+    kept in memory, so that it can be replaced (see coalesceLines), while
+    the spilled elements can only be read.
+    """
+    elementSize = 200 # estimate of the memory used by an element (bytes)
+
+    def __init__(self, budget, compress=False, elements=()):
+        self.capacity = max(2, int(budget // SpillingElements.elementSize))
+        self.compress = compress
+        self.tail = []    # the elements kept in memory
+        self.chunks = []  # (offset, size, count) of the chunks in the file
+        self.spilled = 0  # number of elements in the file
+        self.file = None
+        self.extend(elements)
+
+    def __len__(self):
+        return self.spilled + len(self.tail)
+
+    def append(self, element):
+        self.tail.append(element)
+        if len(self.tail) > self.capacity: self._spill()
+
+    def extend(self, elements):
+        self.tail.extend(elements)
+        if len(self.tail) > self.capacity: self._spill()
+
+    def _spill(self):
+        import pickle, tempfile
+        elements, self.tail = self.tail[:-1], self.tail[-1:]
+        data = pickle.dumps(elements, pickle.HIGHEST_PROTOCOL)
+        if self.compress: data = zlib.compress(data)
+        if self.file is None: self.file = tempfile.TemporaryFile()
+        offset = self.file.seek(0, os.SEEK_END)
+        self.file.write(data)
+        self.chunks.append((offset, len(data), len(elements)))
+        self.spilled += len(elements)
+
+    def _readChunk(self, chunk):
+        import pickle
+        offset, size, _ = chunk
+        self.file.seek(offset)
+        data = self.file.read(size)
+        if self.compress: data = zlib.decompress(data)
+        return pickle.loads(data)
+
+    def __iter__(self):
+        for chunk in list(self.chunks):
+            yield from self._readChunk(chunk)
+        yield from list(self.tail)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(itertools.islice(self, *index.indices(len(self))))
+        if index < 0: index += len(self)
+        if not 0 <= index < len(self): raise IndexError("element index out of range")
+        if index >= self.spilled: return self.tail[index - self.spilled]
+        for chunk in self.chunks:
+            if index < chunk[2]: return self._readChunk(chunk)[index]
+            index -= chunk[2]
+
+    def __setitem__(self, index, element):
+        if index < 0: index += len(self)
+        if not self.spilled <= index < len(self):
+            raise SvgException("Only the elements in memory can be modified")
+        self.tail[index - self.spilled] = element
+
+    def close(self):
+        if self.file is not None: self.file.close()
+        self.file = None
+
 # =======================================================================
 # The sketcher
 
@@ -263,6 +1109,19 @@ class SvgSketcher:
     defaultCanvasWidth  = 600. # pixels
     defaultCanvasHeight = 400. # pixels
     pointRadiusScale = 1.5  # scale factor on lineWidth
+    groupSearchWindow = 32  # number of groups searched back for grouping
+    polygonChunkSize = 1024 # number of points consumed at once by polygon
+    cloudChunkSize = 65536  # number of points consumed at once from a point cloud
+    densityThreshold = 200000 # number of points above which a cloud is drawn as a density
+    densityMode = "image"   # density rendering: "image" (heatmap) or "rects" (cells)
+    densityBinSize = 1      # size of the density cells (pixels)
+    densityLevels = 8       # number of opacity levels of the density cells
+    coalesceTolerance = 0.5 # max deviation (pixels) for merging collinear lines
+    coalesceAngle = 0.001   # max angle (radians) between merged lines
+    gridColor = "lightgray" # color of the grid lines (see grid)
+    gridLineWidth = 1       # width of the grid lines (pixels)
+    tickLength = 6          # length of the ticks on the axis (pixels)
+    tickFontSize = 12       # font size of the ticks labels
     defaultPencil = None
     defaultCoordinatesSystem = None
 
@@ -272,12 +1131,23 @@ class SvgSketcher:
 
         self.x = 0.
         self.y = 0.
-        self.body = ""
+        self.elements = []
         self.backgroundColor = None # transparent
+        self.groupStyles = False # set to True to group elements of same style
+        self.coalesceLines = False # set to True to merge consecutive collinear lines
+        self._checkpoint = None # state of the last saved file (see save)
+        self.memoryBudget = None # see withMemoryBudget
+        self._stats = None # see enableStats
+        self._layers = None # layers by name, if any (see layer)
+        self._layer = None  # the current layer
+        self._bodyCache = None # text of the body without layers (see fragment)
+        self.labelPlacement = None # "drop" or "leader" to avoid labels collisions (see point)
+        self._labelPlacer = None
+        self.spillCompression = False
         self.cnvwidth = cnvwidth
         self.cnvheight = cnvheight
 
-        if pencil is None: self.pencil = SvgPencil()
+        if pencil is None: self.pencil = SvgPencil.new()
         else: self.pencil = pencil
 
         if coordinatesSystem is None: self.coordinatesSystem = CoordinatesSystem.TopLeft()
@@ -293,31 +1163,374 @@ class SvgSketcher:
         self.coordinatesSystem = coordinatesSystem
         return self
 
-    def toSVG(self):
-        s = headPattern % (self.cnvwidth, self.cnvheight) + "\n"
+    @property
+    def body(self):
+        """The SVG text of the sketched elements"""
+        return "".join(self._iterBody(False))
+
+    def _iterBody(self, grouped):
+        """Generate the SVG text of the sketched elements, piece by
+        piece. If grouped is True, the elements of same style are
+        gathered in groups (see groupElements). With layers, the text
+        of the visible layers is given in z-order, each layer as a whole
+        (see SketchLayer.fragment)."""
+        if self._layers is None:
+            yield from iterElements(self.elements, grouped)
+            return
+        for layer in self._sortedLayers():
+            if layer.visible: yield layer.fragment(self._layerElements(layer), grouped)
+
+    def fragment(self, grouped=None):
+        """Return the SVG text of the (visible) elements. The text is kept,
+        and only the elements added since the previous call are formatted
+        (see SketchLayer.fragment), which is useful to include the sketch
+        several times in other documents (see SvgComposition)."""
+        if grouped is None: grouped = self.groupStyles
+        if self._layers is None:
+            if self._bodyCache is None: self._bodyCache = SketchLayer(None, None, 0)
+            return self._bodyCache.fragment(self.elements, grouped)
+        return "".join([layer.fragment(self._layerElements(layer), grouped)
+                        for layer in self._sortedLayers() if layer.visible])
+
+    # ---------------------------------------------------------
+    # Layers (see SketchLayer)
+    defaultLayer = "main" # name of the layer of a sketcher without layers
+
+    def layer(self, name, zorder=None):
+        """Select the layer name (created if it does not exist, over the
+        others if zorder is None) as the layer in which the next elements
+        are drawn. The elements drawn before any layer selection are in
+        the layer defaultLayer, whose zorder is 0."""
+        layers = self._sketchLayers()
+        layer = layers.get(name)
+        if layer is None:
+            if zorder is None: zorder = max(layer.zorder for layer in layers.values()) + 1
+            layer = layers[name] = SketchLayer(name, self._newElements(), zorder)
+        elif zorder is not None:
+            layer.zorder = zorder
+        if layer is not self._layer:
+            # the elements of the current layer are the elements of the sketcher
+            self._layer.elements, self.elements = self.elements, layer.elements
+            layer.elements = None
+            self._layer = layer
+        return self
+
+    def showLayer(self, name, visible=True):
+        """Set the visibility of the layer name"""
+        layer = self._sketchLayers().get(name)
+        if layer is None: raise SvgException("No layer named %s"%name)
+        layer.visible = visible
+        return self
+
+    def hideLayer(self, name):
+        return self.showLayer(name, False)
+
+    def removeLayer(self, name):
+        """Remove the layer name and its elements (the default layer
+        becomes the current layer if name is the current layer)"""
+        if name == SvgSketcher.defaultLayer:
+            raise SvgException("The default layer can't be removed")
+        layers = self._sketchLayers()
+        if name not in layers: raise SvgException("No layer named %s"%name)
+        if self._layer.name == name: self.layer(SvgSketcher.defaultLayer)
+        del layers[name]
+        return self
+
+    def layerNames(self):
+        """Return the names of the layers in z-order"""
+        if self._layers is None: return [SvgSketcher.defaultLayer]
+        return [layer.name for layer in self._sortedLayers()]
+
+    def _sketchLayers(self):
+        """Return the layers by name, created with the default layer as
+        current layer at the first use"""
+        if self._layers is None:
+            self._layer = SketchLayer(SvgSketcher.defaultLayer, None, 0)
+            self._layers = {SvgSketcher.defaultLayer: self._layer}
+        return self._layers
+
+    def _sortedLayers(self):
+        return sorted(self._layers.values(), key=lambda layer: layer.zorder)
+
+    def _layerElements(self, layer):
+        return self.elements if layer is self._layer else layer.elements
+
+    def visibleElementLists(self):
+        """Return the lists of elements of the visible layers, in z-order
+        (a list is kept by its layer when another layer is selected)"""
+        if self._layers is None: return [self.elements]
+        return [self._layerElements(layer) for layer in self._sortedLayers() if layer.visible]
+
+    def visibleElements(self):
+        """Return an iterable of the elements of the visible layers, in
+        z-order (the elements of the sketcher if there is no layers)"""
+        if self._layers is None: return self.elements
+        return itertools.chain.from_iterable(self.visibleElementLists())
+
+    def _iterSVG(self, grouped=None):
+        """Generate the SVG text of the sketch, piece by piece"""
+        if grouped is None: grouped = self.groupStyles
+        yield headPattern % (self.cnvwidth, self.cnvheight) + "\n"
         if self.backgroundColor is not None:
             # Add a full size rectangle as first element with fill color set to
             # the background color (classical method for SVG background color)
-            s+="<rect width='100%%' height='100%%' fill='%s'/>\n"%self.backgroundColor
-        s+= self.body
-        s+= footPattern
-        return s
+            yield backgroundPattern%self.backgroundColor + "\n"
+        yield from self._iterBody(grouped)
+        yield footPattern
+
+    def toSVG(self, grouped=None):
+        """Return the SVG text of the sketch. If grouped is True, the
+        elements of same style are gathered in <g> groups that carry the
+        style (see groupElements). The default is given by the attribute
+        groupStyles."""
+        return "".join(self._iterSVG(grouped))
 
     def __repr__(self):
         return self.toSVG()
 
     def clear(self):
-        self.body = ""
+        """Remove all the elements (of all the layers)"""
+        self.elements = self._newElements()
+        if self._layers is not None:
+            for layer in self._layers.values():
+                if layer is not self._layer: layer.elements = self._newElements()
+        self._checkpoint = None
+        self._labelPlacer = None
+
+    def _newElements(self, elements=()):
+        """Return a new list of elements, spilling to disk if a memory
+        budget is set (see withMemoryBudget)"""
+        if self.memoryBudget is None: return list(elements)
+        return SpillingElements(self.memoryBudget, self.spillCompression, elements)
+
+    def withMemoryBudget(self, budget, compress=False):
+        """Set the maximal memory (bytes) used to keep the sketched
+        elements. Beyond this budget, the elements are written in a
+        temporary file (compressed if compress is True) and read back
+        when needed (see SpillingElements). Set budget to None to keep
+        all the elements in memory."""
+        self.memoryBudget = budget
+        self.spillCompression = compress
+        self.elements = self._newElements(self.elements)
+        if self._layers is not None:
+            for layer in self._layers.values():
+                if layer is not self._layer: layer.elements = self._newElements(layer.elements)
+        self._checkpoint = None
+        return self
 
-    def save(self,filepath=None):
+    def save(self,filepath=None, grouped=None, incremental=False):
+        """Save the SVG text of the sketch in the file (a temporary file if
+        filepath is None) and return the file path. If incremental is
+        True, and if the sketch has only been added new elements since
+        it was last saved in the same file, only the new elements are
+        written at the end of the file (see _appendSave). Otherwise, the
+        whole file is written."""
         if filepath==None: filepath = svgTempPath()
-        with open(filepath,'w') as svgfile:
-            svgfile.write(self.toSVG())        
+        if grouped is None: grouped = self.groupStyles
+        if incremental and not grouped and self._appendSave(filepath):
+            return filepath
+        with open(filepath,'w', encoding="utf-8") as svgfile:
+            svgfile.writelines(self._iterSVG(grouped))
+        # The grouped files can't be appended (the elements are reordered)
+        self._checkpoint = None
+        if not grouped:
+            end = os.path.getsize(filepath) - len(footPattern)
+            self._checkpoint = self._newCheckpoint(filepath, end)
         return filepath
 
+    def _newCheckpoint(self, filepath, end):
+        """Return the description of the content of the file, given the
+        position end of the footer: (file path, elements, number of
+        elements, last element, header parameters, position of the
+        footer)"""
+        elements = self.elements
+        last = elements[-1] if len(elements) > 0 else None
+        header = (self.cnvwidth, self.cnvheight, self.backgroundColor)
+        return (os.path.abspath(filepath), elements, len(elements), last, header, end)
+
+    def _appendSave(self, filepath):
+        """Write the new elements at the end of the file of the last save,
+        over the footer, and return True. Return False, without writing
+        anything, if this is not possible, i.e. if the file is not the
+        one of the last save (or was modified since then), or if the
+        sketch was modified by other means than adding elements (clear,
+        modification of the last element, canvas size or background)."""
+        checkpoint = self._checkpoint
+        if checkpoint is None or self._layers is not None: return False
+        path, elements, count, last, header, end = checkpoint
+        if path != os.path.abspath(filepath): return False
+        if elements is not self.elements or len(elements) < count: return False
+        if count > 0 and elements[count-1] != last: return False
+        if header != (self.cnvwidth, self.cnvheight, self.backgroundColor): return False
+        try:
+            if os.path.getsize(filepath) != end + len(footPattern): return False
+        except OSError:
+            return False
+
+        with open(filepath, 'r+b') as svgfile:
+            svgfile.seek(end)
+            svgfile.write("".join(self._iterAppended(elements, count)).encode("utf-8"))
+            end = svgfile.tell()
+            svgfile.write(footPattern.encode("utf-8"))
+            svgfile.truncate()
+        self._checkpoint = self._newCheckpoint(filepath, end)
+        return True
+
+    def _iterAppended(self, elements, start):
+        """Generate the SVG text of the elements from the index start (see
+        _appendSave)"""
+        for element in itertools.islice(elements, start, None):
+            yield formatElement(element) + "\n"
+
     def display(self):
         SvgViewer.display(self.toSVG())
 
+    # ---------------------------------------------------------
+    # Instrumentation (see SketcherStats)
+    def enableStats(self):
+        """Start measuring the time spent in the stages of the sketching
+        (see SketcherStats). The measures are done by instance methods
+        that wrap the class methods, so that the instrumentation costs
+        nothing when not enabled."""
+        if self._stats is not None: return self
+        stats = SketcherStats()
+        self._stats = stats
+        cls = type(self)
+        clock = time.perf_counter
+
+        def _cnvCoordinates(x, y):
+            start = clock()
+            result = cls._cnvCoordinates(self, x, y)
+            stats.record("transform", clock() - start)
+            return result
+
+        def _iterBody(grouped):
+            return stats.timed("format", cls._iterBody(self, grouped))
+
+        def _iterSVG(grouped=None):
+            return stats.timed("serialize", cls._iterSVG(self, grouped))
+
+        def _iterAppended(elements, start):
+            # the text written by an incremental save is the serialization
+            return stats.timed("serialize", stats.timed("format", cls._iterAppended(self, elements, start)))
+
+        def fragment(grouped=None):
+            start = clock()
+            text = cls.fragment(self, grouped)
+            stats.record("format", clock() - start, encodedLength(text))
+            return text
+
+        def save(filepath=None, grouped=None, incremental=False):
+            serialize = stats.times["serialize"]
+            start = clock()
+            filepath = cls.save(self, filepath, grouped, incremental)
+            # the serialization is measured apart
+            elapsed = clock() - start - (stats.times["serialize"] - serialize)
+            stats.record("write", elapsed, filepath)
+            return filepath
+
+        def display():
+            serialize = stats.times["serialize"]
+            start = clock()
+            cls.display(self)
+            stats.record("write", clock() - start - (stats.times["serialize"] - serialize))
+
+        for method in (_cnvCoordinates, _iterBody, _iterSVG, _iterAppended, fragment, save, display):
+            setattr(self, method.__name__, method)
+        return self
+
+    def disableStats(self):
+        """Stop the measures (the collected stats are dropped)"""
+        if self._stats is None: return self
+        for name in ("_cnvCoordinates", "_iterBody", "_iterSVG", "_iterAppended", "fragment", "save", "display"):
+            delattr(self, name)
+        self._stats = None
+        return self
+
+    def addProbe(self, probe):
+        """Add a function called as probe(stage, elapsed, detail) for each
+        measure (enables the stats, see SketcherStats.record)"""
+        self.enableStats()
+        self._stats.probes.append(probe)
+        return self
+
+    def stats(self):
+        """Return a dictionary of statistics on the sketch: the number of
+        elements by kind, the number of distinct styles, and if enabled
+        (see enableStats), the number of bytes of SVG text produced, and
+        the number of calls and cumulative time (seconds) of each
+        stage."""
+        kinds = {}
+        styles = set()
+        for element in self.visibleElements():
+            kinds[element[0]] = kinds.get(element[0], 0) + 1
+            styles.add(elementStyle(element))
+        result = {"elements": sum(kinds.values()), "kinds": kinds, "styles": len(styles)}
+        if self._stats is not None:
+            result["bytes"] = self._stats.bytes
+            result["calls"] = dict(self._stats.calls)
+            result["times"] = dict(self._stats.times)
+        return result
+
+    def saveLevels(self, levels, pattern=None, tolerance=0.5):
+        """Save the sketch at several resolutions (levels of detail) in a
+        single pass over the elements, and return the dictionary of the
+        file paths by level name.
+
+        The levels are given as a dictionary of sizes by level name, the
+        size being the number of pixels of the largest dimension of the
+        output canvas. The file paths are given by the pattern with the
+        placeholder {level} (default to a temporary file path). In each
+        output, the elements outside of the canvas or too small to be
+        seen are dropped, and the polylines are simplified within the
+        tolerance, given in pixels of the output (see LevelRenderer)."""
+        if pattern is None:
+            pattern = svgTempPath(".{level}.svg")
+        renderers = [LevelRenderer(self, name, size, pattern.format(level=name), tolerance)
+                     for name, size in levels.items()]
+        try:
+            for element in self.visibleElements():
+                box = elementBox(element)
+                for renderer in renderers: renderer.add(element, box)
+        finally:
+            for renderer in renderers: renderer.close()
+        return dict((renderer.name, renderer.filepath) for renderer in renderers)
+
+    def _iterJSON(self):
+        """Generate the JSON text of the sketch for the canvas page,
+        piece by piece (see canvasRuns)"""
+        import json
+        yield '{"width": %s, "height": %s, "background": %s,\n"runs": [' % (
+            json.dumps(self.cnvwidth), json.dumps(self.cnvheight), json.dumps(self.backgroundColor))
+        styles = {}
+        separator = "\n"
+        for kind, state, values, items in canvasRuns(self.visibleElements()):
+            style = styles.setdefault(state, len(styles))
+            if values: data = '"data": "%s"'%float32Data(values)
+            else: data = '"items": %s'%json.dumps(items)
+            yield '%s{"kind": "%s", "style": %d, %s}'%(separator, kind, style, data)
+            separator = ",\n"
+        yield '],\n"styles": %s}' % json.dumps([canvasStyle(state) for state in styles])
+
+    def toJSON(self):
+        """Return the geometry of the sketch as a JSON text, with the
+        coordinates of the elements given as float32 arrays, for the
+        drawing in a HTML canvas (see saveHTML and canvasRuns)"""
+        return "".join(self._iterJSON())
+
+    def saveHTML(self, filepath=None, title="Sketch"):
+        """Save the sketch as a self-contained HTML page that draws it in
+        a canvas, which is much faster than SVG in a browser for large
+        drawings, and return the file path (a temporary file path if
+        filepath is None)"""
+        if filepath is None: filepath = svgTempPath(".html")
+        with open(filepath, 'w', encoding="utf-8") as htmlfile:
+            htmlfile.write(canvasHeadPattern % title.replace("<", "&lt;"))
+            # no closing tag in the JSON text, whose texts can contain "</"
+            htmlfile.writelines(fragment.replace("</", "<\\/") for fragment in self._iterJSON())
+            htmlfile.write(canvasFootPattern)
+        return filepath
+
     # ---------------------------------------------------------
     def _cnvCoordinates(self,x,y):
         return self.coordinatesSystem.cnvCoordinates(x,y)
@@ -368,6 +1581,88 @@ class SvgSketcher:
             xmin+xoffset, ymin+yoffset,
             xmax-xoffset, ymax-yoffset)
 
+    def grid(self, xstep=None, ystep=None, axes=True, ticks=True, labels=True):
+        """Draw a grid over the whole canvas, with lines every xstep
+        (resp. ystep) in the user coordinates system. If a step is not
+        specified, it is chosen to get about ten "nice" intervals (see
+        niceStep). The grid lines are drawn with the gridColor, and the
+        axes (lines x=0 and y=0, or the canvas borders if outside the
+        canvas), the ticks and their labels with the current pencil.
+
+        Each part (grid lines, axes, ticks) is a single path, and the
+        labels share the same style."""
+        xmin, xmax, ymin, ymax = self.xyboundaries()
+        if xstep is None: xstep = niceStep(xmin, xmax)
+        if ystep is None: ystep = niceStep(ymin, ymax)
+        xticks = niceTicks(xmin, xmax, xstep)
+        yticks = niceTicks(ymin, ymax, ystep)
+        cnvCoordinates = self._cnvCoordinates
+        hticks = [cnvCoordinates(x, 0.)[0] for x in xticks]
+        vticks = [cnvCoordinates(0., y)[1] for y in yticks]
+        w, h = float(self.cnvwidth), float(self.cnvheight)
+
+        state = self.pencil.state().withoutFill()
+        gridState = state.variant("lineColor", SvgSketcher.gridColor)
+        gridState = gridState.variant("lineWidth", SvgSketcher.gridLineWidth)
+        commands = []
+        for hc in hticks: commands.extend((("M", hc, 0.), ("L", hc, h)))
+        for vc in vticks: commands.extend((("M", 0., vc), ("L", w, vc)))
+        if commands: self.elements.append((PATH, gridState, tuple(commands)))
+
+        # Position of the axes in the canvas (clamped to the borders)
+        hO, vO = cnvCoordinates(0., 0.)
+        hO = min(max(hO, 0.), w)
+        vO = min(max(vO, 0.), h)
+        if axes:
+            commands = (("M", 0., vO), ("L", w, vO), ("M", hO, 0.), ("L", hO, h))
+            self.elements.append((PATH, state, commands))
+        if ticks:
+            t = 0.5 * SvgSketcher.tickLength
+            commands = []
+            for hc in hticks: commands.extend((("M", hc, vO-t), ("L", hc, vO+t)))
+            for vc in vticks: commands.extend((("M", hO-t, vc), ("L", hO+t, vc)))
+            if commands: self.elements.append((PATH, state, tuple(commands)))
+        if labels:
+            size = SvgSketcher.tickFontSize
+            textState = self.pencil.state().withFontSize(size)
+            elements = []
+            for x, hc in zip(xticks, hticks):
+                elements.append((TEXT, textState, hc + 2., vO + size, formatTick(x, xstep)))
+            for y, vc in zip(yticks, vticks):
+                if y == 0 and 0 in xticks: continue # already labelled
+                elements.append((TEXT, textState, hO + 2., vc - 2., formatTick(y, ystep)))
+            self.elements.extend(elements)
+
+    def deduplicate(self, merge=True, quantum=0.01):
+        """Remove the duplicated elements, i.e. the elements with the same
+        style and the same geometry (canvas coordinates rounded to the
+        quantum, and lines in both directions) as a previous element.
+        If merge is True, the overlapping lines of same style on a same
+        straight line are also replaced by their union (see
+        mergeCollinearLines). The first of the duplicated (resp. merged)
+        elements is kept at its place. An element drawn over an element
+        of another style since its previous copy is kept (see
+        PaintOrder), so that the rendering is unchanged. Return the
+        number of elements removed."""
+        count = len(self.elements)
+        paintOrder = PaintOrder()
+        merged = mergeCollinearLines(self.elements, quantum, paintOrder) if merge else {}
+        elements = self._newElements()
+        seen = {} # index of the last drawn copy by key
+        for index, element in enumerate(self.elements):
+            if not merge: paintOrder.add(index, element)
+            if index in merged:
+                element = merged[index]
+                if element is None: continue
+            key = elementKey(element, quantum)
+            previous = seen.get(key)
+            if previous is not None and not paintOrder.paintedBetween(previous, index, element):
+                continue
+            seen[key] = index
+            elements.append(element)
+        self.elements = elements
+        return count - len(elements)
+
     # ---------------------------------------------------------
     # Turtle-like drawing methods
     def moveTo(self,x,y):
@@ -378,11 +1673,44 @@ class SvgSketcher:
     def lineTo(self,x,y):
         px1, py1 = self._cnvCoordinates(self.x,self.y)
         px2, py2 = self._cnvCoordinates(x,y)
-        style = self.pencil.drawStyle()
-        self.body += linePattern % (px1, py1, px2, py2, style) + "\n"
+        state = self.pencil.state()
+        if not self.coalesceLines or not self._coalesce(state, px1, py1, px2, py2):
+            self.elements.append((LINE, state, px1, py1, px2, py2))
         self.x = x
         self.y = y
 
+    def _coalesce(self, state, px1, py1, px2, py2):
+        """Try to merge the line (px1, py1, px2, py2) with the last
+        sketched element, and return True if merged. The merge is done
+        if the last element is a line of same style that ends at (px1,
+        py1), and if the new line continues it in the same direction,
+        i.e. its angle with the last line is less than coalesceAngle (so
+        that a curve drawn by small steps is not merged), and the point
+        (px1, py1) lies on the merged line (at a distance less than
+        coalesceTolerance pixels) between its ends. A line of null length
+        is simply ignored."""
+        if px1 == px2 and py1 == py2: return True
+        elements = self.elements
+        try:
+            last = elements[-1]
+        except IndexError:
+            return False
+        if last[0] != LINE or last[1] is not state: return False
+        _, _, ox, oy, ex, ey = last
+        if ex != px1 or ey != py1: return False
+        ux, uy = px1-ox, py1-oy
+        sx, sy = px2-px1, py2-py1
+        if abs(ux*sy - uy*sx) > math.sin(SvgSketcher.coalesceAngle) * math.hypot(ux, uy) * math.hypot(sx, sy):
+            return False
+        dx, dy = px2-ox, py2-oy
+        dot = ux*dx + uy*dy
+        length2 = dx*dx + dy*dy
+        if dot <= 0 or dot >= length2: return False
+        if abs(ux*dy - uy*dx) > SvgSketcher.coalesceTolerance * math.sqrt(length2):
+            return False
+        elements[-1] = (LINE, state, ox, oy, px2, py2)
+        return True
+
     def hlineTo(self,x):
         self.lineTo(x,self.y)
 
@@ -401,6 +1729,10 @@ class SvgSketcher:
     # -------------------------------------------------------------
     # Sketching primitive functions
     def point(self, x=None, y=None, color=None, label=None):
+        """Draw a point, with its label if any. If labelPlacement is
+        "drop" or "leader", the label is put at a free position around
+        the point (see LabelPlacer), and dropped, or linked to the point
+        with a leader line, if there is no free place near the point."""
         # Technically, we draw a filled circle with no border, with radius
         # proportional to the lineWidth with factor SvgSketcher.pointRadiusScale
         if x is None: x = self.x
@@ -409,13 +1741,14 @@ class SvgSketcher:
         pcx, pcy = self._cnvCoordinates(x, y)
         pr = self.pencil.lineWidth * SvgSketcher.pointRadiusScale
 
-        pencil = self.pencil.clone()
-        pencil.lineColor = None
-        if color is not None: pencil.fillColor = color
-        
-        style = pencil.drawStyle()
-        self.body += circPattern % (pcx, pcy, pr, style) + "\n"
+        state = self.pencil.state().withoutBorder()
+        if color is not None: state = state.withFill(color)
+
+        self.elements.append((CIRCLE, state, pcx, pcy, pr))
 
+        if self.labelPlacement is not None:
+            self._placeLabel(pcx, pcy, pr, label, color)
+            return
         if label is None: return
         # On décale le label d'une distance proportionnelle au rayon du
         # cercle symbolisant le point, à exprimer dans l'unité du
@@ -423,16 +1756,39 @@ class SvgSketcher:
         dx = dy = float(1.5*pr) / self.coordinatesSystem.xyunit
         self.text(x+dx, y+dy, value=label, color=color)
 
+    def _placeLabel(self, pcx, pcy, pr, label, color):
+        placer = self._labelPlacer
+        if placer is None:
+            if self.labelPlacement not in ("drop", "leader"):
+                raise SvgException("Unknown label placement %s"%self.labelPlacement)
+            placer = LabelPlacer(self.cnvwidth, self.cnvheight, self.labelPlacement == "leader")
+            self._labelPlacer = placer
+        placer.occupy((pcx - pr, pcy - pr, pcx + pr, pcy + pr))
+        if label is None: return
+
+        state = self.pencil.state()
+        if color is not None: state = state.withFontColor(color)
+        size = _number(str(state.fontSize), SvgPencil.defaultFontSize)
+        placement = placer.place(pcx, pcy, 1.5*pr, len(str(label)) * size * LabelPlacer.charWidth, size)
+        if placement is None: return
+        box, leader = placement
+        if leader is not None:
+            length = math.hypot(leader[0] - pcx, leader[1] - pcy)
+            h, v = pcx + pr * (leader[0] - pcx) / length, pcy + pr * (leader[1] - pcy) / length
+            leaderState = self.pencil.state().withoutFill().variant("lineWidth", 1)
+            if color is not None: leaderState = leaderState.variant("lineColor", color)
+            self.elements.append((LINE, leaderState, h, v, leader[0], leader[1]))
+        self.elements.append((TEXT, state, box[0], box[1] + LabelPlacer.ascent * size, label))
+
     def text(self, x=None, y=None, value="Hello", size=None, color=None):
         if x is None: x = self.x
         if y is None: y = self.y
 
-        pencil = self.pencil.clone()
-        if color is not None: pencil.fontColor = color
-        if size is not None: pencil.fontSize = size
+        state = self.pencil.state()
+        if color is not None: state = state.withFontColor(color)
+        if size is not None: state = state.withFontSize(size)
         px, py = self._cnvCoordinates(x, y)
-        style = pencil.textStyle()
-        self.body += textPattern % (px, py, style, value) + "\n"
+        self.elements.append((TEXT, state, px, py, value))
 
     def circle(self, cx=None, cy=None, radius=1, fill=False, border=True):
         if cx is None: cx = self.x
@@ -440,11 +1796,10 @@ class SvgSketcher:
 
         pcx, pcy = self._cnvCoordinates(cx, cy)
         pr = self._cnvScaling(radius)
-        pencil = self.pencil.clone()
-        if not fill: pencil.fillColor = None
-        if not border: pencil.lineColor = None
-        style = pencil.drawStyle()
-        self.body += circPattern % (pcx, pcy, pr, style) + "\n"
+        state = self.pencil.state()
+        if not fill: state = state.withoutFill()
+        if not border: state = state.withoutBorder()
+        self.elements.append((CIRCLE, state, pcx, pcy, pr))
 
     def rectangle(self, x1, y1, x2, y2, fill=False, border=True):
         """Add a rectangle in the canvas."""
@@ -457,11 +1812,133 @@ class SvgSketcher:
         plx = px2-px1
         ply = py2-py1
 
-        pencil = self.pencil.clone()
-        if not fill: pencil.fillColor = None
-        if not border: pencil.lineColor = None
-        style = pencil.drawStyle()
-        self.body += rectPattern % (px1, py1, plx, ply, style) + "\n"
+        state = self.pencil.state()
+        if not fill: state = state.withoutFill()
+        if not border: state = state.withoutBorder()
+        self.elements.append((RECT, state, px1, py1, plx, ply))
+
+    def ellipse(self, cx=None, cy=None, rx=1, ry=1, fill=False, border=True):
+        if cx is None: cx = self.x
+        if cy is None: cy = self.y
+
+        pcx, pcy = self._cnvCoordinates(cx, cy)
+        prx = self._cnvScaling(rx)
+        pry = self._cnvScaling(ry)
+        state = self.pencil.state()
+        if not fill: state = state.withoutFill()
+        if not border: state = state.withoutBorder()
+        self.elements.append((ELLIPSE, state, pcx, pcy, prx, pry))
+
+    # -------------------------------------------------------------
+    # Curves, drawn from the current position as a single path element
+    def _curveTo(self, command, x, y):
+        px, py = self._cnvCoordinates(self.x, self.y)
+        state = self.pencil.state().withoutFill()
+        self.elements.append((PATH, state, (("M", px, py), command)))
+        self.x = x
+        self.y = y
+
+    def arcTo(self, x, y, radius, largeArc=False, clockwise=False):
+        """Draw the arc of circle of the specified radius from the current
+        position to the position x, y. As for the SVG arcs, there are
+        two possible circles and two possible directions: largeArc
+        selects the arc greater than 180 degrees, and clockwise selects
+        the direction regarding to the axis of the user coordinates
+        system (i.e. from the y axis to the x axis). If the radius is
+        too small, it is scaled up to the half distance between the
+        points."""
+        csys = self.coordinatesSystem
+        # The direction is inverted in the canvas if one axis is inverted
+        sweep = (not clockwise) != (bool(csys.xinverse) != bool(csys.yinverse))
+        pr = self._cnvScaling(radius)
+        px, py = self._cnvCoordinates(x, y)
+        self._curveTo(("A", pr, pr, 0, int(bool(largeArc)), int(sweep), px, py), x, y)
+
+    def quadTo(self, cx, cy, x, y):
+        """Draw the quadratic Bézier curve from the current position to the
+        position x, y, with the control point cx, cy"""
+        pcx, pcy = self._cnvCoordinates(cx, cy)
+        px, py = self._cnvCoordinates(x, y)
+        self._curveTo(("Q", pcx, pcy, px, py), x, y)
+
+    def cubicTo(self, c1x, c1y, c2x, c2y, x, y):
+        """Draw the cubic Bézier curve from the current position to the
+        position x, y, with the control points c1x, c1y and c2x, c2y"""
+        pc1x, pc1y = self._cnvCoordinates(c1x, c1y)
+        pc2x, pc2y = self._cnvCoordinates(c2x, c2y)
+        px, py = self._cnvCoordinates(x, y)
+        self._curveTo(("C", pc1x, pc1y, pc2x, pc2y, px, py), x, y)
+
+    # -------------------------------------------------------------
+    # Function plotting
+    def plot(self, f, xmin=None, xmax=None, tolerance=0.5, samples=64, maxdepth=12):
+        """Draw the curve y = f(x) for x in [xmin, xmax] (by default the
+        x boundaries of the canvas, see xyboundaries) as a single path.
+
+        The function is first evaluated on a uniform grid of samples
+        intervals. Then each interval is split in two as long as the
+        middle point of the curve is farther than tolerance (pixels)
+        from the chord (at most maxdepth times), and finally the points
+        that are not needed to stay within the tolerance are removed.
+        The function is evaluated on all the points of a stage at once,
+        with a numpy array if possible (see evaluateFunction). The non
+        finite values (e.g. division by zero) split the curve."""
+        if xmin is None or xmax is None:
+            bxmin, bxmax, _, _ = self.xyboundaries()
+            if xmin is None: xmin = bxmin
+            if xmax is None: xmax = bxmax
+        cnvCoordinates = self._cnvCoordinates
+
+        xs = [xmin + (xmax-xmin)*i/samples for i in range(samples+1)]
+        ys = evaluateFunction(f, xs)
+        refine = [True] * samples
+        for depth in range(maxdepth):
+            indices = [i for i, r in enumerate(refine) if r]
+            if not indices: break
+            xmids = [0.5*(xs[i]+xs[i+1]) for i in indices]
+            ymids = dict(zip(indices, evaluateFunction(f, xmids)))
+            newxs, newys, newrefine = [], [], []
+            for i in range(len(refine)):
+                newxs.append(xs[i])
+                newys.append(ys[i])
+                if not refine[i]:
+                    newrefine.append(False)
+                    continue
+                xm, ym = 0.5*(xs[i]+xs[i+1]), ymids[i]
+                if all(map(math.isfinite, (ys[i], ys[i+1], ym))):
+                    ha, va = cnvCoordinates(xs[i], ys[i])
+                    hb, vb = cnvCoordinates(xs[i+1], ys[i+1])
+                    hm, vm = cnvCoordinates(xm, ym)
+                    if math.hypot(hm - 0.5*(ha+hb), vm - 0.5*(va+vb)) <= tolerance:
+                        newrefine.append(False)
+                        continue
+                elif not any(map(math.isfinite, (ys[i], ys[i+1], ym))):
+                    newrefine.append(False)
+                    continue
+                newxs.append(xm)
+                newys.append(ym)
+                newrefine.extend((True, True))
+            newxs.append(xs[-1])
+            newys.append(ys[-1])
+            xs, ys, refine = newxs, newys, newrefine
+
+        # The finite runs of points are the subpaths of the curve
+        commands = []
+        run = []
+        end = None # last point drawn (user coordinates)
+        for i, (x, y) in enumerate(zip(xs + [None], ys + [math.nan])):
+            if math.isfinite(y):
+                run.append(cnvCoordinates(x, y))
+                continue
+            if len(run) > 1:
+                run = simplifyPolyline(run, tolerance)
+                commands.append(("M",) + tuple(run[0]))
+                commands.extend([("L",) + tuple(p) for p in run[1:]])
+                end = xs[i-1], ys[i-1]
+            run = []
+        if not commands: return
+        self.elements.append((PATH, self.pencil.state().withoutFill(), tuple(commands)))
+        self.moveTo(*end)
 
     def segment(self, x1, y1, x2, y2):
         self.moveTo(x1,y1)
@@ -469,13 +1946,160 @@ class SvgSketcher:
 
     def polygon(self, points, closed=False):
         """
-        The variable points is a list of point coordinates, each point
-        coordinates is a tuple (x,y).
+        The variable points is an iterable of point coordinates, each
+        point coordinates is a tuple (x,y). It can be a generator: the
+        points are consumed by chunks of polygonChunkSize points, and
+        only the first point is kept (to close the polygon), so that the
+        memory used does not depend on the number of points.
+        """
+        points = iter(points)
+        first = next(points, None)
+        if first is None: return
+        self.moveTo(first[0], first[1])
+
+        chunksize = SvgSketcher.polygonChunkSize
+        while True:
+            chunk = list(itertools.islice(points, chunksize))
+            if not chunk: break
+            self._polyline(chunk)
+        if closed: self.lineTo(first[0], first[1])
+
+    def _polyline(self, points):
+        """Draw the lines from the current position through the list of
+        points, and move to the last point"""
+        if self.coalesceLines:
+            for p in points: self.lineTo(p[0], p[1])
+            return
+        cnvCoordinates = self._cnvCoordinates
+        state = self.pencil.state()
+        px1, py1 = cnvCoordinates(self.x, self.y)
+        elements = []
+        for p in points:
+            px2, py2 = cnvCoordinates(p[0], p[1])
+            elements.append((LINE, state, px1, py1, px2, py2))
+            px1, py1 = px2, py2
+        self.elements.extend(elements)
+        p = points[-1]
+        self.x = p[0]
+        self.y = p[1]
+
+    # -------------------------------------------------------------
+    # Point clouds, i.e. large arrays of (x,y) coordinates (see
+    # loadPointCloud). The points are read by chunks of cloudChunkSize
+    # points, and the coordinates transformation is computed on the
+    # whole chunk at once (numpy is required).
+    def pointCloud(self, source, color=None, dtype="float64"):
+        """Draw a point (see point) for each (x,y) coordinates of the
+        source, that is a point cloud file path or an array of shape
+        (n,2). If the number of points is greater than densityThreshold
+        (None for no threshold), the points are drawn as a density layer
+        instead (see densityCloud).
+
+        The source is read by chunks (see cloudChunkSize), but each point
+        is an element of the sketch: with a memory budget (see
+        withMemoryBudget), the chunks are small enough for the budget and
+        the elements are spilled to disk as they are drawn, so that a
+        cloud larger than the memory can be drawn."""
+        points = pointCloudArray(source, dtype)
+        threshold = SvgSketcher.densityThreshold
+        if threshold is not None and len(points) > threshold:
+            return self.densityCloud(points, color=color)
+        state = self.pencil.state().withoutBorder()
+        if color is not None: state = state.withFill(color)
+        pr = self.pencil.lineWidth * SvgSketcher.pointRadiusScale
+        for chunk in iterChunks(points, self._cloudChunkSize()):
+            hcoords, vcoords = self._cnvCoordinates(chunk[:,0], chunk[:,1])
+            self.elements.extend([(CIRCLE, state, h, v, pr)
+                for h, v in zip(hcoords.tolist(), vcoords.tolist())])
+
+    def _cloudChunkSize(self):
+        # number of points drawn at once, whose elements fit in the
+        # memory budget if any
+        size = SvgSketcher.cloudChunkSize
+        if self.memoryBudget is None: return size
+        return max(1, min(size, int(self.memoryBudget // SpillingElements.elementSize)))
+
+    def densityCloud(self, source, color=None, mode=None, binsize=None, dtype="float64"):
+        """Draw the density of the points of the source (see pointCloud),
+        i.e. the number of points in each cell of a grid of binsize
+        pixels on the canvas, with a logarithmic scale. The density is
+        drawn with the fill color of the pencil (or the given color),
+        either as a single grayscale image used as a mask (mode "image")
+        or as rectangles gathering the consecutive cells of a same row
+        with the same level of opacity (mode "rects", see densityLevels).
         """
-        p = points[0]
-        self.moveTo(p[0],p[1])
-        for p in points[1:]: self.lineTo(p[0],p[1])
-        if closed: self.lineTo(points[0][0],points[0][1])
+        numpy = importNumpy()
+        points = pointCloudArray(source, dtype)
+        if mode is None: mode = SvgSketcher.densityMode
+        if binsize is None: binsize = SvgSketcher.densityBinSize
+        if mode not in ("image", "rects"):
+            raise SvgException("Unknown density mode %s"%mode)
+
+        nh = int(math.ceil(self.cnvwidth / binsize))
+        nv = int(math.ceil(self.cnvheight / binsize))
+        counts = numpy.zeros(nh*nv, dtype="int64")
+        for chunk in iterChunks(points, SvgSketcher.cloudChunkSize):
+            hcoords, vcoords = self._cnvCoordinates(chunk[:,0], chunk[:,1])
+            ih = numpy.floor(hcoords / binsize).astype("int64")
+            iv = numpy.floor(vcoords / binsize).astype("int64")
+            inside = (ih >= 0) & (ih < nh) & (iv >= 0) & (iv < nv)
+            counts += numpy.bincount(iv[inside]*nh + ih[inside], minlength=nh*nv)
+        maxcount = counts.max()
+        if maxcount == 0: return
+        levels = (numpy.log1p(counts) / numpy.log1p(maxcount)).reshape(nv, nh)
+
+        state = self.pencil.state().withoutBorder()
+        if color is not None: state = state.withFill(color)
+        if mode == "image":
+            gray = numpy.round(255 * levels).astype("uint8")
+            maskid = "density%d"%next(densityMaskIds)
+            self.elements.append((DENSITY, state, 0., 0., float(nh*binsize), float(nv*binsize),
+                                  maskid, pngDataURI(gray)))
+            return
+
+        nlevels = SvgSketcher.densityLevels
+        quanta = numpy.ceil(nlevels * levels).astype("int64")
+        elements = []
+        for iv, row in enumerate(quanta):
+            # Start of the runs of cells with the same level in this row
+            starts = numpy.flatnonzero(numpy.diff(row, prepend=-1)).tolist()
+            ends = starts[1:] + [nh]
+            for start, end in zip(starts, ends):
+                quantum = int(row[start])
+                if quantum == 0: continue
+                elements.append((RECT, state.withFillOpacity(float(quantum)/nlevels),
+                                 float(start*binsize), float(iv*binsize),
+                                 float((end-start)*binsize), float(binsize)))
+        self.elements.extend(elements)
+
+    def pathCloud(self, source, closed=False, dtype="float64", color=None):
+        """Draw the lines going through the (x,y) coordinates of the
+        source (see polygon), that is a point cloud file path or an
+        array of shape (n,2). As for pointCloud, the lines are spilled to
+        disk as they are drawn with a memory budget, and if the number of
+        points is greater than densityThreshold, the density of the
+        points is drawn instead (with the line color of the pencil, or
+        the given color, see densityCloud)."""
+        points = pointCloudArray(source, dtype)
+        threshold = SvgSketcher.densityThreshold
+        if threshold is not None and len(points) > threshold:
+            if color is None: color = self.pencil.lineColor
+            return self.densityCloud(points, color=color)
+        if len(points) == 0: return
+        first = float(points[0,0]), float(points[0,1])
+        self.moveTo(*first)
+        state = self.pencil.state()
+        if color is not None: state = state.variant("lineColor", color)
+        h1, v1 = self._cnvCoordinates(*first)
+        for chunk in iterChunks(points[1:], self._cloudChunkSize()):
+            hcoords, vcoords = self._cnvCoordinates(chunk[:,0], chunk[:,1])
+            hcoords = [h1] + hcoords.tolist()
+            vcoords = [v1] + vcoords.tolist()
+            self.elements.extend([(LINE, state, ha, va, hb, vb)
+                for ha, va, hb, vb in zip(hcoords, vcoords, hcoords[1:], vcoords[1:])])
+            h1, v1 = hcoords[-1], vcoords[-1]
+            self.x, self.y = float(chunk[-1,0]), float(chunk[-1,1])
+        if closed: self.lineTo(*first)
 
     # ---------------------------------------------------------
     # Factory and/or adapter functions
@@ -541,6 +2165,20 @@ class SvgSketcher:
         cnvheight = csys.underlying_cnvheight
         return SvgSketcher(cnvwidth, cnvheight,coordinatesSystem=csys)
 
+    @staticmethod
+    def newBoundedByPointCloud(source, xoffset="1%", yoffset="1%", cnvsize=defaultCanvasWidth, dtype="float64"):
+        """Same as newBoundedByCoordinates, but for a point cloud file
+        path or array (see loadPointCloud). The bounding box is computed
+        chunk by chunk, without loading the whole data."""
+        points = pointCloudArray(source, dtype)
+        return SvgSketcher.newBoundedByCoordinates(points, xoffset, yoffset, cnvsize)
+
+    @staticmethod
+    def newFromSVG(filepath):
+        """Create a sketcher with the elements of the SVG file (see
+        loadSVG), in native coordinates"""
+        return loadSVG(filepath)
+
     def withNativeCoordinates(self):
         """Set a coordinates system that corresponds to the canvas
         native coordinates, i.e. an origin at the top left corner, y
@@ -552,6 +2190,150 @@ class SvgSketcher:
         return SvgSketcher(cnvwidth,cnvheight).withNativeCoordinates()
 
 
+# =======================================================================
+# Concurrent drawing
+
+class ConcurrentElements:
+    """A list of elements that can be appended concurrently by several
+    threads without lock: each thread appends its elements into its own
+    buffer, with a sequence number. The buffers are merged when the list
+    is iterated, in a deterministic order given by order:
+
+    - "thread": the elements of each thread, the threads being sorted by
+      name (then by order of first drawing), i.e. a layer by thread.
+    - "sequence": the order in which the elements have been appended,
+      whatever the thread.
+
+    The negative indices (e.g. -1 for the last element, see
+    SvgSketcher.coalesceLines) refer to the elements of the current
+    thread.
+    """
+    def __init__(self, order="thread", elements=()):
+        if order not in ("thread", "sequence"):
+            raise SvgException("Unknown order %s"%order)
+        self.order = order
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._buffers = [] # (thread name, rank, (elements, sequences))
+        self._sequence = itertools.count()
+        self.extend(elements)
+
+    def _buffer(self):
+        try:
+            return self._local.buffer
+        except AttributeError:
+            buffer = ([], [])
+            with self._lock:
+                self._buffers.append((threading.current_thread().name, len(self._buffers), buffer))
+            self._local.buffer = buffer
+            return buffer
+
+    def threadLists(self):
+        """Return the lists of elements of the threads, in the order of
+        the threads (i.e. the merge order "thread"). A thread only
+        appends to its list (or replaces its last element)."""
+        with self._lock: buffers = sorted(self._buffers, key=lambda buffer: buffer[:2])
+        return [elements for _, _, (elements, _) in buffers]
+
+    def append(self, element):
+        elements, sequences = self._buffer()
+        sequences.append(next(self._sequence))
+        elements.append(element)
+
+    def extend(self, elements):
+        buffer, sequences = self._buffer()
+        elements = list(elements)
+        sequences.extend([next(self._sequence) for element in elements])
+        buffer.extend(elements)
+
+    def __len__(self):
+        with self._lock: buffers = list(self._buffers)
+        return sum(len(buffer[2][0]) for buffer in buffers)
+
+    def __iter__(self):
+        with self._lock: buffers = sorted(self._buffers, key=lambda buffer: buffer[:2])
+        if self.order == "thread":
+            for _, _, (elements, _) in buffers:
+                yield from elements[:len(elements)]
+            return
+        runs = [zip(sequences[:len(elements)], elements[:len(elements)])
+                for _, _, (elements, sequences) in buffers]
+        for _, element in heapq.merge(*runs, key=lambda item: item[0]):
+            yield element
+
+    def __getitem__(self, index):
+        if isinstance(index, int) and index < 0: return self._buffer()[0][index]
+        if isinstance(index, slice):
+            return list(itertools.islice(self, *index.indices(len(self))))
+        if index >= len(self): raise IndexError("element index out of range")
+        return next(itertools.islice(self, index, None))
+
+    def __setitem__(self, index, element):
+        if not isinstance(index, int) or index >= 0:
+            raise SvgException("Only the elements of the current thread can be modified")
+        self._buffer()[0][index] = element
+
+
+class ConcurrentSvgSketcher(SvgSketcher):
+    """A sketcher in which several threads can draw at the same time.
+    Each thread has its own current position (x, y) and its own pencil
+    (a clone of the sketcher pencil, created when the thread uses it for
+    the first time), and appends its elements in its own buffer, so that
+    the threads never wait for each other while drawing. The elements
+    are merged when the sketch is serialized, in the order given by
+    order (see ConcurrentElements).
+
+    The memory budget (see withMemoryBudget) and the incremental save are
+    not available with this sketcher.
+    """
+    def __init__(self, *args, order="thread", **kwargs):
+        self._local = threading.local()
+        self._owner = threading.get_ident()
+        self.order = order
+        SvgSketcher.__init__(self, *args, **kwargs)
+        self.elements = self._newElements()
+
+    def _newElements(self, elements=()):
+        return ConcurrentElements(self.order, elements)
+
+    def withMemoryBudget(self, budget, compress=False):
+        raise SvgException("The memory budget is not available with a concurrent sketcher")
+
+    def _newCheckpoint(self, filepath, end):
+        return None
+
+    @property
+    def x(self):
+        return getattr(self._local, "x", 0.)
+
+    @x.setter
+    def x(self, value):
+        self._local.x = value
+
+    @property
+    def y(self):
+        return getattr(self._local, "y", 0.)
+
+    @y.setter
+    def y(self, value):
+        self._local.y = value
+
+    @property
+    def pencil(self):
+        try:
+            return self._local.pencil
+        except AttributeError:
+            pencil = self._pencil.clone()
+            self._local.pencil = pencil
+            return pencil
+
+    @pencil.setter
+    def pencil(self, pencil):
+        # The pencil set by the owner thread is the model of the others
+        if threading.get_ident() == self._owner: self._pencil = pencil
+        self._local.pencil = pencil
+
+
 def cnvWidthHeight(xywidth, xyheight, cnvsize):
     """Returns the canvas width and height (cnvwidth and cnvheight in
     pixels) in the same aspect ratio than the input xywidth and xyheight
@@ -566,6 +2348,406 @@ def cnvWidthHeight(xywidth, xyheight, cnvsize):
         cnvheight = int(cnvsize)
     return cnvwidth, cnvheight
 
+class LevelRenderer:
+    """A level renderer writes the SVG file of a sketch at a given
+    resolution (see SvgSketcher.saveLevels). The geometry is written in
+    the canvas coordinates of the sketch, and scaled by the viewBox of
+    the SVG element. The simplification works in the canvas coordinates
+    with a tolerance scaled accordingly:
+
+    - the elements outside of the canvas are dropped, and the ones
+      smaller than minSize pixels (texts with a font smaller than
+      minFontSize pixels) in the output resolution.
+    - the consecutive connected lines of same style are merged as long
+      as the merged line stays within the tolerance of the joints.
+    - the polylines of the paths are simplified (see simplifyPolyline).
+    """
+    minSize = 0.5
+    minFontSize = 4
+    maxJoints = 32 # max number of lines merged in a single one
+
+    def __init__(self, sketcher, name, size, filepath, tolerance):
+        self.name = name
+        self.filepath = filepath
+        self.cnvwidth = float(sketcher.cnvwidth)
+        self.cnvheight = float(sketcher.cnvheight)
+        self.scale = float(size) / max(self.cnvwidth, self.cnvheight)
+        self.tolerance = float(tolerance) / self.scale
+        self.pending = None # the line being merged
+        self.joints = []    # the joints of the merged lines
+        self.file = open(filepath, 'w', encoding="utf-8")
+        self.file.write(scaledHeadPattern % (
+            round(self.scale * self.cnvwidth), round(self.scale * self.cnvheight),
+            self.cnvwidth, self.cnvheight) + "\n")
+        if sketcher.backgroundColor is not None:
+            self.file.write(backgroundPattern % sketcher.backgroundColor + "\n")
+
+    def add(self, element, box):
+        if (box[2] < 0 or box[0] > self.cnvwidth or
+            box[3] < 0 or box[1] > self.cnvheight): return
+        kind = element[0]
+        if kind == LINE: return self._addLine(element)
+        if kind == TEXT:
+            size = element[1].fontSize
+            if isinstance(size, (int, float)) and size * self.scale < LevelRenderer.minFontSize:
+                return
+        elif max(box[2]-box[0], box[3]-box[1]) * self.scale < LevelRenderer.minSize:
+            return
+        self._flush()
+        if kind == PATH: element = (PATH, element[1], self._simplify(element[2]))
+        self.file.write(formatElement(element) + "\n")
+
+    def _addLine(self, element):
+        pending = self.pending
+        if (pending is not None and pending[1] is element[1] and
+            pending[4] == element[2] and pending[5] == element[3]):
+            start, end = pending[2:4], element[4:6]
+            joints = self.joints + [element[2:4]]
+            if (len(joints) <= LevelRenderer.maxJoints and
+                all(_distanceToSegment(joint, start, end) <= self.tolerance for joint in joints)):
+                self.pending = pending[:4] + end
+                self.joints = joints
+                return
+        self._flush()
+        self.pending = element
+        self.joints = []
+
+    def _flush(self):
+        if self.pending is None: return
+        self.file.write(formatElement(self.pending) + "\n")
+        self.pending = None
+
+    def _simplify(self, commands):
+        """Simplify the polylines (sequences of L commands) of the path"""
+        simplified = []
+        start = None # start point of the current subpath
+        run = []     # current point followed by the points of the L commands
+        for command in commands + (("END",),):
+            op = command[0]
+            if op == "L":
+                run.append(command[1:])
+                continue
+            if len(run) > 1:
+                run = simplifyPolyline(run, self.tolerance)
+                simplified.extend([("L",) + tuple(p) for p in run[1:]])
+            if op == "END": break
+            simplified.append(command)
+            if op == "M": start = command[1:]
+            run = [start if op == "Z" else command[-2:]]
+        return tuple(simplified)
+
+    def close(self):
+        self._flush()
+        self.file.write(footPattern)
+        self.file.close()
+
+# =======================================================================
+# HTML canvas output (see SvgSketcher.toJSON and saveHTML)
+#
+# For the very large drawings, the geometry of the elements is given to
+# a web page that draws it on a HTML canvas, instead of SVG nodes. The
+# elements are gathered in runs of consecutive elements of same kind
+# and same style, each run being a JSON object:
+#
+#   {"kind": kind, "style": index of the style, "data": coordinates}
+#
+# where the coordinates are an array of little endian float32 numbers
+# (base64 text): (x, y) points of polylines separated by NaN for the
+# lines, (cx, cy, r) for the circles, (x, y, width, height) for the
+# rectangles and (cx, cy, rx, ry) for the ellipses. The runs of texts,
+# paths and densities have instead a list of items [x, y, value], path
+# data, and [x, y, width, height, href] respectively.
+
+canvasRunSize = 65536 # max number of elements of a run
+
+def float32Data(values):
+    """Return the base64 text of the values as little endian float32"""
+    import sys, array, base64
+    data = array.array("f", values)
+    if sys.byteorder == "big": data.byteswap()
+    return base64.b64encode(data.tobytes()).decode("ascii")
+
+def canvasStyle(state):
+    """Return the style (dictionary) of the pencil state for the canvas"""
+    if state.forcedStyle is None:
+        stroke, lineWidth = cssvalue(state.lineColor), state.lineWidth
+        fill, fillOpacity = cssvalue(state.fillColor), state.fillOpacity
+        font = "%s %spx %s"%(state.fontWeight, state.fontSize, state.fontFamily)
+        fontColor = cssvalue(state.fontColor)
+    else:
+        # the forced style is used for both draw and text styles
+        properties = {}
+        for declaration in state.forcedStyle.split(";"):
+            if ":" not in declaration: continue
+            name, value = declaration.split(":", 1)
+            properties[name.strip()] = value.strip()
+        get = properties.get
+        stroke = get("stroke", "none")
+        lineWidth = _number(get("stroke-width"), 1)
+        fill = fontColor = get("fill", "black")
+        fillOpacity = _number(get("fill-opacity"), None)
+        font = "%s %spx %s"%(get("font-weight", "normal"),
+                             _number(get("font-size"), 16), get("font-family", "serif"))
+    return {"stroke": stroke, "lineWidth": lineWidth, "fill": fill,
+            "fillOpacity": fillOpacity, "font": font, "fontColor": fontColor}
+
+def canvasRuns(elements):
+    """Generate the runs (see above) of the elements, as tuples (kind,
+    state, values, items)"""
+    kind = state = None
+    values, items = [], []
+    count = 0
+    hlast = vlast = None # end of the polyline of the current run
+    for element in elements:
+        if element[0] != kind or element[1] is not state or count == canvasRunSize:
+            if count > 0: yield kind, state, values, items
+            kind, state = element[0], element[1]
+            values, items = [], []
+            count = 0
+            hlast = vlast = None
+        count += 1
+        if kind == LINE:
+            _, _, x1, y1, x2, y2 = element
+            if x1 != hlast or y1 != vlast:
+                if hlast is not None: values += (math.nan, math.nan)
+                values += (x1, y1)
+            values += (x2, y2)
+            hlast, vlast = x2, y2
+        elif kind == TEXT:
+            items.append(element[2:])
+        elif kind == PATH:
+            items.append(pathData(element[2]))
+        elif kind == DENSITY:
+            items.append(element[2:6] + element[7:])
+        else:
+            values += element[2:]
+    if count > 0: yield kind, state, values, items
+
+canvasHeadPattern = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%s</title>
+<style>
+body { margin: 0; }
+canvas { border: 1px solid lightgray; cursor: move; }
+</style>
+</head>
+<body>
+<canvas id="canvas"></canvas>
+<script id="sketch" type="application/json">
+"""
+canvasFootPattern = """
+</script>
+<script>
+(function() {
+  // Mouse wheel to zoom, drag to move, double click to reset
+  var sketch = JSON.parse(document.getElementById("sketch").textContent);
+  var canvas = document.getElementById("canvas");
+  var ctx = canvas.getContext("2d");
+  canvas.width = sketch.width;
+  canvas.height = sketch.height;
+  var zoom = 1, hpan = 0, vpan = 0, pending = false;
+
+  function floats(text) {
+    var bytes = atob(text), buffer = new Uint8Array(bytes.length);
+    for (var i = 0; i < bytes.length; i++) buffer[i] = bytes.charCodeAt(i);
+    return new Float32Array(buffer.buffer);
+  }
+
+  function densityImage(item, style) {
+    // the gray levels of the image are the opacity of the fill color
+    var image = new Image(), mask = document.createElement("canvas");
+    image.onload = function() {
+      mask.width = image.width;
+      mask.height = image.height;
+      var mctx = mask.getContext("2d");
+      mctx.drawImage(image, 0, 0);
+      var pixels = mctx.getImageData(0, 0, mask.width, mask.height);
+      for (var i = 0; i < pixels.data.length; i += 4) pixels.data[i+3] = pixels.data[i];
+      mctx.putImageData(pixels, 0, 0);
+      mctx.globalCompositeOperation = "source-in";
+      mctx.fillStyle = style.fill;
+      mctx.fillRect(0, 0, mask.width, mask.height);
+      mask.ready = true;
+      redraw();
+    };
+    image.src = item[4];
+    return mask;
+  }
+
+  // The paths of the runs are built once, and only drawn at each redraw.
+  // A filled and stroked shape is drawn alone to keep the SVG z-order.
+  var runs = sketch.runs.map(function(run) {
+    var style = sketch.styles[run.style], paths = [], path = new Path2D();
+    var single = run.kind != "line" && style.fill != "none" && style.stroke != "none";
+    function next() { if (single) { paths.push(path); path = new Path2D(); } }
+    var d = run.data ? floats(run.data) : [], i;
+    if (run.kind == "line") {
+      var move = true;
+      for (i = 0; i < d.length; i += 2) {
+        if (isNaN(d[i])) { move = true; continue; }
+        if (move) path.moveTo(d[i], d[i+1]); else path.lineTo(d[i], d[i+1]);
+        move = false;
+      }
+    } else if (run.kind == "circle") {
+      for (i = 0; i < d.length; i += 3) {
+        path.moveTo(d[i] + d[i+2], d[i+1]);
+        path.arc(d[i], d[i+1], d[i+2], 0, 2*Math.PI);
+        next();
+      }
+    } else if (run.kind == "rect") {
+      for (i = 0; i < d.length; i += 4) { path.rect(d[i], d[i+1], d[i+2], d[i+3]); next(); }
+    } else if (run.kind == "ellipse") {
+      for (i = 0; i < d.length; i += 4) {
+        path.moveTo(d[i] + d[i+2], d[i+1]);
+        path.ellipse(d[i], d[i+1], d[i+2], d[i+3], 0, 0, 2*Math.PI);
+        next();
+      }
+    } else if (run.kind == "path") {
+      run.items.forEach(function(data) { path.addPath(new Path2D(data)); next(); });
+    } else if (run.kind == "density") {
+      run.masks = run.items.map(function(item) { return densityImage(item, style); });
+    }
+    if (!single) paths.push(path);
+    return {kind: run.kind, style: style, paths: paths, items: run.items, masks: run.masks};
+  });
+
+  function draw() {
+    pending = false;
+    ctx.setTransform(1, 0, 0, 1, 0, 0);
+    ctx.clearRect(0, 0, canvas.width, canvas.height);
+    if (sketch.background) {
+      ctx.fillStyle = sketch.background;
+      ctx.fillRect(0, 0, canvas.width, canvas.height);
+    }
+    ctx.setTransform(zoom, 0, 0, zoom, hpan, vpan);
+    runs.forEach(function(run) {
+      var style = run.style, opacity = style.fillOpacity == null ? 1 : style.fillOpacity;
+      if (run.kind == "text") {
+        ctx.font = style.font;
+        ctx.fillStyle = style.fontColor;
+        run.items.forEach(function(item) { ctx.fillText(item[2], item[0], item[1]); });
+      } else if (run.kind == "density") {
+        ctx.globalAlpha = opacity;
+        run.items.forEach(function(item, i) {
+          if (run.masks[i].ready) ctx.drawImage(run.masks[i], item[0], item[1], item[2], item[3]);
+        });
+        ctx.globalAlpha = 1;
+      } else {
+        ctx.lineWidth = style.lineWidth;
+        ctx.strokeStyle = style.stroke;
+        ctx.fillStyle = style.fill;
+        run.paths.forEach(function(path) {
+          if (run.kind != "line" && style.fill != "none") {
+            ctx.globalAlpha = opacity;
+            ctx.fill(path);
+            ctx.globalAlpha = 1;
+          }
+          if (style.stroke != "none" && style.lineWidth) ctx.stroke(path);
+        });
+      }
+    });
+  }
+
+  function redraw() {
+    if (!pending) { pending = true; window.requestAnimationFrame(draw); }
+  }
+
+  canvas.addEventListener("wheel", function(e) {
+    e.preventDefault();
+    var factor = e.deltaY < 0 ? 1.25 : 0.8;
+    hpan = e.offsetX - factor * (e.offsetX - hpan);
+    vpan = e.offsetY - factor * (e.offsetY - vpan);
+    zoom *= factor;
+    redraw();
+  });
+  var drag = null;
+  canvas.addEventListener("mousedown", function(e) { drag = [e.offsetX - hpan, e.offsetY - vpan]; });
+  window.addEventListener("mouseup", function(e) { drag = null; });
+  canvas.addEventListener("mousemove", function(e) {
+    if (drag) { hpan = e.offsetX - drag[0]; vpan = e.offsetY - drag[1]; redraw(); }
+  });
+  canvas.addEventListener("dblclick", function(e) { zoom = 1; hpan = vpan = 0; redraw(); });
+  draw();
+})();
+</script>
+</body>
+</html>
+"""
+
+# =======================================================================
+# Composition of sketches
+
+nestedPattern = "<svg x='%.2f' y='%.2f' width='%.2f' height='%.2f' viewBox='0 0 %.2f %.2f'>"
+nestedEndPattern = "</svg>"
+transformPattern = "<g transform='translate(%.2f %.2f) scale(%g)'>"
+sizedBackgroundPattern = "<rect width='%.2f' height='%.2f' fill='%s'/>"
+
+class SvgComposition:
+    """A SVG document made of sketches (sketchers or compositions) placed
+    at a position and a scale on a canvas (see place). The composition
+    keeps only references to the sketches, whose SVG text is taken from
+    their cache at serialization (see SvgSketcher.fragment), so that a
+    sketch is formatted only once whatever the number of compositions,
+    and only the new elements of a sketch are formatted when a
+    composition is serialized again."""
+
+    def __init__(self, cnvwidth, cnvheight, backgroundColor=None):
+        self.cnvwidth = cnvwidth
+        self.cnvheight = cnvheight
+        self.backgroundColor = backgroundColor
+        self.placements = [] # (sketch, x, y, scale, clip)
+
+    def place(self, sketch, x=0., y=0., scale=1., clip=True):
+        """Place the sketch with its top left corner at the position (x,
+        y) in pixels of the canvas of the composition, and scaled by the
+        factor scale. If clip is True, the sketch is drawn in a nested
+        <svg> element, i.e. clipped to its canvas. Otherwise, it is drawn
+        in a <g> element whose transform gives the position and scale."""
+        self.placements.append((sketch, x, y, scale, clip))
+        return self
+
+    def fragment(self, grouped=None):
+        """Return the SVG text of the placed sketches"""
+        return "".join(self._iterBody(grouped))
+
+    def _iterBody(self, grouped):
+        for sketch, x, y, scale, clip in self.placements:
+            width, height = sketch.cnvwidth, sketch.cnvheight
+            if clip:
+                yield nestedPattern % (x, y, scale*width, scale*height, width, height) + "\n"
+            else:
+                yield transformPattern % (x, y, scale) + "\n"
+            if sketch.backgroundColor is not None:
+                yield sizedBackgroundPattern % (width, height, sketch.backgroundColor) + "\n"
+            yield sketch.fragment(grouped)
+            yield (nestedEndPattern if clip else groupEndPattern) + "\n"
+
+    def _iterSVG(self, grouped=None):
+        yield headPattern % (self.cnvwidth, self.cnvheight) + "\n"
+        if self.backgroundColor is not None:
+            yield backgroundPattern % self.backgroundColor + "\n"
+        yield from self._iterBody(grouped)
+        yield footPattern
+
+    def toSVG(self, grouped=None):
+        return "".join(self._iterSVG(grouped))
+
+    def __repr__(self):
+        return self.toSVG()
+
+    def save(self, filepath=None, grouped=None):
+        """Write the SVG text in the file piece by piece (a temporary file
+        if filepath is None) and return the file path"""
+        if filepath is None: filepath = svgTempPath()
+        with open(filepath, 'w', encoding="utf-8") as svgfile:
+            svgfile.writelines(self._iterSVG(grouped))
+        return filepath
+
+    def display(self):
+        SvgViewer.display(self.toSVG())
+
 # =======================================================================
 
 class SvgSketcherWrapper:
@@ -647,11 +2829,35 @@ def svg2png(svgpath, pngpath=None):
     outimg.save(filename=pngpath)
     return pngpath
 
-def svgTempPath():
-    """Return a filepath generated using tempfile"""
-    with tempfile.NamedTemporaryFile(suffix='.svg') as svgfile:
-        filepath = svgfile.name
-    return filepath
+svgTempIds = itertools.count()
+svgTempDirectory = None # (process id, path) of the directory of the temporary files
+svgTempLock = threading.Lock()
+
+def svgTempPath(suffix=".svg"):
+    """Return a filepath in a private temporary directory of the process
+    (created with tempfile.mkdtemp, readable and writable by the user
+    only, so that no other user can create or link the files, and
+    removed at exit). A forked process creates its own directory. The
+    name is made of a counter, so that it is unique without creating
+    (and removing) a file to get it."""
+    global svgTempDirectory
+    pid = os.getpid()
+    with svgTempLock:
+        if svgTempDirectory is None or svgTempDirectory[0] != pid or not os.path.isdir(svgTempDirectory[1]):
+            import atexit
+            import tempfile
+            directory = tempfile.mkdtemp(prefix="svgsketcher-")
+            atexit.register(_removeTempDirectory, pid, directory)
+            svgTempDirectory = (pid, directory)
+        directory = svgTempDirectory[1]
+    return os.path.join(directory, "sketch-%d%s"%(next(svgTempIds), suffix))
+
+def _removeTempDirectory(pid, directory):
+    # only by the process that created it (the exit handlers are
+    # inherited by the forked processes)
+    if os.getpid() == pid:
+        import shutil
+        shutil.rmtree(directory, ignore_errors=True)
 
 def boundingBox(xycoordinates):
     """Return the bounding coordinates for the specified list of (x,y)
@@ -659,9 +2865,11 @@ def boundingBox(xycoordinates):
     respectively of the left bottom point and the top right point of the
     rectangle bounding the whole set of input points coordinates
     
-    :param xycoordinates: list of (x,y) coordinates
+    :param xycoordinates: list of (x,y) coordinates, or array of shape (n,2)
     :return: xmin, ymin, xmax, ymax
     """
+    if hasattr(xycoordinates, "shape"):
+        return arrayBoundingBox(xycoordinates)
     assertIsInstance(xycoordinates, list)
     xmin, ymin = math.inf, math.inf
     xmax, ymax = -math.inf, -math.inf
@@ -674,3 +2882,333 @@ def boundingBox(xycoordinates):
         if y < ymin: ymin = y
             
     return xmin, ymin, xmax, ymax
+
+def arrayBoundingBox(points, chunksize=None):
+    """Same as boundingBox, for an array of shape (n,2). The array is
+    read chunk by chunk, so that it can be a memory map of a file larger
+    than the memory (see loadPointCloud)."""
+    if chunksize is None: chunksize = SvgSketcher.cloudChunkSize
+    xmin, ymin = math.inf, math.inf
+    xmax, ymax = -math.inf, -math.inf
+    for chunk in iterChunks(points, chunksize):
+        cmin = chunk.min(axis=0)
+        cmax = chunk.max(axis=0)
+        xmin = min(xmin, float(cmin[0]))
+        ymin = min(ymin, float(cmin[1]))
+        xmax = max(xmax, float(cmax[0]))
+        ymax = max(ymax, float(cmax[1]))
+    return xmin, ymin, xmax, ymax
+
+# =======================================================================
+# Point clouds input (requires numpy)
+
+def importNumpy():
+    try:
+        import numpy
+    except ImportError:
+        raise SvgException("numpy is required for point clouds (install python3-numpy)")
+    return numpy
+
+def loadPointCloud(filepath, dtype="float64"):
+    """Return the (x,y) coordinates stored in the file as a read only
+    memory map of shape (n,2), i.e. the data is read from the file only
+    when accessed. The file can be a numpy file (.npy) or a raw binary
+    file of interleaved x, y values of type dtype."""
+    numpy = importNumpy()
+    if filepath.endswith(".npy"):
+        points = numpy.load(filepath, mmap_mode='r')
+    else:
+        points = numpy.memmap(filepath, dtype=dtype, mode='r')
+    return points.reshape(-1, 2)
+
+def pointCloudArray(source, dtype="float64"):
+    """Return the point cloud array of the source, that is a file path
+    (see loadPointCloud) or an array-like of (x,y) coordinates"""
+    if isinstance(source, str): return loadPointCloud(source, dtype)
+    numpy = importNumpy()
+    return numpy.asarray(source).reshape(-1, 2)
+
+def iterChunks(points, chunksize):
+    """Generate the successive slices of chunksize points of the array"""
+    for start in range(0, len(points), chunksize):
+        yield points[start:start+chunksize]
+
+def pngDataURI(gray):
+    """Return the data URI (base64) of the grayscale PNG image of the
+    2D array gray of uint8 values"""
+    import base64, struct
+    height, width = gray.shape
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data +
+                struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+    # Each row of the image data starts with the filter type (0 = none)
+    rows = b"".join(b"\x00" + row.tobytes() for row in gray)
+    png = (b"\x89PNG\r\n\x1a\n" +
+           chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)) +
+           chunk(b"IDAT", zlib.compress(rows, 9)) +
+           chunk(b"IEND", b""))
+    return "data:image/png;base64," + base64.b64encode(png).decode("ascii")
+
+def evaluateFunction(f, xs):
+    """Return the list of the values f(x) for x in the list xs. The
+    function is called once with the numpy array of xs if numpy is
+    available and if the function accepts it, and else for each x. The
+    values that can't be computed are replaced by nan."""
+    try:
+        numpy = importNumpy()
+        with numpy.errstate(all="ignore"):
+            ys = numpy.asarray(f(numpy.asarray(xs, dtype="float64")), dtype="float64")
+        return numpy.broadcast_to(ys, (len(xs),)).tolist()
+    except (SvgException, TypeError, ValueError):
+        pass
+    ys = []
+    for x in xs:
+        try:
+            ys.append(float(f(x)))
+        except (ArithmeticError, ValueError):
+            ys.append(math.nan)
+    return ys
+
+# =======================================================================
+# SVG files input
+
+svgNamespace = "{http://www.w3.org/2000/svg}"
+definitionTags = ("defs", "symbol", "clipPath", "marker", "pattern") # not rendered as is
+styleProperties = ("stroke", "stroke-width", "fill", "fill-opacity",
+                   "font-family", "font-size", "font-weight")
+
+def _number(value, default=0.):
+    """Return the float value of a SVG length (e.g. '12.5', '10px')"""
+    if value is None: return default
+    try:
+        return float(value)
+    except ValueError:
+        import re
+    match = re.match(r"\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?", value)
+    if match is None: return default
+    return float(match.group(0))
+
+def _cssnumber(value):
+    if value is None or value == "none": return None
+    number = _number(value, None)
+    if number is None: return value
+    if number == int(number): return int(number)
+    return number
+
+def _csscolor(value):
+    if value is None or value == "none": return None
+    return value
+
+_parsedStyles = weakref.WeakValueDictionary()
+
+def parseStyle(style, text=False):
+    """Return the pencil state (see SvgPencilState) whose draw style (or
+    text style if text is True) is the style string. If the style can't
+    be reproduced from the pencil parameters, a state with a forced
+    style is returned."""
+    state = _parsedStyles.get((style, text))
+    if state is None:
+        state = _parseStyle(style, text)
+        _parsedStyles[(style, text)] = state
+    return state
+
+def _parseStyle(style, text):
+    properties = {}
+    for declaration in style.split(";"):
+        if ":" not in declaration: continue
+        name, value = declaration.split(":", 1)
+        properties[name.strip()] = value.strip()
+    get = properties.get
+    fillOpacity = get("fill-opacity")
+    if fillOpacity is not None: fillOpacity = _number(fillOpacity)
+    state = SvgPencilState.intern(
+        _csscolor(get("stroke")),
+        _cssnumber(get("stroke-width", str(SvgPencil.defaultLineWidth))),
+        _csscolor(get("fill")),
+        get("font-family", SvgPencil.defaultFontFamily),
+        _cssnumber(get("font-size", str(SvgPencil.defaultFontSize))),
+        get("font-weight", SvgPencil.defaultFontWeight),
+        _csscolor(get("fill")),
+        None, fillOpacity)
+    expected = state.textStyle() if text else state.drawStyle()
+    if expected == style: return state
+    return SvgPencilState.intern(
+        SvgPencil.defaultLineColor, SvgPencil.defaultLineWidth, SvgPencil.defaultLineColor,
+        SvgPencil.defaultFontFamily, SvgPencil.defaultFontSize, SvgPencil.defaultFontWeight,
+        SvgPencil.defaultLineColor, style)
+
+def parsePathData(data):
+    """Return the path commands (see PATH) of the SVG path data, with
+    the relative, horizontal, vertical and smooth commands converted to
+    the absolute commands M, L, Q, C, A and Z"""
+    import re
+    tokens = re.findall(r"[MmLlHhVvQqTtCcSsAaZz]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?", data)
+    commands = []
+    x = y = sx = sy = 0.
+    control = None # last control point (for the smooth commands)
+    op = None
+    i = 0
+    def numbers(n):
+        values = [float(token) for token in tokens[i:i+n]]
+        if len(values) < n: raise SvgException("Invalid path data %s"%data)
+        return values
+    while i < len(tokens):
+        if tokens[i].isalpha():
+            op = tokens[i]
+            i += 1
+            if op in "Zz":
+                commands.append(("Z",))
+                x, y = sx, sy
+                control = None
+                continue
+        elif op is None:
+            raise SvgException("Invalid path data %s"%data)
+        relative = op.islower()
+        ox, oy = (x, y) if relative else (0., 0.)
+        kind = op.upper()
+        previous = control
+        control = None
+        if kind in "ML":
+            px, py = numbers(2); i += 2
+            x, y = ox + px, oy + py
+            commands.append((kind, x, y))
+            if kind == "M":
+                sx, sy = x, y
+                op = "l" if relative else "L" # implicit lineto
+        elif kind == "H":
+            x = ox + numbers(1)[0]; i += 1
+            commands.append(("L", x, y))
+        elif kind == "V":
+            y = oy + numbers(1)[0]; i += 1
+            commands.append(("L", x, y))
+        elif kind in "QT":
+            if kind == "Q":
+                cx, cy, px, py = numbers(4); i += 4
+                cx, cy = ox + cx, oy + cy
+            else:
+                px, py = numbers(2); i += 2
+                cx, cy = (x, y)
+                if previous is not None and previous[2] == "Q":
+                    cx, cy = 2*x - previous[0], 2*y - previous[1]
+            x, y = ox + px, oy + py
+            commands.append(("Q", cx, cy, x, y))
+            control = (cx, cy, "Q")
+        elif kind in "CS":
+            if kind == "C":
+                c1x, c1y, c2x, c2y, px, py = numbers(6); i += 6
+                c1x, c1y = ox + c1x, oy + c1y
+            else:
+                c2x, c2y, px, py = numbers(4); i += 4
+                c1x, c1y = (x, y)
+                if previous is not None and previous[2] == "C":
+                    c1x, c1y = 2*x - previous[0], 2*y - previous[1]
+            c2x, c2y = ox + c2x, oy + c2y
+            x, y = ox + px, oy + py
+            commands.append(("C", c1x, c1y, c2x, c2y, x, y))
+            control = (c2x, c2y, "C")
+        elif kind == "A":
+            rx, ry, rotation, large, sweep, px, py = numbers(7); i += 7
+            x, y = ox + px, oy + py
+            commands.append(("A", rx, ry, rotation, int(large), int(sweep), x, y))
+    return tuple(commands)
+
+def loadSVG(filepath, sketcher=None):
+    """Read the SVG file and return the sketcher (a new sketcher in
+    native coordinates with the canvas size of the file if sketcher is
+    None) whose elements are the line, circle, ellipse, rect, text and
+    path elements of the file.
+
+    The file is read incrementally (xml.etree.ElementTree.iterparse)
+    and each element is released once converted, so that the memory
+    used does not depend on the size of the file. The style of the
+    elements is given by their style attribute, their presentation
+    attributes, or the style of the enclosing groups (see parseStyle).
+    The transformations and the elements of the definitions (see
+    definitionTags, except the masks of the density layers) are
+    ignored."""
+    import re
+    import xml.etree.ElementTree as ElementTree
+
+    styles = [None] # stack of the styles of the enclosing elements
+    masks = {}      # images of the density masks by id
+    mask = None     # id of the mask being read
+    parents = []    # stack of the enclosing elements
+    text = None     # text element being read (its content is kept)
+    hidden = None   # definitions element being read (see definitionTags)
+    elements = None
+    for event, node in ElementTree.iterparse(filepath, events=("start", "end")):
+        tag = node.tag
+        if tag.startswith(svgNamespace): tag = tag[len(svgNamespace):]
+        if event == "start":
+            style = node.get("style")
+            if style is None:
+                declarations = ["%s: %s"%(name, node.get(name))
+                                for name in styleProperties if node.get(name) is not None]
+                if declarations: style = "; ".join(declarations)
+            styles.append(style if style is not None else styles[-1])
+            if not parents:
+                if sketcher is None:
+                    viewBox = (node.get("viewBox") or "0 0 %f %f"%(
+                        SvgSketcher.defaultCanvasWidth, SvgSketcher.defaultCanvasHeight)).split()
+                    sketcher = SvgSketcher(_number(node.get("width"), float(viewBox[2])),
+                                           _number(node.get("height"), float(viewBox[3])))
+                elements = sketcher.elements
+            elif tag == "mask":
+                mask = node.get("id")
+            elif tag == "text" and text is None:
+                text = node
+            if tag in definitionTags and hidden is None:
+                hidden = node
+            parents.append(node)
+            continue
+
+        style = styles.pop()
+        parents.pop()
+        if text is not None:
+            if node is not text: continue
+            text = None
+        get = node.get
+        if mask is not None:
+            if tag == "image":
+                href = get("href") or get("{http://www.w3.org/1999/xlink}href")
+                masks[mask] = href
+            elif tag == "mask":
+                mask = None
+        elif hidden is not None:
+            if node is hidden: hidden = None
+        elif tag == "line":
+            elements.append((LINE, parseStyle(style or ""),
+                             _number(get("x1")), _number(get("y1")),
+                             _number(get("x2")), _number(get("y2"))))
+        elif tag == "circle":
+            elements.append((CIRCLE, parseStyle(style or ""),
+                             _number(get("cx")), _number(get("cy")), _number(get("r"))))
+        elif tag == "ellipse":
+            elements.append((ELLIPSE, parseStyle(style or ""),
+                             _number(get("cx")), _number(get("cy")),
+                             _number(get("rx")), _number(get("ry"))))
+        elif tag == "rect":
+            x, y = _number(get("x")), _number(get("y"))
+            width, height = get("width", "0"), get("height", "0")
+            maskref = re.match(r"url\(#(.*)\)", get("mask", ""))
+            if width == "100%" and height == "100%" and get("fill") is not None:
+                sketcher.backgroundColor = get("fill")
+            elif maskref is not None and maskref.group(1) in masks:
+                elements.append((DENSITY, parseStyle(style or ""), x, y,
+                                 _number(width), _number(height),
+                                 "density%d"%next(densityMaskIds), masks.pop(maskref.group(1))))
+            else:
+                elements.append((RECT, parseStyle(style or ""), x, y,
+                                 _number(width), _number(height)))
+        elif tag == "text":
+            elements.append((TEXT, parseStyle(style or "", text=True),
+                             _number(get("x")), _number(get("y")), "".join(node.itertext())))
+        elif tag == "path":
+            commands = parsePathData(get("d", ""))
+            if commands: elements.append((PATH, parseStyle(style or ""), commands))
+
+        # Release the converted elements (detached from their parent,
+        # that is kept until its end)
+        node.clear()
+        if parents: parents[-1].remove(node)
+    return sketcher
@@ -1,26 +1,85 @@
 # coding: utf-8
 
+from svgsketcher import SvgSketcher, SvgPencil, CoordinatesSystem
+
+class SketcherMethod:
+    """Give access, at the class level, to a method of the sketcher of
+    a Telecran, so that the instances have not to bind the methods of
+    the sketcher one by one at creation (see Telecran)"""
+    __slots__ = ("name",)
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, telecran, owner=None):
+        if telecran is None: return self
+        return getattr(telecran._Telecran__sketcher, self.name)
+
 class Telecran:
+    # The telecran are light objects (we may create thousands of them),
+    # that delegate the drawing to a sketcher, whose coordinates system
+    # (never modified) is shared by all the telecrans.
+    __slots__ = ("__sketcher",)
+
+    cnvwidth  = SvgSketcher.defaultCanvasWidth
+    cnvheight = SvgSketcher.defaultCanvasHeight
+    xrange = 200
+    _coordinatesSystem = None # created at the first telecran creation
+
     def __init__(self):
-        from svgsketcher import SvgSketcher
-        self.__sketcher = SvgSketcher.newCenteredCoordinates(xrange=200)
-        
-        self.clear   = self.__sketcher.clear
-        self.save    = self.__sketcher.save
-        self.display = self.__sketcher.display
-
-        self.moveTo    = self.__sketcher.moveTo
-        self.lineTo    = self.__sketcher.lineTo
-        self.hlineTo   = self.__sketcher.hlineTo
-        self.vlineTo   = self.__sketcher.vlineTo
-        self.hlineLong = self.__sketcher.hlineLong
-        self.vlineLong = self.__sketcher.vlineLong
-
-        self.point = self.__sketcher.point
-        self.text  = self.__sketcher.text
-        self.circle = self.__sketcher.circle
-        self.rectangle = self.__sketcher.rectangle
-        self.segment = self.__sketcher.segment
-        self.polygon = self.__sketcher.polygon
-
-        self.pencil = self.__sketcher.pencil
\ No newline at end of file
+        csys = Telecran._coordinatesSystem
+        if csys is None:
+            xyunit = CoordinatesSystem.xyrange2xyunit(Telecran.xrange, Telecran.cnvwidth)
+            csys = CoordinatesSystem.Centered(Telecran.cnvwidth, Telecran.cnvheight, xyunit=xyunit)
+            Telecran._coordinatesSystem = csys
+        self.__sketcher = SvgSketcher(Telecran.cnvwidth, Telecran.cnvheight,
+                                      pencil=SvgPencil.new(), coordinatesSystem=csys)
+        # The telecran moves by small steps: consecutive steps in the
+        # same direction are merged in a single line
+        self.__sketcher.coalesceLines = True
+
+    clear   = SketcherMethod()
+    save    = SketcherMethod()
+    display = SketcherMethod()
+
+    moveTo    = SketcherMethod()
+    lineTo    = SketcherMethod()
+    hlineTo   = SketcherMethod()
+    vlineTo   = SketcherMethod()
+    hlineLong = SketcherMethod()
+    vlineLong = SketcherMethod()
+
+    point = SketcherMethod()
+    text  = SketcherMethod()
+    circle = SketcherMethod()
+    rectangle = SketcherMethod()
+    segment = SketcherMethod()
+    polygon = SketcherMethod()
+
+    @property
+    def pencil(self):
+        return self.__sketcher.pencil
+
+    @property
+    def sketcher(self):
+        """The sketcher of the telecran (e.g. to show it, see svgserver)"""
+        return self.__sketcher
+
+    def knobs(self, deltas):
+        """Draw the moves given by a batch of knobs events, i.e. an
+        iterable of (dx, dy) displacements. The consecutive events in
+        the same direction are accumulated and drawn as a single line,
+        so that the cost is proportional to the number of direction
+        changes rather than to the number of events."""
+        sketcher = self.__sketcher
+        sx = sy = 0.
+        for dx, dy in deltas:
+            if dx == 0 and dy == 0: continue
+            if sx*dy != sy*dx or sx*dx + sy*dy < 0:
+                # change of direction
+                sketcher.lineTo(sketcher.x + sx, sketcher.y + sy)
+                sx = sy = 0.
+            sx += dx
+            sy += dy
+        if sx != 0 or sy != 0:
+            sketcher.lineTo(sketcher.x + sx, sketcher.y + sy)
@@ -7,6 +7,8 @@ import unittest
 
 from test_svgsketcher import TestSvgSketcher
 from test_telecran import TestTelecran
+from test_svgserver import TestSvgServer
+from test_svgarchive import TestSvgArchive
 
 def runtest():
     loader = unittest.TestLoader()
@@ -14,6 +16,8 @@ def runtest():
 
     suite.addTests(loader.loadTestsFromTestCase(TestSvgSketcher))
     suite.addTests(loader.loadTestsFromTestCase(TestTelecran))
+    suite.addTests(loader.loadTestsFromTestCase(TestSvgServer))
+    suite.addTests(loader.loadTestsFromTestCase(TestSvgArchive))
     
     unittest.TextTestRunner(verbosity=2).run(suite)
 
@@ -0,0 +1,61 @@
+import os
+import unittest
+
+import svgarchive
+from svgsketcher import SvgSketcher, SvgComposition, SvgException
+
+try:
+    import wand
+except ImportError:
+    wand = None
+
+def newSketchers(count):
+    sketchers = []
+    for i in range(count):
+        sketcher = SvgSketcher.newCenteredCoordinates(cnvwidth=200, cnvheight=100, xrange=10)
+        sketcher.circle(0, 0, 1 + i)
+        sketcher.segment(-4, -4, 4, i)
+        sketchers.append(sketcher)
+    return sketchers
+
+class TestSvgArchive(unittest.TestCase):
+    def checkArchive(self, filepath):
+        sketchers = newSketchers(5)
+        with svgarchive.SvgArchive(filepath, "w") as archive:
+            for i, sketcher in enumerate(sketchers):
+                entry = archive.add("sketch%d"%i, sketcher)
+            archive.add("composition", SvgComposition(400, 100).place(sketchers[0]).place(sketchers[1], 200, 0))
+            self.assertRaises(SvgException, archive.add, "sketch0", sketchers[0])
+        self.assertEqual(entry, {"name": "sketch4", "svg": "sketch4.svg", "width": 200,
+                                 "height": 100, "bytes": len(sketchers[4].toSVG().encode("utf-8"))})
+
+        archive = svgarchive.SvgArchive(filepath)
+        self.assertEqual(archive.names(), ["sketch0", "sketch1", "sketch2", "sketch3", "sketch4", "composition"])
+        self.assertEqual(archive.read("sketch3"), sketchers[3].toSVG())
+        self.assertEqual(archive.read("composition").count("<circle"), 2)
+        sketcher = archive.load("sketch2")
+        self.assertEqual(len(sketcher.elements), 2)
+        self.assertRaises(KeyError, archive.read, "sketch9")
+        archive.close()
+
+    def test_01_zip(self):
+        self.checkArchive("output.test_01_zip.zip")
+
+    def test_02_tar(self):
+        self.checkArchive("output.test_02_tar.tar")
+        self.checkArchive("output.test_02_tar.tar.gz")
+
+    def test_03_unknownFormat(self):
+        self.assertRaises(SvgException, svgarchive.SvgArchive, "output.test_03.rar", "w")
+        self.assertFalse(os.path.exists("output.test_03.rar"))
+
+    @unittest.skipIf(wand is None, "wand is not installed")
+    def test_04_png(self):
+        with svgarchive.SvgArchive("output.test_04_png.zip", "w", png=True) as archive:
+            archive.add("sketch", newSketchers(1)[0])
+        archive = svgarchive.SvgArchive("output.test_04_png.zip")
+        self.assertTrue(archive.read("sketch", png=True).startswith(b"\x89PNG"))
+        archive.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+import json
+import time
+import threading
+import unittest
+import http.client
+
+import svgserver
+import telecran
+from svgsketcher import SvgSketcher, ConcurrentSvgSketcher
+
+def readEvent(response):
+    """Return the (event, data) of the next server-sent event"""
+    event, lines = None, []
+    while True:
+        line = response.readline().decode("utf-8").rstrip("\n")
+        if not line: return event, "\n".join(lines)
+        key, _, value = line.partition(": ")
+        if key == "event": event = value
+        else: lines.append(value)
+
+class TestSvgServer(unittest.TestCase):
+    def setUp(self):
+        self.server = svgserver.SvgServer(port=0).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def get(self, path):
+        connection = http.client.HTTPConnection(self.server.host, self.server.port, timeout=5)
+        connection.request("GET", path)
+        return connection.getresponse()
+
+    def test_01_requests(self):
+        t = telecran.Telecran()
+        t.moveTo(-50, 0)
+        t.lineTo(50, 0)
+        self.server.register("first sketch", t)
+        self.server.register("second", SvgSketcher())
+
+        self.assertEqual(json.loads(self.get("/sketches").read()), ["first sketch", "second"])
+        svgtext = self.get("/svg/first%20sketch").read().decode("utf-8")
+        self.assertEqual(svgtext, t.sketcher.toSVG())
+        self.assertIn("data-name='second'", self.get("/").read().decode("utf-8"))
+        self.assertEqual(self.get("/svg/third").status, 404)
+
+    def test_02_events(self):
+        t = telecran.Telecran()
+        t.moveTo(-50, 0)
+        t.hlineLong(10)
+        self.server.register("telecran", t)
+        response = self.get("/events/telecran")
+        self.assertEqual(response.getheader("Content-Type"), "text/event-stream")
+
+        event, data = readEvent(response)
+        self.assertEqual(event, "reset")
+        self.assertEqual(data.count("<line"), 1)
+
+        # The new elements are sent at once, the coalesced line replacing
+        # the last line sent
+        t.hlineLong(10)
+        t.vlineLong(10)
+        t.circle(radius=5)
+        event, data = readEvent(response)
+        self.assertEqual(event, "replace")
+        self.assertEqual((data.count("<line"), data.count("<circle")), (2, 1))
+
+        t.point()
+        self.assertEqual(readEvent(response)[0], "append")
+        t.clear()
+        self.assertEqual(readEvent(response), ("reset", SvgSketcher.newCenteredCoordinates().toSVG()))
+        self.server.unregister("telecran")
+        self.assertEqual(readEvent(response), ("close", "telecran"))
+
+    def test_03_layers(self):
+        sketcher = SvgSketcher()
+        sketcher.layer("shapes")
+        sketcher.circle(100, 100, 10)
+        sketcher.layer("boxes")
+        sketcher.rectangle(10, 10, 20, 20)
+        self.server.register("layers", sketcher)
+        response = self.get("/events/layers")
+
+        # All the visible layers are sent
+        event, data = readEvent(response)
+        self.assertEqual(event, "reset")
+        self.assertEqual((data.count("<circle"), data.count("<rect")), (1, 1))
+
+        # The selection of a layer does not reset the clients, and the
+        # elements of the top layer are appended
+        sketcher.layer("shapes")
+        sketcher.layer("boxes")
+        sketcher.rectangle(40, 40, 20, 20)
+        event, data = readEvent(response)
+        self.assertEqual(event, "append")
+        self.assertEqual((data.count("<circle"), data.count("<rect")), (0, 1))
+
+        # The elements of a lower layer, or the visibility, reset the clients
+        sketcher.layer("shapes")
+        sketcher.circle(200, 100, 10)
+        event, data = readEvent(response)
+        self.assertEqual(event, "reset")
+        self.assertEqual((data.count("<circle"), data.count("<rect")), (2, 2))
+        sketcher.hideLayer("boxes")
+        event, data = readEvent(response)
+        self.assertEqual((data.count("<circle"), data.count("<rect")), (2, 0))
+
+    def test_04_concurrentSketcher(self):
+        sketcher = ConcurrentSvgSketcher(order="thread")
+        def draw(count, y):
+            for i in range(count): sketcher.segment(10 * i, y, 10 * i + 5, y)
+        def drawIn(name, count, y):
+            thread = threading.Thread(target=draw, args=(count, y), name=name)
+            thread.start()
+            thread.join()
+        drawIn("A", 3, 10)
+        drawIn("B", 3, 20)
+        draw(3, 30) # in the main thread, the last in thread order
+        self.server.register("concurrent", sketcher)
+        response = self.get("/events/concurrent")
+        self.assertEqual(readEvent(response)[1].count("<line"), 9)
+
+        # The new elements of the last thread are appended, the others
+        # are sent with a reset (they are not at the end of the sketch)
+        draw(1, 40)
+        event, data = readEvent(response)
+        self.assertEqual((event, data.count("<line")), ("append", 1))
+        drawIn("A", 1, 50)
+        self.assertEqual(readEvent(response), ("reset", sketcher.toSVG(False)))
+
+        # In sequence order, any change is sent with a reset
+        sketcher = ConcurrentSvgSketcher(order="sequence")
+        drawIn("A", 2, 10)
+        self.server.register("sequence", sketcher)
+        response = self.get("/events/sequence")
+        self.assertEqual(readEvent(response)[0], "reset")
+        drawIn("B", 1, 20)
+        self.assertEqual(readEvent(response), ("reset", sketcher.toSVG(False)))
+
+    def test_05_disconnection(self):
+        self.server.register("idle", SvgSketcher())
+        connection = http.client.HTTPConnection(self.server.host, self.server.port, timeout=5)
+        connection.request("GET", "/events/idle")
+        response = connection.getresponse()
+        self.assertEqual(readEvent(response)[0], "reset")
+        self.assertEqual(self.server.clients, 1)
+
+        # The client is released, though the sketch does not change
+        response.close()
+        connection.close()
+        for i in range(50):
+            if self.server.clients == 0: break
+            time.sleep(0.02)
+        self.assertEqual(self.server.clients, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,13 +3,25 @@
 __author__ = "gboulant, nov. 2022"
 
 import os
+import gc
+import sys
+import math
 import inspect
 import random
+import tempfile
+import threading
+import subprocess
+import tracemalloc
 
 import unittest
 
 import svgsketcher
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class TestWrapper:
     """This class is for test purpose only. It can be use to wrap the
     execution of a sketching test, by starting the sketch, and ending by
@@ -130,6 +142,28 @@ class TestSvgSketcher(unittest.TestCase):
         svgpath = sketcher.save()
         print("SVG saved into file %s"%svgpath)
         self.assertTrue(os.path.exists(svgpath))
+        # The temporary files are in a directory private to the user
+        directory = os.path.dirname(svgpath)
+        self.assertEqual(os.stat(directory).st_mode & 0o777, 0o700)
+        self.assertNotEqual(svgsketcher.svgTempPath(), svgpath)
+        if hasattr(os, "fork"):
+            # A forked process has its own directory
+            read, write = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.write(write, svgsketcher.svgTempPath().encode("utf-8"))
+                os._exit(0)
+            os.close(write)
+            childpath = os.read(read, 4096).decode("utf-8")
+            os.close(read)
+            os.waitpid(pid, 0)
+            self.assertNotEqual(os.path.dirname(childpath), directory)
+            os.rmdir(os.path.dirname(childpath)) # os._exit skips the cleanup
+        # The directory is removed at exit
+        childpath = subprocess.check_output([sys.executable, "-c",
+            "import svgsketcher; print(svgsketcher.SvgSketcher().save())"], text=True).strip()
+        self.assertFalse(os.path.exists(os.path.dirname(childpath)))
+        self.assertTrue(os.path.isdir(directory))
 
     def test_04_background(self):
         sketcher = svgsketcher.SvgSketcher()
@@ -223,6 +257,88 @@ class TestSvgSketcher(unittest.TestCase):
         sketcher3.save(outputpath(pattern="output.{fname}_with_offset_as_percentage.svg"))
 
 
+    def test_07_pencilStates(self):
+        pencil = svgsketcher.SvgPencil()
+        state = pencil.state()
+        # The state is kept until a parameter of the pencil is modified
+        self.assertIs(pencil.state(), state)
+        # Two pencils with the same parameters share the same state
+        self.assertIs(svgsketcher.SvgPencil().state(), state)
+
+        pencil.lineColor = "red"
+        self.assertIsNot(pencil.state(), state)
+        self.assertEqual(pencil.drawStyle(), "stroke: red; stroke-width: 2; fill: black")
+
+        # The variants are cached by the state
+        variant = state.withoutBorder().withFill("blue")
+        self.assertIs(state.withoutBorder().withFill("blue"), variant)
+        self.assertEqual(variant.drawStyle(), "stroke: none; stroke-width: 2; fill: blue")
+        self.assertEqual(state.drawStyle(), "stroke: black; stroke-width: 2; fill: black")
+
+        def testfct():
+            state.lineColor = "green"
+        self.assertRaises(svgsketcher.SvgException, testfct)
+
+        # A forced style is kept by the variants
+        pencil.forceStyle("stroke: yellow")
+        self.assertEqual(pencil.state().withoutFill().drawStyle(), "stroke: yellow")
+
+        # The states are released with the elements that use them
+        count = len(svgsketcher.SvgPencilState._interned)
+        sketcher = svgsketcher.SvgSketcher()
+        for i in range(1000):
+            sketcher.pencil.lineColor = "#%06x"%i
+            sketcher.circle(0., 0., 1., fill=True)
+        self.assertGreaterEqual(len(svgsketcher.SvgPencilState._interned), count + 1000)
+        del sketcher
+        gc.collect()
+        self.assertLessEqual(len(svgsketcher.SvgPencilState._interned), count + 1)
+
+        # The threads that create the same states get the same objects
+        states = [[] for rank in range(4)]
+        barrier = threading.Barrier(len(states))
+        def worker(rank):
+            barrier.wait()
+            for i in range(2000):
+                states[rank].append(svgsketcher.SvgPencilState.intern(
+                    "#%06x"%i, 2, None, "Arial", 12, "normal", "black"))
+        threads = [threading.Thread(target=worker, args=(rank,)) for rank in range(len(states))]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        for others in states[1:]:
+            self.assertTrue(all(state is other for state, other in zip(states[0], others)))
+
+    def test_08_groupedStyles(self):
+        sketcher = svgsketcher.SvgSketcher()
+        # Two distant runs of red lines, separated by a blue line that
+        # does not overlap the second run: all the red lines are gathered
+        # in the same group.
+        sketcher.pencil.lineColor = "red"
+        sketcher.segment(10, 10, 50, 10)
+        sketcher.segment(10, 20, 50, 20)
+        sketcher.pencil.lineColor = "blue"
+        sketcher.segment(10, 100, 50, 100)
+        sketcher.pencil.lineColor = "red"
+        sketcher.segment(10, 30, 50, 30)
+        # A green circle covering the red lines, then a red line drawn over
+        # it: this line can't be moved below the circle.
+        sketcher.pencil.lineColor = "green"
+        sketcher.circle(30, 20, 30)
+        sketcher.pencil.lineColor = "red"
+        sketcher.segment(10, 40, 50, 40)
+
+        svgtext = sketcher.toSVG(grouped=True)
+        self.assertEqual(svgtext.count("<g "), 1)
+        self.assertEqual(svgtext.count("style="), 4)
+        self.assertLess(len(svgtext), len(sketcher.toSVG()))
+        order = [line.split()[0] for line in svgtext.splitlines()]
+        self.assertEqual(order, ["<svg", "<g",
+            "<line", "<line", "<line", "</g>", "<line", "<circle", "<line", "</svg>"])
+        self.assertIn("blue", svgtext.splitlines()[6])
+
+        sketcher.groupStyles = True
+        sketcher.save(outputpath())
+
     def test_10_lines(self):
         sketcher = svgsketcher.SvgSketcher()
         
@@ -368,6 +484,516 @@ class TestSvgSketcher(unittest.TestCase):
 
         tw.end()
 
+    def test_17_polygonFromGenerator(self):
+        tw = TestWrapper()
+        sketcher = tw.start(withaxis=False)
+
+        def spiral(n):
+            for i in range(n):
+                angle = 0.1 * i
+                radius = 0.002 * i
+                yield (radius * math.cos(angle), radius * math.sin(angle))
+
+        n = 3 * svgsketcher.SvgSketcher.polygonChunkSize + 7
+        sketcher.polygon(spiral(n), closed=True)
+        self.assertEqual(len(sketcher.elements), n)
+        self.assertEqual(sketcher.xy(), (0., 0.))
+
+        # The result is the same as with a list of points
+        reference = svgsketcher.SvgSketcher()
+        reference.withCoordinatesSystem(sketcher.coordinatesSystem)
+        reference.polygon(list(spiral(n)), closed=True)
+        self.assertEqual(reference.toSVG(), sketcher.toSVG())
+
+        tw.end()
+
+    def test_18_curves(self):
+        tw = TestWrapper()
+        sketcher = tw.start()
+
+        # Each curve is a single path element
+        sketcher.moveTo(1., 0.)
+        sketcher.arcTo(0., 1., radius=1.)
+        sketcher.arcTo(1., 0., radius=1., largeArc=True, clockwise=True)
+        sketcher.moveTo(-4., -2.)
+        sketcher.quadTo(-3., 2., -2., -2.)
+        sketcher.cubicTo(-1., 2., 1., -4., 2., -2.)
+        self.assertEqual(sketcher.xy(), (2., -2.))
+        sketcher.pencil.lineColor = "blue"
+        sketcher.ellipse(0., 0., rx=3., ry=1.5)
+        self.assertEqual(len(sketcher.elements), 2 + 5)
+
+        # The y axis is oriented upward: a counterclockwise arc is drawn
+        # with a negative direction in the canvas (sweep flag 0)
+        svgtext = sketcher.toSVG()
+        self.assertIn("<path d='M350.00 200.00 A50.00 50.00 0 0 0 300.00 150.00'", svgtext)
+        self.assertIn("A50.00 50.00 0 1 1 350.00 200.00'", svgtext)
+        self.assertIn("<ellipse cx='300.00' cy='200.00' rx='150.00' ry='75.00'", svgtext)
+
+        # The flattening of the arc is within the tolerance
+        commands = sketcher.elements[2][2]
+        polyline = svgsketcher.flattenPath(commands, tolerance=0.5)[0]
+        self.assertEqual(polyline[0], (350., 200.))
+        self.assertEqual(polyline[-1], (300., 150.))
+        for h, v in polyline:
+            self.assertAlmostEqual(math.hypot(h-300., v-200.), 50.)
+            self.assertTrue(h >= 300. and v <= 200.)
+        for (h1, v1), (h2, v2) in zip(polyline, polyline[1:]):
+            sagitta = 50. - math.hypot(0.5*(h1+h2)-300., 0.5*(v1+v2)-200.)
+            self.assertLessEqual(sagitta, 0.5)
+
+        polyline = svgsketcher.flattenPath(sketcher.elements[5][2], tolerance=0.5)[0]
+        self.assertEqual(polyline[-1], sketcher._cnvCoordinates(2., -2.))
+
+        tw.end()
+
+    def test_19_plot(self):
+        tw = TestWrapper()
+        sketcher = tw.start()
+        csys = sketcher.coordinatesSystem
+
+        # The function is evaluated with arrays when possible (numpy)
+        # and else value by value (math.sin does not accept arrays)
+        sketcher.plot(lambda x: math.sin(2*x))
+        self.assertEqual(len(sketcher.elements), 3)
+        commands = sketcher.elements[2][2]
+        self.assertEqual([c[0] for c in commands], ["M"] + ["L"] * (len(commands)-1))
+        self.assertLess(len(commands), 150)
+        xmin, xmax, _, _ = sketcher.xyboundaries()
+        self.assertEqual(csys.xyCoordinates(*commands[0][1:])[0], xmin)
+        self.assertAlmostEqual(csys.xyCoordinates(*commands[-1][1:])[0], xmax)
+
+        # The polyline is within the tolerance of the curve
+        for (_, h1, v1), (_, h2, v2) in zip(commands, commands[1:]):
+            for t in (0.25, 0.5, 0.75):
+                h = h1 + t * (h2-h1)
+                x, _ = csys.xyCoordinates(h, 0.)
+                _, v = csys.cnvCoordinates(x, math.sin(2*x))
+                self.assertLess(abs(v - (v1 + t * (v2-v1))), 1.)
+
+        # The non finite values split the curve in subpaths
+        sketcher.pencil.lineColor = "red"
+        sketcher.plot(lambda x: 1./x, -5., 5.)
+        commands = sketcher.elements[3][2]
+        self.assertEqual([c[0] for c in commands].count("M"), 2)
+        self.assertEqual(sketcher.xy(), (5., 0.2))
+
+        # The position is the last point drawn (the last value is not finite)
+        sketcher.plot(lambda x: 1./x, -5., 0.)
+        self.assertEqual(csys.cnvCoordinates(*sketcher.xy()), sketcher.elements[4][2][-1][1:])
+        sketcher.moveTo(1., 1.)
+        sketcher.plot(lambda x: math.nan, -5., 5.)
+        self.assertEqual(len(sketcher.elements), 5)
+        self.assertEqual(sketcher.xy(), (1., 1.))
+
+        tw.end()
+
+    def test_20_grid(self):
+        self.assertEqual(svgsketcher.niceStep(-6., 6.), 2.)
+        self.assertEqual(svgsketcher.niceStep(0., 0.37), 0.05)
+        self.assertEqual(svgsketcher.niceTicks(-1.3, 2.1, 0.5), [-1., -0.5, 0., 0.5, 1., 1.5, 2.])
+        self.assertEqual(svgsketcher.formatTick(0.15000000000000002, 0.05), "0.15")
+
+        tw = TestWrapper()
+        sketcher = tw.start(withaxis=False)
+        sketcher.grid()
+        # The grid, the axes and the ticks are one path each, then the
+        # labels (7 along the x axis, 9-1 along the y axis)
+        kinds = [element[0] for element in sketcher.elements]
+        self.assertEqual(kinds, [svgsketcher.PATH]*3 + [svgsketcher.TEXT]*(7+8))
+        self.assertEqual(len(sketcher.elements[0][2]), 2*(7+9))
+        styles = set(svgsketcher.elementStyle(element) for element in sketcher.elements[3:])
+        self.assertEqual(len(styles), 1)
+        sketcher.plot(lambda x: 0.1*x**3 - x)
+        tw.end()
+
+    def test_21_levels(self):
+        tw = TestWrapper()
+        sketcher = tw.start()
+        sketcher.backgroundColor = "lightyellow"
+        sketcher.polygon([(0.01*i*math.cos(0.05*i), 0.01*i*math.sin(0.05*i)) for i in range(400)])
+        sketcher.plot(lambda x: 3*math.sin(x))
+        sketcher.text(-5., 3., "Small text", size=10)
+        sketcher.circle(20., 0., 1.) # outside of the canvas
+
+        svgpaths = sketcher.saveLevels({"thumbnail": 60, "preview": 300, "full": 600},
+                                       pattern=outputpath(pattern="output.{fname}.{{level}}.svg"))
+        self.assertEqual(sorted(svgpaths), ["full", "preview", "thumbnail"])
+        svgtexts = {}
+        for level, svgpath in svgpaths.items():
+            with open(svgpath) as svgfile: svgtexts[level] = svgfile.read()
+
+        self.assertIn("width='60' height='40' viewBox='0 0 600.00 400.00'", svgtexts["thumbnail"])
+        self.assertIn("width='600' height='400'", svgtexts["full"])
+        for svgtext in svgtexts.values():
+            self.assertIn("lightyellow", svgtext)
+            self.assertNotIn("<circle", svgtext)
+        self.assertIn("Small text", svgtexts["full"])
+        self.assertNotIn("Small text", svgtexts["thumbnail"])
+        lines = dict((level, svgtext.count("<line")) for level, svgtext in svgtexts.items())
+        self.assertLess(lines["thumbnail"], lines["preview"])
+        self.assertLess(lines["preview"], lines["full"])
+        self.assertLessEqual(lines["full"], 2 + 399)
+        self.assertLess(len(svgtexts["thumbnail"]), len(svgtexts["full"]))
+
+    def test_22_loadSVG(self):
+        tw = TestWrapper()
+        sketcher = tw.start()
+        sketcher.backgroundColor = "lightyellow"
+        sketcher.point(-2., 1., color="red", label="A")
+        sketcher.circle(0., 0., 1., fill=True)
+        sketcher.pencil.lineColor = "blue"
+        sketcher.rectangle(-3., -3., -1., -2., border=False, fill=True)
+        sketcher.ellipse(2., 2., 1., 0.5)
+        sketcher.moveTo(1., 0.)
+        sketcher.arcTo(0., 1., radius=1.)
+        sketcher.cubicTo(-1., 2., 1., 3., 2., 1.)
+        sketcher.pencil.forceStyle("stroke: orange; stroke-dasharray: 4")
+        sketcher.segment(-4., 0., 4., 0.)
+        svgpath = outputpath()
+        sketcher.save(svgpath)
+
+        # The loaded sketch is identical, including when saved with groups
+        loaded = svgsketcher.SvgSketcher.newFromSVG(svgpath)
+        self.assertEqual(loaded.toSVG(), sketcher.toSVG())
+        sketcher.save(svgpath, grouped=True)
+        loaded = svgsketcher.loadSVG(svgpath)
+        self.assertEqual(loaded.toSVG(), sketcher.toSVG())
+
+        # The drawing can go on with the loaded sketch
+        loaded.segment(0., 0., 300., 200.)
+        self.assertEqual(len(loaded.elements), len(sketcher.elements) + 1)
+
+        # The relative, horizontal/vertical and smooth path commands
+        commands = svgsketcher.parsePathData("m10 10 h20 v-5 l5 5 s10 10 20 0 t10 0 z")
+        self.assertEqual(commands, (
+            ("M", 10., 10.), ("L", 30., 10.), ("L", 30., 5.), ("L", 35., 10.),
+            ("C", 35., 10., 45., 20., 55., 10.), ("Q", 55., 10., 65., 10.), ("Z",)))
+
+        loaded = svgsketcher.loadSVG("telecran.svg")
+        self.assertEqual((loaded.cnvwidth, loaded.cnvheight), (600., 400.))
+        self.assertEqual([element[0] for element in loaded.elements], ["circle"] + ["line"]*3 + ["circle"])
+
+        # The texts are escaped, and the definitions are not drawn
+        with open(svgpath, "w") as svgfile:
+            svgfile.write("<svg xmlns='http://www.w3.org/2000/svg' width='100' height='100'>"
+                          "<defs><line x1='0' y1='0' x2='1' y2='1'/><text>hidden</text></defs>"
+                          "<marker id='m'><circle cx='0' cy='0' r='1'/></marker>"
+                          "<text x='1' y='2'>a &amp; &lt;b&gt;</text></svg>")
+        loaded = svgsketcher.loadSVG(svgpath)
+        self.assertEqual([element[0] for element in loaded.elements], ["text"])
+        self.assertEqual(loaded.elements[0][4], "a & <b>")
+        self.assertIn(">a &amp; &lt;b&gt;</text>", loaded.toSVG())
+        loaded.save(svgpath)
+        self.assertEqual(svgsketcher.loadSVG(svgpath).elements[0][4], "a & <b>")
+
+        # The elements of the groups are released once converted: the
+        # memory used to load a grouped file does not grow with the size
+        # of the groups (the loaded elements are spilled to disk)
+        def peak(count):
+            sketcher = svgsketcher.SvgSketcher()
+            for i in range(count): sketcher.segment(i % 600, 0, 0, i % 400)
+            sketcher.save(svgpath, grouped=True)
+            loaded = svgsketcher.SvgSketcher()
+            loaded.withMemoryBudget(100000)
+            tracemalloc.start()
+            svgsketcher.loadSVG(svgpath, loaded)
+            size = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.assertEqual(len(loaded.elements), count)
+            return size
+        peak(100) # first loading (imports and caches)
+        self.assertLess(peak(20000), 1.2 * peak(2000))
+
+    def test_23_incrementalSave(self):
+        tw = TestWrapper()
+        sketcher = tw.start()
+        svgpath = outputpath()
+        def content():
+            with open(svgpath) as svgfile: return svgfile.read()
+
+        sketcher.polygon([(-4., -3.), (-3., 2.), (0., 3.)])
+        sketcher.save(svgpath, incremental=True)
+        self.assertEqual(content(), sketcher.toSVG())
+
+        # Mark the file to check that it is not rewritten (same length)
+        def mark():
+            with open(svgpath, 'r+') as svgfile: svgfile.write("<svg xmlns='http://www.w3.org/2000/SVG'")
+        mark()
+        sketcher.text(-3., -3., "Résumé") # not only ASCII
+        sketcher.circle(2., 2., 1.)
+        sketcher.save(svgpath, incremental=True)
+        self.assertTrue(content().startswith("<svg xmlns='http://www.w3.org/2000/SVG'"))
+        self.assertEqual(content().lower(), sketcher.toSVG().lower())
+        sketcher.save(svgpath, incremental=True) # nothing new
+        self.assertEqual(content().lower(), sketcher.toSVG().lower())
+
+        # Other modifications imply a full rewrite
+        sketcher.backgroundColor = "lightyellow"
+        sketcher.save(svgpath, incremental=True)
+        self.assertEqual(content(), sketcher.toSVG())
+        sketcher.coalesceLines = True
+        sketcher.segment(0., 3., 0., 3.5)
+        sketcher.save(svgpath, incremental=True)
+        mark()
+        sketcher.lineTo(0., 4.) # merged with the last line
+        sketcher.save(svgpath, incremental=True)
+        self.assertEqual(content(), sketcher.toSVG())
+        mark()
+        sketcher.clear()
+        sketcher.segment(0., 0., 1., 1.)
+        sketcher.save(svgpath, incremental=True)
+        self.assertEqual(content(), sketcher.toSVG())
+
+    def test_24_memoryBudget(self):
+        def sketchfunc(sketcher):
+            for i in range(1000):
+                sketcher.pencil.lineColor = ["red", "green", "blue"][i % 3]
+                sketcher.lineTo(0.01*i*math.cos(0.05*i), 0.01*i*math.sin(0.05*i))
+            sketcher.coalesceLines = True
+            sketcher.hlineLong(0.5)
+            sketcher.hlineLong(0.5) # merged with the previous line
+
+        reference = TestWrapper().start()
+        sketchfunc(reference)
+        for compress in (False, True):
+            tw = TestWrapper()
+            sketcher = tw.start().withMemoryBudget(20000, compress=compress)
+            sketchfunc(sketcher)
+            elements = sketcher.elements
+            self.assertIsInstance(elements, svgsketcher.SpillingElements)
+            self.assertEqual(len(elements), len(reference.elements))
+            self.assertLessEqual(len(elements.tail), 100)
+            self.assertEqual(elements[1], reference.elements[1])
+            self.assertEqual(elements[-2], reference.elements[-2])
+            self.assertEqual(sketcher.toSVG(), reference.toSVG())
+
+            svgpath = sketcher.save(outputpath(), incremental=True)
+            sketcher.circle(0., 0., 1.)
+            reference.circle(0., 0., 1.)
+            sketcher.save(svgpath, incremental=True)
+            with open(svgpath) as svgfile:
+                self.assertEqual(svgfile.read(), reference.toSVG())
+            reference.elements.pop()
+
+        # The budget is kept when clearing the sketch
+        sketcher.clear()
+        self.assertIsInstance(sketcher.elements, svgsketcher.SpillingElements)
+        sketcher.withMemoryBudget(None)
+        self.assertEqual(sketcher.elements, [])
+
+    def test_25_deduplicate(self):
+        tw = TestWrapper()
+        sketcher = tw.start(withaxis=False)
+        # Back and forth on the same line: the overlapping lines are merged
+        sketcher.moveTo(-4., 1.)
+        sketcher.hlineLong(3.)
+        sketcher.hlineLong(-2.)
+        sketcher.hlineLong(4.)
+        sketcher.moveTo(-4., 1.)
+        sketcher.hlineLong(-0.5) # touching the first line
+        # Exact duplicates (in both directions) are removed
+        sketcher.circle(0., 0., 1.)
+        sketcher.segment(-1., -1.5, 1., -2.5)
+        sketcher.segment(1., -2.5, -1., -1.5)
+        sketcher.circle(0., 0., 1.)
+        # The lines of another style, or on another line, are kept
+        sketcher.pencil.lineColor = "red"
+        sketcher.segment(-3., 1., -2., 1.)
+        sketcher.segment(-3., 1.5, -2., 1.5)
+
+        removed = sketcher.deduplicate()
+        self.assertEqual(removed, 5)
+        elements = sketcher.elements
+        self.assertEqual([element[0] for element in elements], ["line", "circle", "line", "line", "line"])
+        h1, v1 = sketcher._cnvCoordinates(-4.5, 1.)
+        h2, v2 = sketcher._cnvCoordinates(1., 1.)
+        for value, expected in zip(elements[0][2:], (h1, v1, h2, v2)):
+            self.assertAlmostEqual(value, expected)
+        self.assertEqual(sketcher.deduplicate(), 0)
+        tw.end()
+
+        # A copy drawn over an element of another style is kept
+        sketcher = svgsketcher.SvgSketcher()
+        sketcher.pencil.lineColor = "red"
+        sketcher.segment(10., 50., 100., 50.)
+        sketcher.segment(200., 50., 300., 50.)
+        sketcher.pencil.lineColor = "blue"
+        sketcher.segment(10., 50., 100., 50.)
+        sketcher.pencil.lineColor = "red"
+        sketcher.segment(10., 50., 100., 50.) # covers the blue line
+        sketcher.segment(50., 50., 250., 50.) # collinear, overlapping the blue line
+        sketcher.segment(200., 50., 300., 50.) # away from the blue line
+        self.assertEqual(sketcher.deduplicate(), 1)
+        colors = [element[1].lineColor for element in sketcher.elements]
+        self.assertEqual(colors, ["red", "red", "blue", "red", "red"])
+
+        # A spilled sketch (see withMemoryBudget) is read as it is stored
+        sketchers = [svgsketcher.SvgSketcher() for i in range(2)]
+        sketchers[1].withMemoryBudget(10000)
+        for sketcher in sketchers:
+            for i in range(2000):
+                sketcher.pencil.lineColor = ("red", "blue")[i // 500 % 2]
+                sketcher.segment(i % 300, 10, i % 300 + 1, 20)
+        self.assertGreater(sketchers[1].elements.spilled, 0)
+        self.assertEqual(sketchers[1].deduplicate(), sketchers[0].deduplicate())
+        self.assertEqual(sketchers[1].toSVG(), sketchers[0].toSVG())
+
+    def test_26_concurrentSketcher(self):
+        colors = ["red", "green", "blue", "orange"]
+        def worker(sketcher, rank):
+            sketcher.pencil.lineColor = colors[rank]
+            sketcher.moveTo(0., 0.)
+            for i in range(200):
+                angle = 0.05 * i + rank * 0.5 * math.pi
+                sketcher.lineTo(0.02 * i * math.cos(angle), 0.02 * i * math.sin(angle))
+
+        def sketch(order):
+            csys = svgsketcher.CoordinatesSystem.Centered(600., 400., xyunit=50.)
+            sketcher = svgsketcher.ConcurrentSvgSketcher(600., 400., coordinatesSystem=csys, order=order)
+            sketcher.pencil.lineWidth = 1 # model of the threads pencils
+            threads = [threading.Thread(target=worker, args=(sketcher, rank), name="worker%d"%rank)
+                       for rank in range(len(colors))]
+            for thread in threads: thread.start()
+            for thread in threads: thread.join()
+            return sketcher
+
+        sketcher = sketch("thread")
+        self.assertEqual(len(sketcher.elements), 4 * 200)
+        self.assertRaises(svgsketcher.SvgException, sketcher.withMemoryBudget, 1 << 20)
+        self.assertEqual(sketcher.xy(), (0., 0.)) # position of the main thread
+        self.assertEqual(sketcher.pencil.lineColor, "black")
+        styles = [svgsketcher.elementStyle(element) for element in sketcher.elements]
+        expected = ["stroke: %s; stroke-width: 1; fill: black"%color for color in colors for i in range(200)]
+        self.assertEqual(styles, expected)
+        self.assertEqual(sketch("thread").toSVG(), sketcher.toSVG())
+        sketcher.save(outputpath())
+
+        sketcher = sketch("sequence")
+        self.assertEqual(sorted(sketcher.toSVG().splitlines()), sorted(sketch("thread").toSVG().splitlines()))
+
+    def test_27_stats(self):
+        tw = TestWrapper()
+        sketcher = tw.start()
+        self.assertNotIn("times", sketcher.stats())
+
+        measures = []
+        sketcher.enableStats()
+        sketcher.addProbe(lambda stage, elapsed, detail: measures.append(stage))
+        sketcher.polygon([(-1., -1.), (1., -1.), (1., 1.)], closed=True)
+        sketcher.point(0., 0.)
+        sketcher.pencil.lineColor = "red"
+        sketcher.circle(0., 0., 2.)
+        svgtext = sketcher.toSVG()
+        svgpath = sketcher.save(outputpath())
+
+        stats = sketcher.stats()
+        self.assertEqual(stats["elements"], 2 + 5)
+        self.assertEqual(stats["kinds"], {"line": 5, "circle": 2})
+        self.assertEqual(stats["styles"], 3)
+        self.assertEqual(stats["bytes"], 2 * len(svgtext))
+        self.assertEqual(stats["calls"], {"transform": 7, "format": 2, "serialize": 2, "write": 1})
+        self.assertTrue(all(t >= 0 for t in stats["times"].values()))
+        self.assertEqual(measures.count("transform"), 7)
+        self.assertEqual(measures[-1], "write")
+        self.assertTrue(os.path.exists(svgpath))
+
+        # The bytes are counted in UTF-8, and the incremental saves, the
+        # fragments and the grid are measured
+        sketcher.text(0., 0., "Résumé")
+        sketcher.save(svgpath, incremental=True)
+        appended = svgsketcher.formatElement(sketcher.elements[-1]) + "\n"
+        stats = sketcher.stats()
+        self.assertEqual(stats["bytes"], 2 * len(svgtext) + len(appended.encode("utf-8")))
+        self.assertEqual(stats["calls"]["serialize"], 3)
+        sketcher.fragment()
+        self.assertEqual(sketcher.stats()["calls"]["format"], 4)
+        transforms = sketcher.stats()["calls"]["transform"]
+        sketcher.grid()
+        self.assertGreater(sketcher.stats()["calls"]["transform"], transforms)
+
+        sketcher.disableStats()
+        self.assertNotIn("_cnvCoordinates", vars(sketcher))
+        self.assertNotIn("times", sketcher.stats())
+
+    def test_28_canvas(self):
+        import json, array, base64
+        def floats(data):
+            return array.array("f", base64.b64decode(data)).tolist()
+
+        sketcher = svgsketcher.SvgSketcher.newNativeCoordinates()
+        sketcher.moveTo(10, 10)
+        sketcher.lineTo(20, 10)
+        sketcher.lineTo(20, 30)
+        sketcher.segment(50, 50, 60, 50)
+        sketcher.circle(100, 100, 5)
+        sketcher.circle(110, 100, 5)
+        sketcher.pencil.lineColor = "red"
+        sketcher.text(10, 200, "</script> & <b>")
+        sketcher.lineTo(30, 30)
+
+        geometry = json.loads(sketcher.toJSON())
+        self.assertEqual((geometry["width"], geometry["height"]), (600, 400))
+        runs = geometry["runs"]
+        self.assertEqual([run["kind"] for run in runs], ["line", "circle", "text", "line"])
+        # connected lines are a single polyline, the others separated by NaN
+        points = floats(runs[0]["data"])
+        self.assertEqual(points[:6], [10, 10, 20, 10, 20, 30])
+        self.assertTrue(math.isnan(points[6]) and math.isnan(points[7]))
+        self.assertEqual(points[8:], [50, 50, 60, 50])
+        self.assertEqual(floats(runs[1]["data"]), [100, 100, 5, 110, 100, 5])
+        self.assertEqual(runs[2]["items"], [[10, 200, "</script> & <b>"]])
+        self.assertEqual([run["style"] for run in runs], [0, 1, 2, 2])
+        styles = geometry["styles"]
+        self.assertEqual((styles[0]["stroke"], styles[2]["stroke"]), ("black", "red"))
+
+        htmlpath = sketcher.saveHTML(outputpath("output.{fname}.html"))
+        with open(htmlpath) as htmlfile: page = htmlfile.read()
+        self.assertIn("<canvas", page)
+        self.assertEqual(page.count("</script>"), 2)
+        start = page.index('type="application/json">') + len('type="application/json">')
+        self.assertEqual(json.loads(page[start:page.index("</script>")]), geometry)
+
+    def test_29_layers(self):
+        sketcher = svgsketcher.SvgSketcher.newCenteredCoordinates(xrange=10)
+        sketcher.circle(0, 0, 1)
+        sketcher.layer("frame").boundaries()
+        sketcher.layer("axis", zorder=-1).unitaxis()
+        sketcher.layer("main")
+        sketcher.point(1, 1)
+        self.assertEqual(sketcher.layerNames(), ["axis", "main", "frame"])
+
+        # The layers are drawn in z-order
+        svgtext = sketcher.toSVG()
+        axis, circle, frame = (svgtext.index(s) for s in ("<line", "<circle", "<rect"))
+        self.assertTrue(axis < circle < frame)
+        self.assertEqual(svgtext.count("<circle"), 2)
+
+        # Only the new elements are formatted
+        formatElement = svgsketcher.formatElement
+        formatted = []
+        def counter(element, style=None):
+            formatted.append(element)
+            return formatElement(element, style)
+        svgsketcher.formatElement = counter
+        try:
+            sketcher.point(2, 2)
+            sketcher.hideLayer("axis")
+            hidden = sketcher.toSVG()
+        finally:
+            svgsketcher.formatElement = formatElement
+        self.assertEqual(len(formatted), 1)
+        self.assertNotIn("<line", hidden)
+        self.assertEqual(hidden.count("<circle"), 3)
+
+        sketcher.showLayer("axis")
+        sketcher.removeLayer("frame")
+        self.assertEqual(sketcher.layerNames(), ["axis", "main"])
+        self.assertNotIn("<rect", sketcher.toSVG())
+        self.assertEqual(sketcher.stats()["elements"], len(list(sketcher.visibleElements())))
+        sketcher.save(outputpath())
+        self.assertRaises(svgsketcher.SvgException, sketcher.removeLayer, "main")
+
     def test_30_factory(self):
         xyrange = 100
         
@@ -436,6 +1062,169 @@ class TestSvgSketcher(unittest.TestCase):
         sketcher.save(outputpath())
         
 
+    def test_32_composition(self):
+        first = svgsketcher.SvgSketcher.newCenteredCoordinates(cnvwidth=200, cnvheight=100, xrange=10)
+        first.backgroundColor = "lightyellow"
+        first.circle(0, 0, 2)
+        second = svgsketcher.SvgSketcher.newCenteredCoordinates(cnvwidth=200, cnvheight=100, xrange=10)
+        second.segment(-4, -4, 4, 4)
+
+        composition = svgsketcher.SvgComposition(400, 300)
+        composition.place(first).place(second, 200, 0)
+        composition.place(second, 0, 100, scale=2, clip=False)
+        svgtext = composition.toSVG()
+        self.assertEqual(svgtext.count("<svg"), 3)
+        self.assertIn("viewBox='0 0 200.00 100.00'", svgtext)
+        self.assertIn("<g transform='translate(0.00 100.00) scale(2)'>", svgtext)
+        self.assertIn("<rect width='200.00' height='100.00' fill='lightyellow'/>", svgtext)
+        self.assertEqual(svgtext.count(second.body), 2)
+
+        # The texts of the sketches are reused, only the new elements are
+        # formatted, and the compositions can be nested
+        formatElement = svgsketcher.formatElement
+        formatted = []
+        def counter(element, style=None):
+            formatted.append(element)
+            return formatElement(element, style)
+        svgsketcher.formatElement = counter
+        try:
+            first.point(1, 1)
+            dashboard = svgsketcher.SvgComposition(800, 300).place(composition).place(composition, 400, 0)
+            svgpath = dashboard.save(outputpath())
+        finally:
+            svgsketcher.formatElement = formatElement
+        self.assertEqual(len(formatted), 1)
+        with open(svgpath) as svgfile:
+            self.assertEqual(svgfile.read().count("<circle"), 4)
+
+    def test_33_labelPlacement(self):
+        def labelBoxes(sketcher):
+            size = sketcher.pencil.fontSize
+            ascent, charWidth = svgsketcher.LabelPlacer.ascent, svgsketcher.LabelPlacer.charWidth
+            return [(e[2], e[3] - ascent*size, e[2] + len(e[4])*size*charWidth, e[3] + (1-ascent)*size)
+                    for e in sketcher.elements if e[0] == svgsketcher.TEXT]
+
+        random.seed(3)
+        points = [(random.uniform(-4, 4), random.uniform(-3, 3)) for i in range(300)]
+        counts = {}
+        for placement in ("drop", "leader"):
+            sketcher = svgsketcher.SvgSketcher.newCenteredCoordinates(xrange=10)
+            sketcher.pencil.fontSize = 12
+            sketcher.labelPlacement = placement
+            for i, (x, y) in enumerate(points):
+                sketcher.point(x, y, label="P%d"%i)
+            boxes = labelBoxes(sketcher)
+            # the labels are inside the canvas and do not overlap
+            for i, box in enumerate(boxes):
+                self.assertTrue(box[0] >= 0 and box[2] <= sketcher.cnvwidth)
+                for other in boxes[i+1:]:
+                    self.assertFalse(box[0] < other[2] and other[0] < box[2] and
+                                     box[1] < other[3] and other[1] < box[3])
+            counts[placement] = sketcher.stats()["kinds"]
+            sketcher.save(outputpath("output.{fname}.%s.svg"%placement))
+
+        self.assertEqual(counts["drop"]["circle"], 300)
+        self.assertTrue(0 < counts["drop"]["text"] < 300)
+        self.assertNotIn("line", counts["drop"])
+        self.assertTrue(counts["leader"]["text"] > counts["drop"]["text"])
+        self.assertTrue(counts["leader"]["line"] > 0)
+
+        # The labels are not necessarily texts (as without placement)
+        sketcher = svgsketcher.SvgSketcher()
+        sketcher.labelPlacement = "drop"
+        sketcher.point(100, 100, label=42)
+        sketcher.point(200, 100, label=3.5)
+        self.assertEqual([element[-1] for element in sketcher.elements if element[0] == "text"], [42, 3.5])
+        self.assertIn(">3.5</text>", sketcher.toSVG())
+
+        sketcher = svgsketcher.SvgSketcher()
+        sketcher.labelPlacement = "around"
+        self.assertRaises(svgsketcher.SvgException, sketcher.point, 1, 1, label="P")
+
+    @unittest.skipIf(numpy is None, "numpy is required for point clouds")
+    def test_40_pointCloud(self):
+        xycoordinates, _ = TestSvgSketcher._getElementsForBoundingTest()
+        points = numpy.array(xycoordinates, dtype="float64")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            npypath = os.path.join(tmpdir, "cloud.npy")
+            rawpath = os.path.join(tmpdir, "cloud.bin")
+            numpy.save(npypath, points)
+            points.tofile(rawpath)
+
+            cloud = svgsketcher.loadPointCloud(npypath)
+            self.assertIsInstance(cloud, numpy.memmap)
+            self.assertEqual(svgsketcher.boundingBox(cloud), svgsketcher.boundingBox(xycoordinates))
+            cloud = svgsketcher.loadPointCloud(rawpath)
+            self.assertEqual(cloud.shape, (len(xycoordinates), 2))
+
+            # The drawing is the same as with the standard functions
+            reference = svgsketcher.SvgSketcher.newBoundedByCoordinates(xycoordinates)
+            for x, y in xycoordinates: reference.point(x, y, color="red")
+            reference.polygon(xycoordinates, closed=True)
+
+            chunksize = svgsketcher.SvgSketcher.cloudChunkSize
+            svgsketcher.SvgSketcher.cloudChunkSize = 3
+            try:
+                sketcher = svgsketcher.SvgSketcher.newBoundedByPointCloud(npypath)
+                sketcher.pointCloud(npypath, color="red")
+                sketcher.pathCloud(rawpath, closed=True)
+            finally:
+                svgsketcher.SvgSketcher.cloudChunkSize = chunksize
+            self.assertEqual(sketcher.toSVG(), reference.toSVG())
+            sketcher.save(outputpath())
+
+            # With a memory budget, the elements are spilled as drawn,
+            # and above the density threshold, the density is drawn
+            points = numpy.random.default_rng(0).uniform(-5., 5., size=(100000, 2))
+            numpy.save(npypath, points)
+            threshold = svgsketcher.SvgSketcher.densityThreshold
+            try:
+                svgsketcher.SvgSketcher.densityThreshold = None
+                sketcher = svgsketcher.SvgSketcher.newCenteredCoordinates()
+                sketcher.withMemoryBudget(1 << 20)
+                tracemalloc.start()
+                sketcher.pathCloud(npypath)
+                size = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                self.assertEqual(len(sketcher.elements), len(points) - 1)
+                self.assertLess(size, 4 << 20)
+
+                svgsketcher.SvgSketcher.densityThreshold = 1000
+                sketcher = svgsketcher.SvgSketcher.newCenteredCoordinates()
+                sketcher.pathCloud(npypath, color="green")
+                self.assertEqual([element[0] for element in sketcher.elements], [svgsketcher.DENSITY])
+                self.assertEqual(sketcher.elements[0][1].fillColor, "green")
+            finally:
+                svgsketcher.SvgSketcher.densityThreshold = threshold
+
+    @unittest.skipIf(numpy is None, "numpy is required for point clouds")
+    def test_41_densityCloud(self):
+        tw = TestWrapper()
+        sketcher = tw.start()
+        generator = numpy.random.default_rng(0)
+        points = generator.normal(0., 1., size=(5000, 2))
+
+        threshold = svgsketcher.SvgSketcher.densityThreshold
+        svgsketcher.SvgSketcher.densityThreshold = 1000
+        try:
+            sketcher.pointCloud(points, color="blue")
+        finally:
+            svgsketcher.SvgSketcher.densityThreshold = threshold
+        self.assertEqual(len(sketcher.elements), 3) # unit axis + density
+        svgtext = sketcher.toSVG()
+        self.assertIn("data:image/png;base64,", svgtext)
+        self.assertIn("mask='url(#", svgtext)
+        tw.end()
+
+        sketcher = tw.start()
+        sketcher.densityCloud(points, color="blue", mode="rects", binsize=10)
+        rects = sketcher.elements[2:]
+        self.assertLess(len(rects), 60*40)
+        self.assertTrue(all(r[0] == svgsketcher.RECT for r in rects))
+        styles = set(svgsketcher.elementStyle(r) for r in rects)
+        self.assertIn("stroke: none; stroke-width: 2; fill: blue; fill-opacity: 1", styles)
+        tw.end(outputpath(pattern="output.{fname}_rects.svg"))
+
     def runTest(self):
         """This function executes the whole set of tests"""
         unittest.main(verbosity=2)
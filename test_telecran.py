@@ -1,3 +1,6 @@
+import sys
+import math
+import subprocess
 import unittest
 import telecran
 
@@ -17,4 +20,40 @@ class TestTelecran(unittest.TestCase):
         t.circle(radius=10)
 
         t.display()
-        t.save("output.telecran.svg")
\ No newline at end of file
+        t.save("output.telecran.svg")
+    def test_02_knobs(self):
+        t = telecran.Telecran()
+        t.moveTo(-50,-50)
+        # Many small steps in the same direction are merged in one line
+        for i in range(100): t.hlineLong(1)
+        for i in range(100): t.vlineLong(0.5)
+        # And the same for batches of knobs events
+        t.knobs([(1,0)] * 50 + [(0,-1)] * 50 + [(-1,0)] * 25)
+        t.knobs([(-1,0)] * 25)
+        svgpath = t.save("output.telecran_knobs.svg")
+        with open(svgpath) as svgfile:
+            self.assertEqual(svgfile.read().count("<line"), 5)
+
+    def test_03_lightweight(self):
+        t = telecran.Telecran()
+        self.assertFalse(hasattr(t, "__dict__"))
+        self.assertIsNot(t.pencil, telecran.Telecran().pencil)
+        t.pencil.lineColor = "red"
+        self.assertEqual(telecran.Telecran().pencil.lineColor, "black")
+        # The modules used only for some features are not imported
+        modules = ("subprocess", "tempfile", "pickle", "re")
+        script = "import sys, telecran; print([m for m in %r if m in sys.modules])"%(modules,)
+        output = subprocess.check_output([sys.executable, "-c", script], text=True)
+        self.assertEqual(output.strip(), "[]")
+
+    def test_04_coalesceCurve(self):
+        # A curve drawn by small steps is not merged into a few lines
+        t = telecran.Telecran()
+        steps = 2000
+        t.moveTo(50, 0)
+        for i in range(1, steps + 1):
+            angle = 2 * math.pi * i / steps
+            t.lineTo(50 * math.cos(angle), 50 * math.sin(angle))
+        svgpath = t.save("output.telecran_circle.svg")
+        with open(svgpath) as svgfile:
+            self.assertGreaterEqual(svgfile.read().count("<line"), 0.95 * steps)